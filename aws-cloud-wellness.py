@@ -5,7 +5,6 @@ Attributes:
     AWS_CLOUD_WELLNESS_STANDARD_VERSION (str): Description
     CONFIG_RULE (bool): Description
     CONTROL_1_1_DAYS (int): Description
-    IAM_CLIENT (TYPE): Description
     REGIONS (list): Description
     S3_WEB_REPORT (bool): Description
     S3_WEB_REPORT_BUCKET (str): Description
@@ -16,15 +15,12 @@ Attributes:
 
 from __future__ import print_function
 import json
-import csv
 import time
 import sys
 import re
-import tempfile
-import getopt
 import os
+import threading
 from datetime import datetime
-import boto3
 
 
 ''' TODO:
@@ -59,6 +55,22 @@ S3_WEB_REPORT_EXPIRE = "168"
 # This is mostly used for demo/sharing purposes.
 S3_WEB_REPORT_OBFUSCATE_ACCOUNT = False
 
+# Report layout. "compact" embeds the results as JSON and renders sections and offender
+# pages in the browser when opened, which keeps reports with many offenders small and fast
+# to open. "full" writes every control and offender link as HTML.
+S3_WEB_REPORT_FORMAT = "compact"
+
+# Offenders shown at a time in the compact report.
+S3_WEB_REPORT_OFFENDERS_PAGE_SIZE = 100
+
+# Store the report gzip compressed (Content-Encoding: gzip)? Browsers decompress it transparently.
+S3_WEB_REPORT_COMPRESS = True
+S3_WEB_REPORT_COMPRESS_LEVEL = 6
+
+# Reports larger than this many bytes (after compression) are sent as a multipart upload,
+# one part of this size at a time, so memory use stays bounded. S3 requires at least 5 MB.
+S3_WEB_REPORT_PART_SIZE = 8 * 1024 * 1024
+
 # Would  you like to send the report signedURL to an SNS topic
 SEND_REPORT_URL_TO_SNS = False
 SNS_TOPIC_ARN = "CHANGE_ME_TO_YOUR_TOPIC_ARN"
@@ -71,6 +83,114 @@ SCRIPT_OUTPUT_JSON = True
 # If using S3 reporting, please enable SNS integration to get S3 signed URL
 OUTPUT_ONLY_JSON = False
 
+# Console result format. "json" prints the whole result tree when the scan is done.
+# "ndjson" writes one compact JSON line per control as soon as it is evaluated, for
+# SIEM ingestion; set NDJSON_PER_OFFENDER to also write one line per offender.
+# Can also be set with --output ndjson and --ndjson-per-offender.
+OUTPUT_FORMAT = "json"
+NDJSON_PER_OFFENDER = False
+
+
+# Save progress and continue in a new invocation when the Lambda is about to time out?
+# Completed control results and collected resources are checkpointed, and the
+# next invocation only evaluates the remaining controls.
+CHECKPOINT_ENABLED = True
+
+# Where checkpoints are stored: "s3" for the report bucket, or a local directory (for example an EFS mount).
+CHECKPOINT_LOCATION = "s3"
+CHECKPOINT_PREFIX = "checkpoints/"
+
+# Checkpoint when less than this fraction of the execution time an invocation started with
+# remains. Every invocation evaluates at least one control before it checkpoints.
+CHECKPOINT_MARGIN_FRACTION = 0.2
+
+# Invocations that may continue one scan. Past this, the checkpoint is kept but the
+# function is not invoked again, and the continuation token is returned instead.
+CHECKPOINT_MAX_HOPS = 10
+
+# Invoke the function again to continue the scan? Otherwise the continuation
+# token is returned and the caller has to invoke with {"continuationToken": <token>}.
+CHECKPOINT_REINVOKE = True
+
+
+# SQLite file that keeps every run's results and offenders, with first/last seen history
+# and daily rollups per control. Empty to disable. In Lambda, point it at an EFS mount.
+# Can also be set with --findings-db <path>.
+FINDINGS_DB = ""
+
+
+# Only report changes since the previous run? The JSON output, HTML report and SNS
+# notification then cover new and resolved offenders per control, and nothing is
+# reported or sent when nothing changed. Config rule evaluations still use all results.
+# Can also be set with --diff.
+DIFF_MODE = False
+
+# Where the previous run's results are kept: "s3" for the report bucket, or a local directory.
+DIFF_BASELINE_LOCATION = "s3"
+DIFF_BASELINE_PREFIX = "baselines/"
+
+# When run as a Config rule, also report each offending resource (security groups, trails,
+# keys, VPCs, IAM users and policies, ...) in the rule's region as its own evaluation?
+# Resources the rule reported non compliant before are reported compliant once every
+# control that failed them evaluated them again without a finding. Each evaluation is
+# billed as a custom rule evaluation. The account evaluation is always sent.
+CONFIG_RESOURCE_EVALUATIONS = False
+
+# Evaluations per put_evaluations call (at most 100), and retries of throttled calls.
+CONFIG_EVALUATION_BATCH_SIZE = 100
+CONFIG_EVALUATION_RETRIES = 5
+
+# Deliver results (console output, HTML report and SNS, Config evaluations) on background
+# threads, each sink independently of the others? False delivers them one after another.
+DELIVERY_CONCURRENT = True
+
+# Stop calling a service operation in a region for the rest of the run after its first
+# failure that would repeat on every call, such as a missing IAM permission, a region that
+# is not enabled or an unreachable endpoint? The skipped calls are listed in the
+# 'SkippedScope' of the controls they belong to.
+CIRCUIT_BREAKER_ENABLED = True
+
+# Seconds an AWS call may take, retries included, per operation in OPERATION_DEADLINES
+# ("service.operation"), and never more than what is left of its region's time budget.
+# No attempt starts after the deadline, and each attempt waits for data until the deadline
+# at most (READ_TIMEOUT, or the operation's own deadline when it is listed). Regions with
+# abandoned calls are listed in the 'IncompleteRegions' of the controls they belong to.
+CALL_DEADLINE = 30
+OPERATION_DEADLINES = {"iam.get_credential_report": 60, "iam.get_account_authorization_details": 60}
+
+# Seconds a region may have AWS calls in flight per run, counted in wall-clock time so that
+# concurrent calls are not charged twice. Once spent, the region's remaining calls are
+# skipped and listed in the 'IncompleteRegions' of the controls they belong to. None
+# disables the budget.
+REGION_TIME_BUDGET = 300
+
+# Send a second, identical request when a describe/list/get call is slower than this
+# percentile of the operation's recent calls, and use whichever answers first?
+HEDGE_ENABLED = False
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+
+# HTTP transport of the boto3 clients. Each client keeps up to MAX_WORKERS * 2 pooled
+# connections (room for hedged requests), with TCP keepalive. Retries use botocore's
+# "adaptive" mode, which also rate limits the client when AWS throttles it.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 20
+RETRY_MODE = "adaptive"
+RETRY_MAX_ATTEMPTS = 5
+
+# Call STS through the endpoint of the Lambda's region instead of the global endpoint.
+STS_REGIONAL_ENDPOINTS = True
+
+# Inventory items reused by later invocations of a warm Lambda container, with the number
+# of seconds each stays fresh. Items not listed are collected again on every run, as are
+# items whose collection skipped calls or left regions incomplete. The cache holds at
+# most MEMO_MAX_ENTRIES items and MEMO_MAX_BYTES of (JSON) data, evicting the least
+# recently used first. The enabled regions are kept by the region capability map
+# (REGION_CACHE_TTL) instead.
+MEMO_POLICIES = {"account_number": 86400, "cloud_trails": 300, "events_rules": 300, "iam_details": 300}
+MEMO_MAX_ENTRIES = 32
+MEMO_MAX_BYTES = 64 * 1024 * 1024
+
 
 # --- Control Parameters ---
 
@@ -83,16 +203,554 @@ IAM_MANAGER_POLICY = "iam_manager_policy"
 # Control 1.1 - Days allowed since use of root account.
 CONTROL_1_1_DAYS = 0
 
+# Control 5.4 - Ports that must not be open to the world (0.0.0.0/0 or ::/0).
+# Controls 4.1 (22) and 4.2 (3389) use the same security group rule index.
+SENSITIVE_PORTS = [22, 3389, 1433, 1521, 2375, 3306, 5432, 6379, 9200, 11211, 27017]
+
+# Controls 4.1, 4.2 and 5.4 evaluate each distinct security group rule set once.
+# Optional JSON file that keeps these verdicts, by rule set hash, between runs; it only
+# keeps the rule sets of the latest scan. A warm container keeps at most
+# RULESET_CACHE_MAX_ENTRIES verdicts, the least recently used are dropped first.
+RULESET_CACHE_FILE = ""
+RULESET_CACHE_MAX_ENTRIES = 100000
+
+# Controls 5.1-5.3 - Security service probes run in every region, concurrently.
+# Service name -> (boto3 service, probe function), the probe returns at least {'Status': ...}.
+SECURITY_SERVICE_PROBES = {"GuardDuty": ("guardduty", "probe_guardduty"), "Inspector": ("inspector", "probe_inspector"),
+                           "Macie": ("macie2", "probe_macie")}
+
+# Regions the account has enabled, and the services available in each, are kept for this
+# many seconds. Optional JSON file that keeps them between runs, for example in /tmp.
+REGION_CACHE_TTL = 86400
+REGION_CACHE_FILE = ""
+
 
 # --- Global ---
-IAM_CLIENT = boto3.client('iam')
-S3_CLIENT = boto3.client('s3')
 
 CONTROL_LABEL_MAP = {"1": "IAM", "2": "Logging",
                      "3": "Monitoring", "4": "Networking", "5": "Custom"}
 
 output_bucket = ''
 
+# Threads used for independent AWS calls, such as the per-bucket checks of the trail buckets.
+MAX_WORKERS = 10
+
+# Regional services the scan calls, listed in the region capability map.
+REGIONAL_SERVICES = ['cloudtrail', 'cloudwatch', 'config', 'ec2', 'events', 'guardduty', 'inspector',
+                     'kms', 'logs', 'macie2', 'sns']
+
+# Offender text patterns that identify a resource Config can evaluate, first match wins.
+# IAM ARNs are resolved to the user or policy ID Config uses as resource ID.
+CONFIG_RESOURCE_PATTERNS = [
+    ('AWS::CloudTrail::Trail', r'arn:aws[\w-]*:cloudtrail:[\w-]+:\d{12}:trail/([\w.-]+)'),
+    ('AWS::KMS::Key', r'arn:aws[\w-]*:kms:[\w-]+:\d{12}:key/([\w-]+)'),
+    ('AWS::IAM::User', r'(arn:aws[\w-]*:iam::\d{12}:user/[\w+=,.@/-]+)'),
+    ('AWS::IAM::Policy', r'(arn:aws[\w-]*:iam::\d{12}:policy/[\w+=,.@/-]+)'),
+    ('AWS::EC2::RouteTable', r'\b(rtb-[0-9a-f]+)\b'),
+    ('AWS::EC2::SecurityGroup', r'\b(sg-[0-9a-f]+)\b'),
+    ('AWS::EC2::Instance', r'\b(i-[0-9a-f]+)\b'),
+    ('AWS::EC2::VPC', r'\b(vpc-[0-9a-f]+)\b'),
+]
+
+# Stream NDJSON lines are written to, sys.stdout when None.
+ndjson_stream = None
+
+# Held while a delivery sink prints, so the output of concurrent sinks does not interleave.
+_OUTPUT_LOCK = threading.Lock()
+
+# Exposed ports per security group rule set hash, least recently used first, see get_port_exposure.
+_RULESET_VERDICTS = {}
+
+# Rule set hashes in RULESET_CACHE_FILE, as last read or written.
+_RULESET_FILE_KEYS = set()
+
+# Error codes that fail every call of an operation in a region. AccessDenied style codes
+# only count when the message blames identity-side policies, since resource policies
+# (a key policy, a bucket policy) deny single resources.
+CIRCUIT_BREAKER_CODES = ['UnauthorizedOperation', 'AuthFailure', 'OptInRequired', 'InvalidClientTokenId',
+                         'UnrecognizedClientException', 'SubscriptionRequiredException']
+CIRCUIT_BREAKER_DENIED_CODES = ['AccessDenied', 'AccessDeniedException']
+CIRCUIT_BREAKER_DENIED_PHRASES = ['identity-based policy', 'service control policy', 'permissions boundary',
+                                  'session policy']
+CIRCUIT_BREAKER_ENDPOINT_ERRORS = ['EndpointConnectionError', 'ConnectTimeoutError']
+
+# Region capability map, see region_capabilities.
+_REGION_MAP = {}
+
+# boto3 clients, created on first use and reused by later invocations in a warm container.
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def aws_client(service, region=None):
+    """Return the shared client for a service and region, creating it on first use.
+
+    Importing the module has no AWS side effects: boto3 is only loaded and clients are
+    only built once a control needs them.
+
+    Args:
+        service (str): Service name, for example 'ec2'
+        region (str): Region name, None for the session default
+
+    Returns:
+        TYPE: boto3 client
+    """
+    key = (service, region)
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                import boto3
+                options = dict(config=client_config())
+                if service == 'sts' and STS_REGIONAL_ENDPOINTS:
+                    region = region or os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+                    if region is not None:
+                        options['endpoint_url'] = sts_endpoint(region)
+                if region is not None:
+                    options['region_name'] = region
+                client = boto3.client(service, **options)
+                _TRANSPORT.attach(client)
+                _GUARD.attach(client)
+                if CIRCUIT_BREAKER_ENABLED:
+                    _BREAKER.attach(client, service)
+                client = GuardedClient(client, service, region)
+                _CLIENTS[key] = client
+    return client
+
+
+def sts_endpoint(region):
+    """Regional STS endpoint URL of a region.
+
+    Args:
+        region (str): Region name
+
+    Returns:
+        str: Endpoint URL
+    """
+    suffix = "amazonaws.com.cn" if region.startswith("cn-") else "amazonaws.com"
+    return "https://sts.{0}.{1}".format(region, suffix)
+
+
+def client_config():
+    """botocore Config of the clients: timeouts, pool size, keepalive and retries.
+
+    Returns:
+        TYPE: botocore.config.Config
+    """
+    from botocore.config import Config
+    settings = dict(connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                    max_pool_connections=MAX_WORKERS * 2,
+                    retries={'mode': RETRY_MODE, 'max_attempts': RETRY_MAX_ATTEMPTS})
+    try:
+        return Config(tcp_keepalive=True, **settings)
+    except TypeError:
+        # botocore releases before tcp_keepalive was added
+        return Config(**settings)
+
+
+class TransportMetrics(object):
+    """Counts HTTP requests and the new connections opened for them.
+
+    Requests are counted through botocore's before-send event. New
+    connections are read from the num_connections counters of the clients'
+    urllib3 connection pools, relative to their totals at the start of the
+    run, so urllib3's logging is left alone.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.sessions = []
+        self.baseline = 0
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+        self.baseline = self.opened()
+
+    def attach(self, client):
+        events = getattr(client.meta, 'events', None)
+        if events is not None:
+            events.register('before-send', self.count_request)
+        session = getattr(getattr(client, '_endpoint', None), 'http_session', None)
+        if session is not None:
+            with self.lock:
+                self.sessions.append(session)
+
+    def opened(self):
+        """Connections the clients' connection pools have opened so far."""
+        with self.lock:
+            sessions = list(self.sessions)
+        total = 0
+        for session in sessions:
+            managers = [getattr(session, '_manager', None)] + list(getattr(session, '_proxy_managers', {}).values())
+            for manager in managers:
+                pools = getattr(manager, 'pools', None)
+                for key in list(pools.keys()) if pools is not None else []:
+                    total += getattr(pools.get(key), 'num_connections', 0)
+        return total
+
+    def count_request(self, **kwargs):
+        with self.lock:
+            self.requests += 1
+
+    def summary(self):
+        """Requests, new connections and the share of requests that reused a connection."""
+        with self.lock:
+            requests = self.requests
+        connections = max(self.opened() - self.baseline, 0)
+        reuse = (requests - connections) / float(requests) if requests else 0.0
+        return {'requests': requests, 'newConnections': connections, 'connectionReuse': round(max(reuse, 0.0), 3)}
+
+
+class CircuitBreaker(object):
+    """Short-circuit AWS calls that are certain to fail again.
+
+    Attached to each client through botocore's before-call, after-call
+    and after-call-error events. The first deterministic failure of an
+    operation in a region opens the circuit for (service, operation,
+    region); an unreachable endpoint opens it for the whole service in that
+    region. Later calls raise a ClientError with the original error code
+    without a request, and are recorded as skipped scope.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open = {}
+        self.skipped = []
+
+    def reset(self):
+        """Close all circuits, at the start of a run."""
+        with self.lock:
+            self.open = {}
+            self.skipped = []
+
+    def attach(self, client, service):
+        import functools
+        region = client.meta.region_name
+        events = client.meta.events
+        events.register('before-call', functools.partial(self.before_call, service, region))
+        events.register('after-call', functools.partial(self.after_call, service, region))
+        events.register('after-call-error', functools.partial(self.after_call_error, service, region))
+
+    def before_call(self, service, region, event_name=None, **kwargs):
+        operation = event_name.split('.')[-1]
+        code = self.open.get((service, operation, region)) or self.open.get((service, '*', region))
+        if code is None:
+            return None
+        scope = "{0}:{1}@{2}".format(service, operation, region)
+        with self.lock:
+            self.skipped.append(scope)
+        from botocore.exceptions import ClientError
+        raise ClientError({'Error': {'Code': code, 'Message': "Skipped, an earlier call failed with " + code}},
+                          operation)
+
+    def after_call(self, service, region, event_name=None, parsed=None, **kwargs):
+        error = (parsed or {}).get('Error') or {}
+        code = error.get('Code')
+        message = str(error.get('Message', ''))
+        if code in CIRCUIT_BREAKER_CODES or (code in CIRCUIT_BREAKER_DENIED_CODES and
+                                             any(p in message for p in CIRCUIT_BREAKER_DENIED_PHRASES)):
+            with self.lock:
+                self.open[(service, event_name.split('.')[-1], region)] = code
+
+    def after_call_error(self, service, region, event_name=None, exception=None, **kwargs):
+        name = type(exception).__name__
+        if name in CIRCUIT_BREAKER_ENDPOINT_ERRORS:
+            with self.lock:
+                self.open[(service, '*', region)] = name
+
+    def mark(self):
+        """Position in the skipped calls, to attribute later skips to a control."""
+        with self.lock:
+            return len(self.skipped)
+
+    def skipped_since(self, mark):
+        """Distinct scopes skipped after mark."""
+        with self.lock:
+            return sorted(set(self.skipped[mark:]))
+
+
+_BREAKER = CircuitBreaker()
+_TRANSPORT = TransportMetrics()
+
+
+class GuardedClient(object):
+    """boto3 client whose API calls and paginated requests go through _GUARD."""
+
+    # Client methods that make no API call
+    LOCAL_METHODS = ('can_paginate', 'generate_presigned_url', 'generate_presigned_post', 'get_waiter', 'close')
+
+    def __init__(self, client, service, region):
+        self._client = client
+        self._service = service
+        self._region = region
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name == 'get_paginator':
+            return lambda operation: GuardedPaginator(attr(operation), self._service, operation, self._region)
+        if name.startswith('_') or name in self.LOCAL_METHODS or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return _GUARD.run(self._service, name, self._region, lambda: attr(*args, **kwargs),
+                              hedge=name.startswith(('describe_', 'list_', 'get_')))
+        call.__name__ = name
+        return call
+
+
+class GuardedPaginator(object):
+    """Paginator whose page requests go through _GUARD. Pages are not hedged.
+
+    A page that misses its deadline or finds the region's budget spent
+    raises like any other call, so a listing is never silently cut short;
+    see all_pages for collectors that skip such a region instead.
+    """
+
+    def __init__(self, paginator, service, operation, region):
+        self._paginator = paginator
+        self._service = service
+        self._operation = operation
+        self._region = region
+
+    def paginate(self, **kwargs):
+        pages = iter(self._paginator.paginate(**kwargs))
+        while True:
+            try:
+                page = _GUARD.run(self._service, self._operation, self._region, lambda: next(pages))
+            except StopIteration:
+                return
+            yield page
+
+
+def all_pages(paginator, **kwargs):
+    """All pages of a listing, or None when the region ran out of time.
+
+    For per-region collectors: a region whose listing missed its deadline or
+    budget is already recorded as incomplete, and is left out of the
+    collected item rather than evaluated on a partial listing.
+
+    Returns:
+        list: Pages, None when the listing could not complete
+    """
+    try:
+        return list(paginator.paginate(**kwargs))
+    except Exception as e:
+        if error_code(e) in ('DeadlineExceeded', 'RegionTimeBudgetExceeded'):
+            return None
+        raise
+
+
+class CallGuard(object):
+    """Per-region time budgets and hedging for AWS calls.
+
+    Calls run on the calling thread with a deadline: CALL_DEADLINE (per
+    operation in OPERATION_DEADLINES), capped at what is left of the
+    region's budget. Through botocore's before-send event, no attempt starts
+    after the deadline and each attempt's read timeout ends at the deadline;
+    a call that runs out of time raises a 'DeadlineExceeded' ClientError. A region is charged the wall-clock time
+    during which at least one of its calls is in flight, so concurrent calls
+    are not counted twice; once REGION_TIME_BUDGET is spent, further calls to
+    the region raise 'RegionTimeBudgetExceeded' without a request. Regions affected by
+    either are recorded as incomplete. With HEDGE_ENABLED, a call slower than
+    HEDGE_PERCENTILE of its operation's recent latencies gets a second,
+    identical request; both then run on a shared pool of MAX_WORKERS * 2
+    threads.
+    """
+
+    # botocore exceptions raised once a call's attempts have all timed out
+    TIMEOUT_ERRORS = ('ConnectTimeoutError', 'ReadTimeoutError')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Forget the time spent and the incomplete regions, at the start of a run."""
+        import collections
+        with self.lock:
+            self.spent = collections.Counter()
+            self.active = collections.Counter()
+            self.busySince = {}
+            self.incomplete = []
+            self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=200))
+            self.hedged = 0
+
+    def mark(self):
+        """Position in the incomplete regions, to attribute later ones to a control."""
+        with self.lock:
+            return len(self.incomplete)
+
+    def incomplete_since(self, mark):
+        """Distinct regions that became incomplete after mark."""
+        with self.lock:
+            return sorted(set(self.incomplete[mark:]))
+
+    def attach(self, client):
+        events = getattr(client.meta, 'events', None)
+        if events is not None:
+            events.register('before-send', self.before_send)
+
+    def before_send(self, request=None, **kwargs):
+        call = getattr(self.local, 'call', None)
+        if call is None:
+            return None
+        operation, region, deadline, readTimeout = call
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise self.fail('DeadlineExceeded', operation, region,
+                            "{0} ran out of time for another attempt".format(operation))
+        context = getattr(request, 'context', None)
+        if context is not None:
+            # Per-request read timeout, honoured by botocore releases that support it
+            context['read_timeout'] = min(readTimeout, remaining)
+        return None
+
+    def used(self, region):
+        """Seconds of wall-clock time the region has had calls in flight."""
+        with self.lock:
+            used = self.spent[region]
+            if self.active[region]:
+                used += time.time() - self.busySince[region]
+            return used
+
+    def begin(self, region):
+        with self.lock:
+            if not self.active[region]:
+                self.busySince[region] = time.time()
+            self.active[region] += 1
+
+    def end(self, region):
+        with self.lock:
+            self.active[region] -= 1
+            if not self.active[region]:
+                self.spent[region] += time.time() - self.busySince.pop(region)
+
+    def threshold(self, service, operation):
+        with self.lock:
+            samples = sorted(self.latencies[(service, operation)])
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100.0))]
+
+    def fail(self, code, operation, region, message):
+        from botocore.exceptions import ClientError
+        if region is not None:
+            with self.lock:
+                self.incomplete.append(region)
+        return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+    def run(self, service, operation, region, call, hedge=False):
+        """Make call under the budget of its region, hedged when it is slow.
+
+        Returns:
+            TYPE: The call's result, exceptions are raised to the caller
+        """
+        if region is not None and REGION_TIME_BUDGET is not None and self.used(region) >= REGION_TIME_BUDGET:
+            raise self.fail('RegionTimeBudgetExceeded', operation, region,
+                            "Skipped, {0} used its time budget".format(region))
+        threshold = self.threshold(service, operation) if hedge and HEDGE_ENABLED else None
+        start = time.time()
+        name = service + '.' + operation
+        limit = OPERATION_DEADLINES.get(name, CALL_DEADLINE)
+        if region is not None and REGION_TIME_BUDGET is not None:
+            limit = min(limit, REGION_TIME_BUDGET - self.used(region))
+        bounds = (operation, region, start + limit, OPERATION_DEADLINES.get(name, READ_TIMEOUT))
+
+        def bounded():
+            # The deadline is per thread, hedged requests run on the shared pool
+            self.local.call = bounds
+            try:
+                return call()
+            finally:
+                self.local.call = None
+        if region is not None:
+            self.begin(region)
+        try:
+            result = bounded() if threshold is None else self.race(bounded, threshold)
+        except Exception as e:
+            if type(e).__name__ not in self.TIMEOUT_ERRORS:
+                raise
+            raise self.fail('DeadlineExceeded', operation, region,
+                            "{0}.{1} timed out: {2}".format(service, operation, e))
+        finally:
+            if region is not None:
+                self.end(region)
+        with self.lock:
+            self.latencies[(service, operation)].append(time.time() - start)
+        return result
+
+    def race(self, call, threshold):
+        """Run call, and a hedge once it took threshold seconds, on the shared pool.
+
+        Returns:
+            TYPE: The first successful result, otherwise the first error is raised
+        """
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=MAX_WORKERS * 2)
+        pending = [self.executor.submit(call)]
+        done, _ = wait(pending, timeout=threshold)
+        if not done:
+            with self.lock:
+                self.hedged += 1
+            pending.append(self.executor.submit(call))
+        error = None
+        while pending:
+            done, notDone = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = error or future.exception()
+            pending = list(notDone)
+        raise error
+
+
+_GUARD = CallGuard()
+
+
+def run_concurrently(function, items, workers=None):
+    """Call function for every item on a thread pool.
+
+    Suited to independent AWS calls, which spend their time waiting on the
+    network. Exceptions are raised to the caller.
+
+    Args:
+        function (TYPE): Called with one item at a time
+        items (list): Items to process
+        workers (int): Thread pool size, MAX_WORKERS by default
+
+    Returns:
+        list: Results in the order of items
+    """
+    items = list(items)
+    workers = min(workers or MAX_WORKERS, len(items))
+    if workers <= 1:
+        return [function(item) for item in items]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, items))
+
+
+def error_code(e):
+    """AWS error code of a botocore ClientError, otherwise the exception text.
+
+    Args:
+        e (Exception): Exception raised by a boto3 call
+
+    Returns:
+        str: Error code
+    """
+    try:
+        return e.response['Error']['Code']
+    except (AttributeError, KeyError, TypeError):
+        return str(e)
+
 
 # --- 1 Identity and Access Management ---
 
@@ -582,7 +1240,7 @@ def control_1_13_root_mfa_enabled():
     control = "1.13"
     description = "Ensure MFA is enabled for the root account"
     scored = True
-    response = IAM_CLIENT.get_account_summary()
+    response = aws_client('iam').get_account_summary()
     if response['SummaryMap']['AccountMFAEnabled'] != 1:
         result = False
         failReason = "Root account not using MFA"
@@ -604,9 +1262,9 @@ def control_1_14_root_hardware_mfa_enabled():
     description = "Ensure hardware MFA is enabled for the root account"
     scored = True
     # First verify that root is using MFA (avoiding false positive)
-    response = IAM_CLIENT.get_account_summary()
+    response = aws_client('iam').get_account_summary()
     if response['SummaryMap']['AccountMFAEnabled'] == 1:
-        paginator = IAM_CLIENT.get_paginator('list_virtual_mfa_devices')
+        paginator = aws_client('iam').get_paginator('list_virtual_mfa_devices')
         response_iterator = paginator.paginate(AssignmentStatus='Any',
         )
         pagedResult = []
@@ -641,9 +1299,12 @@ def control_1_15_security_questions_registered():
 
 
 # 1.16 Ensure IAM policies are attached only to groups or roles (Scored)
-def control_1_16_no_policies_on_iam_users():
+def control_1_16_no_policies_on_iam_users(iamdetails):
     """Summary
 
+    Args:
+        iamdetails (dict): Users and policies from get_iam_authorization_details
+
     Returns:
         TYPE: Description
     """
@@ -654,19 +1315,9 @@ def control_1_16_no_policies_on_iam_users():
     control = "1.16"
     description = "Ensure IAM policies are attached only to groups or roles"
     scored = True
-    paginator = IAM_CLIENT.get_paginator('list_users')
-    response_iterator = paginator.paginate()
-    pagedResult = []
-    for page in response_iterator:
-        for n in page['Users']:
-            pagedResult.append(n)
-    offenders = []
-    offenders_links = []
-    for n in pagedResult:
-        policies = IAM_CLIENT.list_user_policies(UserName=n['UserName'],
-            MaxItems=1
-        )
-        if policies['PolicyNames'] != []:
+    # Inline policies are returned with each user, no per-user lookup needed
+    for n in iamdetails['Users']:
+        if n.get('UserPolicyList'):
             result = False
             failReason = "IAM user have inline policy attached"
             offenders.append(str(n['Arn']))
@@ -760,7 +1411,7 @@ def control_1_21_ensure_iam_instance_roles_used():
     description = "Ensure IAM instance roles are used for AWS resource access from instances, application code is not audited"
     scored = True
     failReason = "Instance not assigned IAM role for EC2"
-    client = boto3.client('ec2')
+    client = aws_client('ec2')
     response = client.describe_instances()
     offenders = []
     offenders_links = []
@@ -793,7 +1444,7 @@ def control_1_22_ensure_incident_management_roles():
     offenders = []
     offenders_links = []
     try:
-        response = IAM_CLIENT.list_entities_for_policy(PolicyArn='arn:aws:iam::aws:policy/AWSSupportAccess'
+        response = aws_client('iam').list_entities_for_policy(PolicyArn='arn:aws:iam::aws:policy/AWSSupportAccess'
         )
         if (len(response['PolicyGroups']) + len(response['PolicyUsers']) + len(response['PolicyRoles'])) == 0:
             result = False
@@ -808,6 +1459,9 @@ def control_1_22_ensure_incident_management_roles():
 def control_1_23_no_active_initial_access_keys_with_iam_user(credreport):
     """Summary
 
+    Args:
+        credreport (TYPE): Description
+
     Returns:
         TYPE: Description
     """
@@ -818,25 +1472,27 @@ def control_1_23_no_active_initial_access_keys_with_iam_user(credreport):
     control = "1.23"
     description = "Do not setup access keys during initial user setup for all IAM users that have a console password"
     scored = False
-    offenders = []
-    offenders_links = []
+    # The credential report holds each key's creation time (last_rotated), so no per-user lookup is needed
     for n, _ in enumerate(credreport):
-        if (credreport[n]['access_key_1_active'] or credreport[n]['access_key_2_active'] == 'true') and n > 0:
-            response = IAM_CLIENT.list_access_keys(UserName=str(credreport[n]['user'])
-            )
-            for m in response['AccessKeyMetadata']:
-                if re.sub(r"\s", "T", str(m['CreateDate'])) == credreport[n]['user_creation_time']:
-                    result = False
-                    failReason = "Users with keys created at user creation time found"
-                    offenders.append(str(credreport[n]['arn']) + ":" + str(m['AccessKeyId']))
-                    offenders_links.append('https://console.aws.amazon.com/iam/home#/users/{user}?section=security_credentials'.format(user=credreport[n]['user']))
+        if n == 0:
+            continue  # Root account
+        for key in ('1', '2'):
+            if credreport[n]['access_key_' + key + '_active'] == 'true' and \
+                    credreport[n]['access_key_' + key + '_last_rotated'] == credreport[n]['user_creation_time']:
+                result = False
+                failReason = "Users with keys created at user creation time found"
+                offenders.append(str(credreport[n]['arn']) + ":key" + key)
+                offenders_links.append('https://console.aws.amazon.com/iam/home#/users/{user}?section=security_credentials'.format(user=credreport[n]['user']))
     return {'Result': result, 'failReason': failReason, 'Offenders': offenders, 'OffendersLinks': offenders_links, 'ScoredControl': scored, 'Description': description, 'ControlId': control}
 
 
 # 1.24  Ensure IAM policies that allow full "*:*" administrative privileges are not created (Scored)
-def control_1_24_no_overly_permissive_policies():
+def control_1_24_no_overly_permissive_policies(iamdetails):
     """Summary
 
+    Args:
+        iamdetails (dict): Users and policies from get_iam_authorization_details
+
     Returns:
         TYPE: Description
     """
@@ -847,28 +1503,20 @@ def control_1_24_no_overly_permissive_policies():
     control = "1.24"
     description = "Ensure IAM policies that allow full administrative privileges are not created"
     scored = True
-    offenders = []
-    offenders_links = []
-    paginator = IAM_CLIENT.get_paginator('list_policies')
-    response_iterator = paginator.paginate(Scope='Local',
-        OnlyAttached=False,
-    )
-    pagedResult = []
-    for page in response_iterator:
-        for n in page['Policies']:
-            pagedResult.append(n)
-    for m in pagedResult:
-        policy = IAM_CLIENT.get_policy_version(PolicyArn=m['Arn'],
-            VersionId=m['DefaultVersionId']
-        )
+    for m in iamdetails['Policies']:
+        # Every version document is returned with the policy, pick the default one
+        document = {}
+        for version in m.get('PolicyVersionList', []):
+            if version['IsDefaultVersion']:
+                document = version['Document']
 
         statements = []
         # a policy may contain a single statement, a single statement in an array, or multiple statements in an array
-        if isinstance(policy['PolicyVersion']['Document']['Statement'], list):
-            for statement in policy['PolicyVersion']['Document']['Statement']:
+        if isinstance(document.get('Statement', []), list):
+            for statement in document.get('Statement', []):
                 statements.append(statement)
         else:
-            statements.append(policy['PolicyVersion']['Document']['Statement'])
+            statements.append(document['Statement'])
 
         for n in statements:
             # a policy statement has to contain either an Action or a NotAction
@@ -900,13 +1548,10 @@ def control_2_1_ensure_cloud_trail_all_regions(cloudtrails):
     control = "2.1"
     description = "Ensure CloudTrail is enabled in all regions"
     scored = True
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             if o['IsMultiRegionTrail']:
-                client = boto3.client('cloudtrail', region_name=m)
-                response = client.get_trail_status(Name=o['TrailARN']
-                )
-                if response['IsLogging'] is True:
+                if o['TrailStatus'].get('IsLogging') is True:
                     result = True
                     break
     if result is False:
@@ -933,7 +1578,7 @@ def control_2_2_ensure_cloudtrail_validation(cloudtrails):
     control = "2.2"
     description = "Ensure CloudTrail log file validation is enabled"
     scored = True
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             # The console uses an @ as part of the ARN.
             cloudtrail_arn_ui = o['TrailARN'].replace('/' + o['Name'], '@' + o['Name'])
@@ -952,11 +1597,12 @@ def control_2_2_ensure_cloudtrail_validation(cloudtrails):
 
 
 # 2.3 Ensure the S3 bucket CloudTrail logs to is not publicly accessible (Scored)
-def control_2_3_ensure_cloudtrail_bucket_not_public(cloudtrails):
+def control_2_3_ensure_cloudtrail_bucket_not_public(cloudtrails, trail_buckets):
     """Summary
 
     Args:
         cloudtrails (TYPE): Description
+        trail_buckets (dict): Output of get_trail_buckets
 
     Returns:
         TYPE: Description
@@ -968,31 +1614,32 @@ def control_2_3_ensure_cloudtrail_bucket_not_public(cloudtrails):
     control = "2.3"
     description = "Ensure the S3 bucket CloudTrail logs to is not publicly accessible"
     scored = True
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             # The console uses an @ as part of the ARN.
             cloudtrail_arn_ui = o['TrailARN'].replace('/' + o['Name'], '@' + o['Name'])
 
             #  We only want to check cases where there is a bucket
-            if "S3BucketName" in str(o):
-                try:
-                    response = S3_CLIENT.get_bucket_acl(Bucket=o['S3BucketName'])
-                    for p in response['Grants']:
-                        # print("Grantee is " + str(p['Grantee']))
-                        if re.search(r'(global/AllUsers|global/AuthenticatedUsers)', str(p['Grantee'])):
-                            result = False
-                            offenders.append(str(o['TrailARN']) + ":PublicBucket")
-                            offenders_links.append('https://s3.console.aws.amazon.com/s3/buckets/{bucket_name}/?tab=permissions'.format(bucket_name=o['S3BucketName']))
-                            if "Publically" not in failReason:
-                                failReason = failReason + "Publically accessible CloudTrail bucket discovered."
-                except Exception as e:
+            if o.get('S3BucketName'):
+                bucket = trail_buckets[o['S3BucketName']]
+                # The ACL, the policy status and the public access block all decide whether the bucket is public
+                error = ", ".join(bucket['Errors'][check] for check in ('Acl', 'Policy', 'PublicAccessBlock')
+                                  if check in bucket['Errors']) or None
+                if error is None:
+                    if bucket['Public']:
+                        result = False
+                        offenders.append(str(o['TrailARN']) + ":PublicBucket")
+                        offenders_links.append('https://s3.console.aws.amazon.com/s3/buckets/{bucket_name}/?tab=permissions'.format(bucket_name=o['S3BucketName']))
+                        if "Publically" not in failReason:
+                            failReason = failReason + "Publically accessible CloudTrail bucket discovered."
+                else:
                     result = False
-                    if "AccessDenied" in str(e):
+                    if "AccessDenied" in error:
                         offenders.append(str(o['TrailARN']) + ":AccessDenied")
                         offenders_links.append('https://s3.console.aws.amazon.com/s3/buckets/{bucket_name}/?tab=permissions'.format(bucket_name=o['S3BucketName']))
                         if "Missing" not in failReason:
-                            failReason = "Missing permissions to verify bucket ACL. " + failReason
-                    elif "NoSuchBucket" in str(e):
+                            failReason = "Missing permissions to verify bucket ACL and policy. " + failReason
+                    elif "NoSuchBucket" in error:
                         offenders.append(str(o['TrailARN']) + ":NoBucket")
                         offenders_links.append('https://console.aws.amazon.com/cloudtrail/home?region={region}#/configuration/{arn}'.format(
                             region=o['TrailARN'].split(':')[3],
@@ -1008,7 +1655,7 @@ def control_2_3_ensure_cloudtrail_bucket_not_public(cloudtrails):
                             arn=cloudtrail_arn_ui
                         ))
                         if "Cannot" not in failReason:
-                            failReason = "Cannot verify bucket ACL. " + failReason
+                            failReason = "Cannot verify bucket ACL and policy. " + failReason
             else:
                 result = False
                 offenders.append(str(o['TrailARN']) + "NoS3Logging")
@@ -1037,7 +1684,7 @@ def control_2_4_ensure_cloudtrail_cloudwatch_logs_integration(cloudtrails):
     control = "2.4"
     description = "Ensure CloudTrail trails are integrated with CloudWatch Logs"
     scored = True
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 # The console uses an @ as part of the ARN.
@@ -1065,7 +1712,7 @@ def control_2_4_ensure_cloudtrail_cloudwatch_logs_integration(cloudtrails):
 
 
 # 2.5 Ensure AWS Config is enabled in all regions (Scored)
-def control_2_5_ensure_config_all_regions(regions):
+def control_2_5_ensure_config_all_regions(regions, config_posture):
     """Summary
 
     Returns:
@@ -1080,59 +1727,32 @@ def control_2_5_ensure_config_all_regions(regions):
     scored = True
     globalConfigCapture = False  # Only one region needs to capture global events
     for n in regions:
-        configClient = boto3.client('config', region_name=n)
-        response = configClient.describe_configuration_recorder_status()
+        if n not in config_posture:
+            continue  # AWS Config is not offered in this region
+        posture = config_posture[n]
+        failed = []
+        if posture['Errors']:
+            failed.append("Unavailable")
         # Get recording status
-        try:
-            if not response['ConfigurationRecordersStatus'][0]['recording'] is True:
-                result = False
-                failReason = "Config not enabled in all regions, not capturing all/global events or delivery channel errors"
-                offenders.append(str(n) + ":NotRecording")
-                offenders_links.append('https://console.aws.amazon.com/config/home?region={region}#/configure'.format(region=n))
-        except:
+        if not posture['Recorders'] or any(o['Recording'] is not True for o in posture['Recorders']):
+            failed.append("NotRecording")
+        # Verify that each recorder is capturing all events
+        if any(o['AllSupported'] is not True for o in posture['Recorders']):
+            failed.append("NotAllEvents")
+        # Check if region is capturing global events. Fail is verified later since only one region needs to capture them.
+        if any(o['IncludeGlobalResourceTypes'] is True for o in posture['Recorders']):
+            globalConfigCapture = True
+        # Verify the delivery channels, missing statuses are captured by the recording check
+        if any(o['HistoryStatus'] not in (None, "SUCCESS") for o in posture['Channels']):
+            failed.append("S3orSNSDelivery")
+        if any(o['StreamStatus'] not in (None, "SUCCESS") for o in posture['Channels']):
+            failed.append("SNSDelivery")
+        for reason in failed:
             result = False
             failReason = "Config not enabled in all regions, not capturing all/global events or delivery channel errors"
-            offenders.append(str(n) + ":NotRecording")
+            offenders.append(str(n) + ":" + reason)
             offenders_links.append('https://console.aws.amazon.com/config/home?region={region}#/configure'.format(region=n))
 
-        # Verify that each region is capturing all events
-        response = configClient.describe_configuration_recorders()
-        try:
-            if not response['ConfigurationRecorders'][0]['recordingGroup']['allSupported'] is True:
-                result = False
-                failReason = "Config not enabled in all regions, not capturing all/global events or delivery channel errors"
-                offenders.append(str(n) + ":NotAllEvents")
-                offenders_links.append('https://console.aws.amazon.com/config/home?region={region}#/configure'.format(region=n))
-        except:
-            # This indicates that Config is disabled in the region and will be captured above.
-            pass
-
-        # Check if region is capturing global events. Fail is verified later since only one region needs to capture them.
-        try:
-            if response['ConfigurationRecorders'][0]['recordingGroup']['includeGlobalResourceTypes'] is True:
-                globalConfigCapture = True
-        except:
-            pass
-
-        # Verify the delivery channels
-        response = configClient.describe_delivery_channel_status()
-        try:
-            if response['DeliveryChannelsStatus'][0]['configHistoryDeliveryInfo']['lastStatus'] != "SUCCESS":
-                result = False
-                failReason = "Config not enabled in all regions, not capturing all/global events or delivery channel errors"
-                offenders.append(str(n) + ":S3orSNSDelivery")
-                offenders_links.append('https://console.aws.amazon.com/config/home?region={region}#/configure'.format(region=n))
-        except:
-            pass  # Will be captured by earlier rule
-        try:
-            if response['DeliveryChannelsStatus'][0]['configStreamDeliveryInfo']['lastStatus'] != "SUCCESS":
-                result = False
-                failReason = "Config not enabled in all regions, not capturing all/global events or delivery channel errors"
-                offenders.append(str(n) + ":SNSDelivery")
-                offenders_links.append('https://console.aws.amazon.com/config/home?region={region}#/configure'.format(region=n))
-        except:
-            pass  # Will be captured by earlier rule
-
     # Verify that global events is captured by any region
     if globalConfigCapture is False:
         result = False
@@ -1143,11 +1763,12 @@ def control_2_5_ensure_config_all_regions(regions):
 
 
 # 2.6 Ensure S3 bucket access logging is enabled on the CloudTrail S3 bucket (Scored)
-def control_2_6_ensure_cloudtrail_bucket_logging(cloudtrails):
+def control_2_6_ensure_cloudtrail_bucket_logging(cloudtrails, trail_buckets):
     """Summary
 
     Args:
         cloudtrails (TYPE): Description
+        trail_buckets (dict): Output of get_trail_buckets
 
     Returns:
         TYPE: Description
@@ -1159,15 +1780,14 @@ def control_2_6_ensure_cloudtrail_bucket_logging(cloudtrails):
     control = "2.6"
     description = "Ensure S3 bucket access logging is enabled on the CloudTrail S3 bucket"
     scored = True
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             # The console uses an @ as part of the ARN.
             cloudtrail_arn_ui = o['TrailARN'].replace('/' + o['Name'], '@' + o['Name'])
 
             # it is possible to have a cloudtrail configured with a nonexistant bucket
-            try:
-                response = S3_CLIENT.get_bucket_logging(Bucket=o['S3BucketName'])
-            except:
+            bucket = trail_buckets.get(o.get('S3BucketName'))
+            if bucket is None or 'Logging' in bucket['Errors']:
                 result = False
                 failReason = "Cloudtrail not configured to log to S3. "
                 offenders.append(str(o['TrailARN']))
@@ -1175,10 +1795,7 @@ def control_2_6_ensure_cloudtrail_bucket_logging(cloudtrails):
                     region=o['TrailARN'].split(':')[3],
                     arn=cloudtrail_arn_ui
                 ))
-            try:
-                if response['LoggingEnabled']:
-                    pass
-            except:
+            elif not bucket['Logging']:
                 result = False
                 failReason = failReason + "CloudTrail S3 bucket without logging discovered"
                 offenders.append("Trail:" + str(o['TrailARN']))
@@ -1203,7 +1820,7 @@ def control_2_7_ensure_cloudtrail_encryption_kms(cloudtrails):
     control = "2.7"
     description = "Ensure CloudTrail logs are encrypted at rest using KMS CMKs"
     scored = True
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             # The console uses an @ as part of the ARN.
             cloudtrail_arn_ui = o['TrailARN'].replace('/' + o['Name'], '@' + o['Name'])
@@ -1236,24 +1853,37 @@ def control_2_8_ensure_kms_cmk_rotation(regions):
     control = "2.8"
     description = "Ensure rotation for customer created CMKs is enabled"
     scored = True
-    for n in regions:
-        kms_client = boto3.client('kms', region_name=n)
-        paginator = kms_client.get_paginator('list_keys')
-        response_iterator = paginator.paginate()
-        for page in response_iterator:
-            for n in page['Keys']:
-                try:
-                    rotationStatus = kms_client.get_key_rotation_status(KeyId=n['KeyId'])
-                    if rotationStatus['KeyRotationEnabled'] is False:
-                        keyDescription = kms_client.describe_key(KeyId=n['KeyId'])
-                        # Ignore service keys
-                        if "Default master key that protects my" not in str(keyDescription['KeyMetadata']['Description']):
-                            result = False
-                            failReason = "KMS CMK rotation not enabled"
-                            offenders.append("Key:" + str(keyDescription['KeyMetadata']['Arn']))
-                            offenders_links.append('https://console.aws.amazon.com/iam/home#/encryptionKeys/{key_arn}'.format(key_arn=n['Arn']))
-                except:
-                    pass  # Ignore keys without permission, for example ACM key
+    # AWS managed keys, which AWS rotates itself, are the targets of the alias/aws/ aliases
+    def customer_keys(region):
+        kms_client = aws_client('kms', region)
+        aliases = all_pages(kms_client.get_paginator('list_aliases'))
+        listed = all_pages(kms_client.get_paginator('list_keys')) if aliases is not None else None
+        if listed is None:
+            return []
+        managed = set()
+        for page in aliases:
+            for alias in page['Aliases']:
+                if alias['AliasName'].startswith('alias/aws/') and 'TargetKeyId' in alias:
+                    managed.add(alias['TargetKeyId'])
+        keys = []
+        for page in listed:
+            keys.extend((region, k) for k in page['Keys'] if k['KeyId'] not in managed)
+        return keys
+
+    def rotation_enabled(item):
+        region, key = item
+        try:
+            return aws_client('kms', region).get_key_rotation_status(KeyId=key['KeyId'])['KeyRotationEnabled']
+        except:
+            return None  # Ignore keys without permission, for example ACM key
+
+    keys = [k for keys in run_concurrently(customer_keys, service_regions('kms', regions)) for k in keys]
+    for (region, key), enabled in zip(keys, run_concurrently(rotation_enabled, keys)):
+        if enabled is False:
+            result = False
+            failReason = "KMS CMK rotation not enabled"
+            offenders.append("Key:" + str(key['KeyArn']))
+            offenders_links.append('https://console.aws.amazon.com/iam/home#/encryptionKeys/{key_arn}'.format(key_arn=key['KeyArn']))
     return {'Result': result, 'failReason': failReason, 'Offenders': offenders, 'OffendersLinks': offenders_links, 'ScoredControl': scored, 'Description': description, 'ControlId': control}
 
 
@@ -1274,21 +1904,18 @@ def control_3_1_ensure_log_metric_filter_unauthorized_api_calls(cloudtrails):
     description = "Ensure log metric filter unauthorized api calls"
     scored = True
     failReason = "Incorrect log metric alerts for unauthorized_api_calls"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group)
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.errorCode\s*=\s*\"?\*UnauthorizedOperation(\"|\)|\s)", "\$\.errorCode\s*=\s*\"?AccessDenied\*(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1314,22 +1941,18 @@ def control_3_2_ensure_log_metric_filter_console_signin_no_mfa(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for Management Console sign-in without MFA"
     scored = True
     failReason = "Incorrect log metric alerts for management console signin without MFA"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group
-                    )
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventName\s*=\s*\"?ConsoleLogin(\"|\)|\s)", "\$\.additionalEventData\.MFAUsed\s*\!=\s*\"?Yes"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1355,22 +1978,18 @@ def control_3_3_ensure_log_metric_filter_root_usage(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for root usage"
     scored = True
     failReason = "Incorrect log metric alerts for root usage"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group
-                    )
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.userIdentity\.type\s*=\s*\"?Root", "\$\.userIdentity\.invokedBy\s*NOT\s*EXISTS","\$\.eventType\s*\!=\s*\"?AwsServiceEvent(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1396,22 +2015,18 @@ def control_3_4_ensure_log_metric_iam_policy_change(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for IAM changes"
     scored = True
     failReason = "Incorrect log metric alerts for IAM policy changes"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group
-                    )
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventName\s*=\s*\"?DeleteGroupPolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteRolePolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteUserPolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?PutGroupPolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?PutRolePolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?PutUserPolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?CreatePolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeletePolicy(\"|\)|\s)","\$\.eventName\s*=\s*\"?CreatePolicyVersion(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeletePolicyVersion(\"|\)|\s)", "\$\.eventName\s*=\s*\"?AttachRolePolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DetachRolePolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?AttachUserPolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DetachUserPolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?AttachGroupPolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DetachGroupPolicy(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1437,22 +2052,18 @@ def control_3_5_ensure_log_metric_cloudtrail_configuration_changes(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for CloudTrail configuration changes"
     scored = True
     failReason = "Incorrect log metric alerts for CloudTrail configuration changes"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group
-                    )
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventName\s*=\s*\"?CreateTrail(\"|\)|\s)", "\$\.eventName\s*=\s*\"?UpdateTrail(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteTrail(\"|\)|\s)","\$\.eventName\s*=\s*\"?StartLogging(\"|\)|\s)", "\$\.eventName\s*=\s*\"?StopLogging(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1478,22 +2089,18 @@ def control_3_6_ensure_log_metric_console_auth_failures(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for console auth failures"
     scored = True
     failReason = "Ensure a log metric filter and alarm exist for console auth failures"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group
-                    )
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventName\s*=\s*\"?ConsoleLogin(\"|\)|\s)", "\$\.errorMessage\s*=\s*\"?Failed authentication(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1519,21 +2126,18 @@ def control_3_7_ensure_log_metric_disabling_scheduled_delete_of_kms_cmk(cloudtra
     description = "Ensure a log metric filter and alarm exist for disabling or scheduling deletion of KMS CMK"
     scored = True
     failReason = "Ensure a log metric filter and alarm exist for disabling or scheduling deletion of KMS CMK"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group)
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventSource\s*=\s*\"?kms\.amazonaws\.com(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DisableKey(\"|\)|\s)", "\$\.eventName\s*=\s*\"?ScheduleKeyDeletion(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1559,22 +2163,18 @@ def control_3_8_ensure_log_metric_s3_bucket_policy_changes(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for S3 bucket policy changes"
     scored = True
     failReason = "Ensure a log metric filter and alarm exist for S3 bucket policy changes"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group
-                    )
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventSource\s*=\s*\"?s3\.amazonaws\.com(\"|\)|\s)", "\$\.eventName\s*=\s*\"?PutBucketAcl(\"|\)|\s)", "\$\.eventName\s*=\s*\"?PutBucketPolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?PutBucketCors(\"|\)|\s)", "\$\.eventName\s*=\s*\"?PutBucketLifecycle(\"|\)|\s)","\$\.eventName\s*=\s*\"?PutBucketReplication(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteBucketPolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteBucketCors(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteBucketLifecycle(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteBucketReplication(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1600,21 +2200,18 @@ def control_3_9_ensure_log_metric_config_configuration_changes(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for for AWS Config configuration changes"
     scored = True
     failReason = "Ensure a log metric filter and alarm exist for for AWS Config configuration changes"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group)
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventSource\s*=\s*\"?config\.amazonaws\.com(\"|\)|\s)", "\$\.eventName\s*=\s*\"?StopConfigurationRecorder(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteDeliveryChannel(\"|\)|\s)","\$\.eventName\s*=\s*\"?PutDeliveryChannel(\"|\)|\s)", "\$\.eventName\s*=\s*\"?PutConfigurationRecorder(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1640,22 +2237,18 @@ def control_3_10_ensure_log_metric_security_group_changes(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for security group changes"
     scored = True
     failReason = "Ensure a log metric filter and alarm exist for security group changes"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group
-                    )
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventName\s*=\s*\"?AuthorizeSecurityGroupIngress(\"|\)|\s)", "\$\.eventName\s*=\s*\"?AuthorizeSecurityGroupEgress(\"|\)|\s)", "\$\.eventName\s*=\s*\"?RevokeSecurityGroupIngress(\"|\)|\s)","\$\.eventName\s*=\s*\"?RevokeSecurityGroupEgress(\"|\)|\s)", "\$\.eventName\s*=\s*\"?CreateSecurityGroup(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteSecurityGroup(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1681,21 +2274,18 @@ def control_3_11_ensure_log_metric_nacl(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for changes to Network Access Control Lists (NACL)"
     scored = True
     failReason = "Ensure a log metric filter and alarm exist for changes to Network Access Control Lists (NACL)"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group)
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventName\s*=\s*\"?CreateNetworkAcl(\"|\)|\s)", "\$\.eventName\s*=\s*\"?CreateNetworkAclEntry(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteNetworkAcl(\"|\)|\s)","\$\.eventName\s*=\s*\"?DeleteNetworkAclEntry(\"|\)|\s)", "\$\.eventName\s*=\s*\"?ReplaceNetworkAclEntry(\"|\)|\s)", "\$\.eventName\s*=\s*\"?ReplaceNetworkAclAssociation(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1721,21 +2311,18 @@ def control_3_12_ensure_log_metric_changes_to_network_gateways(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for changes to network gateways"
     scored = True
     failReason = "Ensure a log metric filter and alarm exist for changes to network gateways"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group)
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventName\s*=\s*\"?CreateCustomerGateway(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteCustomerGateway(\"|\)|\s)", "\$\.eventName\s*=\s*\"?AttachInternetGateway(\"|\)|\s)","\$\.eventName\s*=\s*\"?CreateInternetGateway(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteInternetGateway(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DetachInternetGateway(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1761,21 +2348,18 @@ def control_3_13_ensure_log_metric_changes_to_route_tables(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for route table changes"
     scored = True
     failReason = "Ensure a log metric filter and alarm exist for route table changes"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group)
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventName\s*=\s*\"?CreateRoute(\"|\)|\s)", "\$\.eventName\s*=\s*\"?CreateRouteTable(\"|\)|\s)", "\$\.eventName\s*=\s*\"?ReplaceRoute(\"|\)|\s)", "\$\.eventName\s*=\s*\"?ReplaceRouteTableAssociation(\"|\)|\s)","\$\.eventName\s*=\s*\"?DeleteRouteTable(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteRoute(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DisassociateRouteTable(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1801,21 +2385,18 @@ def control_3_14_ensure_log_metric_changes_to_vpc(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for VPC changes"
     scored = True
     failReason = "Ensure a log metric filter and alarm exist for VPC changes"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group)
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventName\s*=\s*\"?CreateVpc(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteVpc(\"|\)|\s)", "\$\.eventName\s*=\s*\"?ModifyVpcAttribute(\"|\)|\s)", "\$\.eventName\s*=\s*\"?AcceptVpcPeeringConnection(\"|\)|\s)", "\$\.eventName\s*=\s*\"?CreateVpcPeeringConnection(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteVpcPeeringConnection(\"|\)|\s)","\$\.eventName\s*=\s*\"?RejectVpcPeeringConnection(\"|\)|\s)", "\$\.eventName\s*=\s*\"?AttachClassicLinkVpc(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DetachClassicLinkVpc(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DisableVpcClassicLink(\"|\)|\s)", "\$\.eventName\s*=\s*\"?EnableVpcClassicLink(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1858,21 +2439,18 @@ def control_3_16_ensure_log_metric_changes_to_organizations(cloudtrails):
     description = "Ensure a log metric filter and alarm exist for Organizations changes"
     scored = True
     failReason = "A log metric filter and alarm do not exist for Organizations changes"
-    for m, n in cloudtrails.iteritems():
+    for m, n in cloudtrails.items():
         for o in n:
             try:
                 if o['CloudWatchLogsLogGroupArn']:
-                    group = re.search('log-group:(.+?):', o['CloudWatchLogsLogGroupArn']).group(1)
-                    client = boto3.client('logs', region_name=m)
-                    filters = client.describe_metric_filters(logGroupName=group)
-                    for p in filters['metricFilters']:
+                    for p in o['MetricFilters']:
                         patterns = ["\$\.eventName\s*=\s*\"?CreateAccount(\"|\)|\s)", "\$\.eventName\s*=\s*\"?CreatePolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?CreateOrganizationalUnit(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteOrganization(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeleteOrganizationalUnit(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DeletePolicy(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DetachPolicy(\"|\)|\s)","\$\.eventName\s*=\s*\"?DisableAWSServiceAccess(\"|\)|\s)", "\$\.eventName\s*=\s*\"?DisablePolicyType(\"|\)|\s)", "\$\.eventName\s*=\s*\"?MoveAccount(\"|\)|\s)", "\$\.eventName\s*=\s*\"?RemoveAccountFromOrganization(\"|\)|\s)", "\$\.eventName\s*=\s*\"?UpdateOrganizationalUnit(\"|\)|\s)", "\$\.eventName\s*=\s*\"?UpdatePolicy(\"|\)|\s)"]
                         if find_in_string(patterns, str(p['filterPattern'])):
-                            cwclient = boto3.client('cloudwatch', region_name=m)
+                            cwclient = aws_client('cloudwatch', m)
                             response = cwclient.describe_alarms_for_metric(MetricName=p['metricTransformations'][0]['metricName'],
                                 Namespace=p['metricTransformations'][0]['metricNamespace']
                             )
-                            snsClient = boto3.client('sns', region_name=m)
+                            snsClient = aws_client('sns', m)
                             subscribers = snsClient.list_subscriptions_by_topic(TopicArn=response['MetricAlarms'][0]['AlarmActions'][0]
                                 #  Pagination not used since only 1 subscriber required
                             )
@@ -1887,7 +2465,7 @@ def control_3_16_ensure_log_metric_changes_to_organizations(cloudtrails):
 # --- Networking ---
 
 # 4.1 Ensure no security groups allow ingress from 0.0.0.0/0 to port 22 (Scored)
-def control_4_1_ensure_ssh_not_open_to_world(regions):
+def control_4_1_ensure_ssh_not_open_to_world(regions, port_exposure):
     """Summary
 
     Returns:
@@ -1898,37 +2476,22 @@ def control_4_1_ensure_ssh_not_open_to_world(regions):
     offenders = []
     offenders_links = []
     control = "4.1"
-    description = "Ensure no security groups allow ingress from 0.0.0.0/0 to port 22"
+    description = "Ensure no security groups allow ingress from 0.0.0.0/0 or ::/0 to port 22"
     scored = True
     for n in regions:
-        client = boto3.client('ec2', region_name=n)
-        response = client.describe_security_groups()
-        for m in response['SecurityGroups']:
-            if "0.0.0.0/0" in str(m['IpPermissions']):
-                for o in m['IpPermissions']:
-                    try:
-                        if int(o['FromPort']) <= 22 <= int(o['ToPort']) and '0.0.0.0/0' in str(o['IpRanges']):
-                            result = False
-                            failReason = "Found Security Group with port 22 open to the world (0.0.0.0/0)"
-                            offenders.append(str(m['GroupId']))
-                            offenders_links.append('https://console.aws.amazon.com/ec2/v2/home?region={region}#SecurityGroups:search={security_group}'.format(
-                                region=n,
-                                security_group=m['GroupId']
-                            ))
-                    except:
-                        if str(o['IpProtocol']) == "-1" and '0.0.0.0/0' in str(o['IpRanges']):
-                            result = False
-                            failReason = "Found Security Group with port 22 open to the world (0.0.0.0/0)"
-                            offenders.append(str(n) + " : " + str(m['GroupId']))
-                            offenders_links.append('https://console.aws.amazon.com/ec2/v2/home?region={region}#SecurityGroups:search={security_group}'.format(
-                                region=n,
-                                security_group=m['GroupId']
-                            ))
+        for m in port_exposure.get(n, {}).get("22", []):
+            result = False
+            failReason = "Found Security Group with port 22 open to the world (0.0.0.0/0 or ::/0)"
+            offenders.append(str(m))
+            offenders_links.append('https://console.aws.amazon.com/ec2/v2/home?region={region}#SecurityGroups:search={security_group}'.format(
+                region=n,
+                security_group=m
+            ))
     return {'Result': result, 'failReason': failReason, 'Offenders': offenders, 'OffendersLinks': offenders_links, 'ScoredControl': scored, 'Description': description, 'ControlId': control}
 
 
 # 4.2 Ensure no security groups allow ingress from 0.0.0.0/0 to port 3389 (Scored)
-def control_4_2_ensure_rdp_not_open_to_world(regions):
+def control_4_2_ensure_rdp_not_open_to_world(regions, port_exposure):
     """Summary
 
     Returns:
@@ -1939,37 +2502,22 @@ def control_4_2_ensure_rdp_not_open_to_world(regions):
     offenders = []
     offenders_links = []
     control = "4.2"
-    description = "Ensure no security groups allow ingress from 0.0.0.0/0 to port 3389"
+    description = "Ensure no security groups allow ingress from 0.0.0.0/0 or ::/0 to port 3389"
     scored = True
     for n in regions:
-        client = boto3.client('ec2', region_name=n)
-        response = client.describe_security_groups()
-        for m in response['SecurityGroups']:
-            if "0.0.0.0/0" in str(m['IpPermissions']):
-                for o in m['IpPermissions']:
-                    try:
-                        if int(o['FromPort']) <= 3389 <= int(o['ToPort']) and '0.0.0.0/0' in str(o['IpRanges']):
-                            result = False
-                            failReason = "Found Security Group with port 3389 open to the world (0.0.0.0/0)"
-                            offenders.append(str(m['GroupId']))
-                            offenders_links.append('https://console.aws.amazon.com/ec2/v2/home?region={region}#SecurityGroups:search={security_group}'.format(
-                                region=n,
-                                security_group=m['GroupId']
-                            ))
-                    except:
-                        if str(o['IpProtocol']) == "-1" and '0.0.0.0/0' in str(o['IpRanges']):
-                            result = False
-                            failReason = "Found Security Group with port 3389 open to the world (0.0.0.0/0)"
-                            offenders.append(str(n) + " : " + str(m['GroupId']))
-                            offenders_links.append('https://console.aws.amazon.com/ec2/v2/home?region={region}#SecurityGroups:search={security_group}'.format(
-                                region=n,
-                                security_group=m['GroupId']
-                            ))
+        for m in port_exposure.get(n, {}).get("3389", []):
+            result = False
+            failReason = "Found Security Group with port 3389 open to the world (0.0.0.0/0 or ::/0)"
+            offenders.append(str(m))
+            offenders_links.append('https://console.aws.amazon.com/ec2/v2/home?region={region}#SecurityGroups:search={security_group}'.format(
+                region=n,
+                security_group=m
+            ))
     return {'Result': result, 'failReason': failReason, 'Offenders': offenders, 'OffendersLinks': offenders_links, 'ScoredControl': scored, 'Description': description, 'ControlId': control}
 
 
 # 4.3 Ensure VPC flow logging is enabled in all VPCs (Scored)
-def control_4_3_ensure_flow_logs_enabled_on_all_vpc(regions):
+def control_4_3_ensure_flow_logs_enabled_on_all_vpc(regions, flow_log_coverage):
     """Summary
 
     Returns:
@@ -1983,36 +2531,25 @@ def control_4_3_ensure_flow_logs_enabled_on_all_vpc(regions):
     description = "Ensure VPC flow logging is enabled in all VPCs"
     scored = True
     for n in regions:
-        client = boto3.client('ec2', region_name=n)
-        flowlogs = client.describe_flow_logs(#  No paginator support in boto atm.
-        )
-        activeLogs = []
-        for m in flowlogs['FlowLogs']:
-            if "vpc-" in str(m['ResourceId']):
-                activeLogs.append(m['ResourceId'])
-        vpcs = client.describe_vpcs(Filters=[
-                {
-                    'Name': 'state',
-                    'Values': [
-                        'available',
-                    ]
-                },
-            ]
-        )
-        for m in vpcs['Vpcs']:
-            if not str(m['VpcId']) in str(activeLogs):
-                result = False
+        for vpcId, status in sorted(flow_log_coverage.get(n, {}).items()):
+            if status == "active":
+                continue
+            result = False
+            if status == "missing":
                 failReason = "VPC without active VPC Flow Logs found"
-                offenders.append(str(n) + " : " + str(m['VpcId']))
-                offenders_links.append('https://console.aws.amazon.com/vpc/home?region={region}#vpcs:filter={vpc}'.format(
-                    region=n,
-                    vpc=m['VpcId']
-                ))
+                offenders.append(str(n) + " : " + str(vpcId))
+            else:
+                failReason = "VPC without active VPC Flow Logs or with failing log delivery found"
+                offenders.append(str(n) + " : " + str(vpcId) + " : " + status)
+            offenders_links.append('https://console.aws.amazon.com/vpc/home?region={region}#vpcs:filter={vpc}'.format(
+                region=n,
+                vpc=vpcId
+            ))
     return {'Result': result, 'failReason': failReason, 'Offenders': offenders, 'OffendersLinks': offenders_links, 'ScoredControl': scored, 'Description': description, 'ControlId': control}
 
 
 # 4.4 Ensure the default security group of every VPC restricts all traffic (Scored)
-def control_4_4_ensure_default_security_groups_restricts_traffic(regions):
+def control_4_4_ensure_default_security_groups_restricts_traffic(regions, security_group_rules):
     """Summary
 
     Returns:
@@ -2026,18 +2563,8 @@ def control_4_4_ensure_default_security_groups_restricts_traffic(regions):
     description = "Ensure the default security group of every VPC restricts all traffic"
     scored = True
     for n in regions:
-        client = boto3.client('ec2', region_name=n)
-        response = client.describe_security_groups(Filters=[
-                {
-                    'Name': 'group-name',
-                    'Values': [
-                        'default',
-                    ]
-                },
-            ]
-        )
-        for m in response['SecurityGroups']:
-            if not (len(m['IpPermissions']) + len(m['IpPermissionsEgress'])) == 0:
+        for m in security_group_rules.get(n, {}).get('groups', []):
+            if m['GroupName'] == 'default' and not m['RuleCount'] == 0:
                 result = False
                 failReason = "Default security groups with ingress or egress rules discovered"
                 offenders.append(str(n) + " : " + str(m['GroupId']))
@@ -2049,7 +2576,7 @@ def control_4_4_ensure_default_security_groups_restricts_traffic(regions):
 
 
 # 4.5 Ensure routing tables for VPC peering are "least access" (Not Scored)
-def control_4_5_ensure_route_tables_are_least_access(regions):
+def control_4_5_ensure_route_tables_are_least_access(regions, route_analysis):
     """Summary
 
     Returns:
@@ -2063,26 +2590,19 @@ def control_4_5_ensure_route_tables_are_least_access(regions):
     description = "Ensure routing tables for VPC peering are least access"
     scored = False
     for n in regions:
-        client = boto3.client('ec2', region_name=n)
-        response = client.describe_route_tables()
-        for m in response['RouteTables']:
-            for o in m['Routes']:
-                try:
-                    if o['VpcPeeringConnectionId']:
-                        if int(str(o['DestinationCidrBlock']).split("/", 1)[1]) < 24:
-                            result = False
-                            failReason = "Large CIDR block routed to peer discovered, please investigate"
-                            offenders.append(str(n) + " : " + str(m['RouteTableId']))
-                            offenders_links.append('https://console.aws.amazon.com/vpc/home?region={region}#routetables:filter={route_table}'.format(
-                                region=n,
-                                route_table=m['RouteTableId']
-                            ))
-                except:
-                    pass
+        for m in route_analysis.get(n, []):
+            result = False
+            failReason = "Peering routes broader than the peer VPC, outside it, overlapping or to inactive peering connections discovered, please investigate"
+            offenders.append("{0} : {1} : {2} -> {3} : {4}".format(
+                n, m['RouteTableId'], m['Destination'], m['VpcPeeringConnectionId'], m['Finding']))
+            offenders_links.append('https://console.aws.amazon.com/vpc/home?region={region}#routetables:filter={route_table}'.format(
+                region=n,
+                route_table=m['RouteTableId']
+            ))
     return {'Result': result, 'failReason': failReason, 'Offenders': offenders, 'OffendersLinks': offenders_links, 'ScoredControl': scored, 'Description': description, 'ControlId': control}
 
 
-def custom_control1_ensure_guardduty_is_enabled(regions, events_rules):
+def custom_control1_ensure_guardduty_is_enabled(regions, events_rules, security_services):
     """Summary
 
     Returns:
@@ -2097,45 +2617,42 @@ def custom_control1_ensure_guardduty_is_enabled(regions, events_rules):
     failReason = "GuardDuty is not enabled in each region with an enabled CloudWatch Rule"
     scored = False
     for n in regions:
-        client = boto3.client('guardduty', region_name=n)
-        response = client.list_detectors()
+        guardduty = security_services[n]['GuardDuty']
+
+        if guardduty['Status'] == 'UNAVAILABLE':
+            continue
+
+        elif guardduty['Status'] == 'ERROR':
+            offenders.append(str(n) + " : Unable to determine (" + guardduty['Error'] + ")")
+            offenders_links.append('https://console.aws.amazon.com/guardduty/home?region={region}'.format(region=n))
+            result = False
 
-        if not response['DetectorIds']:
+        elif not guardduty['Detectors']:
             offenders.append(str(n) + " : Not enabled")
             offenders_links.append('https://console.aws.amazon.com/guardduty/home?region={region}'.format(region=n))
             result = False
 
         else:
-            for m in response['DetectorIds']:
-                response = client.get_detector(DetectorId=m)
+            for m in guardduty['Detectors']:
 
-                if response['Status'] != 'ENABLED':
+                if m['Status'] != 'ENABLED':
                     result = False
                     offenders.append(str(n) + " : Suspended")
                     offenders_links.append('https://console.aws.amazon.com/guardduty/home?region={region}'.format(region=n))
 
                 else:
 
-                    rule_exists = False
-
                     # If GuardDuty is enabled, then determine whether notifictions are enabled.
-                    for rule in events_rules[n]:
-
-                        if 'EventPattern' in rule and 'detail' in json.loads(rule['EventPattern']):
-                            detail = json.loads(rule['EventPattern'])['detail']
-
-                            if 'eventSource' in detail and 'aws.guardduty' in detail['eventSource']:
-
-                                rule_exists = True
-
-                                if rule['State'] != 'ENABLED':
-
-                                    result = False
-                                    offenders.append(str(n) + " : Disabled rule")
-                                    offenders_links.append('https://console.aws.amazon.com/cloudwatch/home?region={region}#rules:name={rule_name}'.format(
-                                        region=n,
-                                        rule_name=rule['Name'])
-                                    )
+                    rules = events_rules.get(n, {}).get('aws.guardduty', [])
+                    rule_exists = len(rules) > 0
+                    for rule in rules:
+                        if rule['State'] != 'ENABLED':
+                            result = False
+                            offenders.append(str(n) + " : Disabled rule")
+                            offenders_links.append('https://console.aws.amazon.com/cloudwatch/home?region={region}#rules:name={rule_name}'.format(
+                                region=n,
+                                rule_name=rule['Name'])
+                            )
 
                     if not rule_exists:
                         result = False
@@ -2145,7 +2662,7 @@ def custom_control1_ensure_guardduty_is_enabled(regions, events_rules):
     return {'Result': result, 'failReason': failReason, 'Offenders': offenders, 'OffendersLinks': offenders_links, 'ScoredControl': scored, 'Description': description, 'ControlId': control}
 
 
-def custom_control1_ensure_inspector_is_enabled(regions):
+def custom_control1_ensure_inspector_is_enabled(regions, security_services):
     """Summary
 
     Returns:
@@ -2158,10 +2675,9 @@ def custom_control1_ensure_inspector_is_enabled(regions):
     control = "5.2"
     description = "Ensure Inspector is enabled"
     scored = False
-    client = boto3.client('inspector')
-    response = client.list_assessment_targets()
+    enabled = [n for n in regions if security_services[n]['Inspector']['Status'] == 'ENABLED']
 
-    if not response['assessmentTargetArns']:
+    if not enabled:
         offenders.append("Not enabled")
         offenders_links.append('https://console.aws.amazon.com/inspector/home')
         result = False
@@ -2169,7 +2685,7 @@ def custom_control1_ensure_inspector_is_enabled(regions):
 
     return {'Result': result, 'failReason': failReason, 'Offenders': offenders, 'OffendersLinks': offenders_links, 'ScoredControl': scored, 'Description': description, 'ControlId': control}
 
-def custom_control1_ensure_macie_is_enabled(regions):
+def custom_control1_ensure_macie_is_enabled(regions, events_rules, security_services):
     """Summary
 
     Returns:
@@ -2182,20 +2698,13 @@ def custom_control1_ensure_macie_is_enabled(regions):
     control = "5.3"
     description = "Ensure Macie is enabled"
     scored = False
-    client = IAM_CLIENT
-
-    try:
-        # First, test for failure.
-        response = client.get_role(RoleName="AWSMacieServiceCustomerSetupRole")
+    enabled = [n for n in regions if security_services[n]['Macie']['Status'] == 'ENABLED']
 
-        # An exception wasn't thrown, so continue...
-        response = boto3.client('events').list_rules()['Rules']
-
-        for m in response:
-
-            if 'EventPattern' in m and "aws.macie" in m['EventPattern']:
-                result = True
-                pass
+    if enabled:
+        for n in enabled:
+            for rule in events_rules.get(n, {}).get('aws.macie', []):
+                if rule['State'] == 'ENABLED':
+                    result = True
 
         if not result:
             offenders.append("Account")
@@ -2203,15 +2712,43 @@ def custom_control1_ensure_macie_is_enabled(regions):
             result = False
             failReason = "There are no CloudWatch event rules for Macie activities"
 
-    except:
+    else:
         offenders.append("Account")
-        offenders_links.append('https://console.aws.amazon.com/console/home')
+        offenders_links.append('https://console.aws.amazon.com/macie/home')
         result = False
         failReason = "Macie is not enabled"
 
     return {'Result': result, 'failReason': failReason, 'Offenders': offenders, 'OffendersLinks': offenders_links, 'ScoredControl': scored, 'Description': description, 'ControlId': control}
 
 
+def custom_control1_ensure_sensitive_ports_not_open_to_world(regions, port_exposure):
+    """Summary
+
+    Returns:
+        TYPE: Description
+    """
+    result = True
+    failReason = ""
+    offenders = []
+    offenders_links = []
+    control = "5.4"
+    description = "Ensure no security groups allow ingress from 0.0.0.0/0 or ::/0 to sensitive ports ({0})".format(
+        ", ".join(str(port) for port in sorted(SENSITIVE_PORTS)))
+    scored = False
+    for n in regions:
+        exposed = port_exposure.get(n, {})
+        for port in sorted(SENSITIVE_PORTS):
+            for m in exposed.get(str(port), []):
+                result = False
+                failReason = "Found Security Groups with sensitive ports open to the world (0.0.0.0/0 or ::/0)"
+                offenders.append(str(n) + " : " + str(m) + " : " + str(port))
+                offenders_links.append('https://console.aws.amazon.com/ec2/v2/home?region={region}#SecurityGroups:search={security_group}'.format(
+                    region=n,
+                    security_group=m
+                ))
+    return {'Result': result, 'failReason': failReason, 'Offenders': offenders, 'OffendersLinks': offenders_links, 'ScoredControl': scored, 'Description': description, 'ControlId': control}
+
+
 # --- Central functions ---
 
 def get_cred_report():
@@ -2222,7 +2759,7 @@ def get_cred_report():
     """
     x = 0
     status = ""
-    while IAM_CLIENT.generate_credential_report()['State'] != "COMPLETE":
+    while aws_client('iam').generate_credential_report()['State'] != "COMPLETE":
         time.sleep(2)
         x += 1
         # If no credentail report is delivered within this time fail the check.
@@ -2231,9 +2768,10 @@ def get_cred_report():
             break
     if "Fail" in status:
         return status
-    response = IAM_CLIENT.get_credential_report()
+    import csv
+    response = aws_client('iam').get_credential_report()
     report = []
-    reader = csv.DictReader(response['Content'].splitlines(), delimiter=',')
+    reader = csv.DictReader(response['Content'].decode('utf-8').splitlines(), delimiter=',')
     for row in reader:
         report.append(row)
 
@@ -2258,198 +2796,1179 @@ def get_account_password_policy():
         Account IAM password policy or False
     """
     try:
-        response = IAM_CLIENT.get_account_password_policy()
+        response = aws_client('iam').get_account_password_policy()
         return response['PasswordPolicy']
     except Exception as e:
         if "cannot be found" in str(e):
             return False
 
 
+def get_iam_authorization_details():
+    """Retrieve IAM users and customer managed policies in as few pages as possible.
+
+    A single paginated call returns each user's inline policies and every
+    version of each policy document, replacing per-user and per-policy lookups.
+
+    Returns:
+        dict: 'Users' (UserDetailList) and 'Policies' (customer managed policies)
+    """
+    details = {'Users': [], 'Policies': []}
+    paginator = aws_client('iam').get_paginator('get_account_authorization_details')
+    response_iterator = paginator.paginate(Filter=['User', 'LocalManagedPolicy'],
+        PaginationConfig={'PageSize': 1000}
+    )
+    for page in response_iterator:
+        details['Users'].extend(page.get('UserDetailList', []))
+        details['Policies'].extend(page.get('Policies', []))
+    return details
+
+
 def get_regions():
-    """Summary
+    """Regions enabled for the account, from the region capability map.
 
     Returns:
-        TYPE: Description
+        list: Region names
+    """
+    capabilities = region_capabilities()
+    return [n for n, status in capabilities['Regions'].items() if status != 'not-opted-in']
+
+
+def region_capabilities():
+    """Map of the account's regions and the services available in each.
+
+    Opt-in status comes from describe_regions(AllRegions=True), service
+    availability from botocore's endpoint data, which needs no API call.
+    Regions botocore does not know yet are assumed to offer every service.
+    The map is kept in memory, and in REGION_CACHE_FILE when set, for
+    REGION_CACHE_TTL seconds.
+
+    Returns:
+        dict: 'Regions' (region -> opt-in status), 'Services' (service ->
+        enabled regions offering it) and 'FetchedAt'
+    """
+    capabilities = _REGION_MAP.get('map')
+    if capabilities is None and REGION_CACHE_FILE and os.path.exists(REGION_CACHE_FILE):
+        try:
+            with open(REGION_CACHE_FILE) as f:
+                capabilities = json.load(f)
+        except ValueError:
+            capabilities = None
+    if capabilities is not None and time.time() - capabilities['FetchedAt'] < REGION_CACHE_TTL:
+        _REGION_MAP['map'] = capabilities
+        return capabilities
+
+    import boto3
+    response = aws_client('ec2').describe_regions(AllRegions=True)
+    regions = dict((r['RegionName'], r.get('OptInStatus', 'opt-in-not-required')) for r in response['Regions'])
+    enabled = [n for n, status in regions.items() if status != 'not-opted-in']
+    session = boto3.session.Session()
+    known = set(session.get_available_regions('ec2'))
+    services = dict()
+    for service in REGIONAL_SERVICES:
+        available = set(session.get_available_regions(service))
+        services[service] = [n for n in enabled if n in available or n not in known]
+    capabilities = {'Regions': regions, 'Services': services, 'FetchedAt': time.time()}
+    _REGION_MAP['map'] = capabilities
+    if REGION_CACHE_FILE:
+        with open(REGION_CACHE_FILE, 'w') as f:
+            json.dump(capabilities, f)
+    return capabilities
+
+
+def service_regions(service, regions):
+    """The given regions in which a service is available.
+
+    Args:
+        service (str): Service name, for example 'guardduty'
+        regions (list): Region names
+
+    Returns:
+        list: Regions where calls to the service can succeed
     """
-    client = boto3.client('ec2')
-    region_response = client.describe_regions()
-    regions = [region['RegionName'] for region in region_response['Regions']]
-    if 'ap-northeast-3' in regions:
-        regions.remove('ap-northeast-3')
-    return regions
+    available = region_capabilities()['Services'].get(service)
+    if available is None:
+        return list(regions)
+    return [n for n in regions if n in available]
 
 
 def get_cloudtrails(regions):
-    """Summary
+    """Build the trail catalog shared by the 2.x and 3.x controls.
+
+    One paginated list_trails call finds every trail in the account with
+    its home region, so shadow copies of multi-region trails never appear.
+    The trails are then described with one describe_trails call per home
+    region, and their status, event selectors and, for trails delivering to
+    CloudWatch Logs, metric filters are fetched concurrently. Failed calls
+    are recorded in 'Errors' by call name.
 
     Returns:
-        TYPE: Description
+        dict: Home region -> list of trails, each with 'TrailStatus',
+        'EventSelectors', 'MetricFilters' and 'Errors' added
     """
+    arns = dict()
+    paginator = aws_client('cloudtrail').get_paginator('list_trails')
+    for page in paginator.paginate():
+        for trail in page['Trails']:
+            if trail['HomeRegion'] in regions:
+                arns.setdefault(trail['HomeRegion'], []).append(trail['TrailARN'])
+
+    def describe(region):
+        client = aws_client('cloudtrail', region)
+        return client.describe_trails(trailNameList=arns[region], includeShadowTrails=False)['trailList']
+    homes = sorted(arns)
+    catalog = dict()
+    for region, trailList in zip(homes, run_concurrently(describe, homes)):
+        for trail in trailList:
+            trail.update({'TrailStatus': {}, 'EventSelectors': {}, 'MetricFilters': [], 'Errors': {}})
+            catalog[trail['TrailARN']] = trail
+
+    def inspect(task):
+        arn, call = task
+        trail = catalog[arn]
+        try:
+            if call == 'TrailStatus':
+                response = aws_client('cloudtrail', trail['HomeRegion']).get_trail_status(Name=arn)
+                response.pop('ResponseMetadata', None)
+                trail['TrailStatus'] = response
+            elif call == 'EventSelectors':
+                response = aws_client('cloudtrail', trail['HomeRegion']).get_event_selectors(TrailName=arn)
+                trail['EventSelectors'] = dict((k, response[k]) for k in ('EventSelectors', 'AdvancedEventSelectors')
+                                               if k in response)
+            elif call == 'MetricFilters':
+                group = re.search('log-group:(.+?):', trail['CloudWatchLogsLogGroupArn']).group(1)
+                paginator = aws_client('logs', trail['HomeRegion']).get_paginator('describe_metric_filters')
+                for page in paginator.paginate(logGroupName=group):
+                    trail['MetricFilters'].extend(page['metricFilters'])
+        except Exception as e:
+            trail['Errors'][call] = error_code(e)
+    tasks = []
+    for arn, trail in sorted(catalog.items()):
+        tasks.extend([(arn, 'TrailStatus'), (arn, 'EventSelectors')])
+        if trail.get('CloudWatchLogsLogGroupArn'):
+            tasks.append((arn, 'MetricFilters'))
+    run_concurrently(inspect, tasks)
+
     trails = dict()
-    for n in regions:
-        client = boto3.client('cloudtrail', region_name=n)
-        response = client.describe_trails()
-        temp = []
-        for m in response['trailList']:
-            if m['IsMultiRegionTrail'] is True:
-                if m['HomeRegion'] == n:
-                    temp.append(m)
-            else:
-                temp.append(m)
-        if len(temp) > 0:
-            trails[n] = temp
+    for arn, trail in sorted(catalog.items()):
+        trails.setdefault(trail['HomeRegion'], []).append(trail)
     return trails
 
 def get_events_rules(regions):
-    """Summary
+    """Index the EventBridge rules of every region by event source.
+
+    Rules are listed concurrently, one paginator per region, and each
+    EventPattern is parsed once. A rule is indexed under every value of its
+    'source' and 'detail.eventSource' fields, at most once per source.
 
     Returns:
-        TYPE: Description
+        dict: Region -> event source -> list of {'Name', 'State'}
     """
+    def index(region):
+        sources = dict()
+        for page in all_pages(aws_client('events', region).get_paginator('list_rules')) or []:
+            for rule in page['Rules']:
+                for source in event_sources(rule.get('EventPattern')):
+                    sources.setdefault(source, []).append({'Name': rule['Name'], 'State': rule['State']})
+        return sources
     events_rules = dict()
-    for n in regions:
-        # response = boto3.client('events').list_rules()['Rules']
-        client = boto3.client('events', region_name=n)
-        response = client.list_rules()
-        temp = []
-        for m in response['Rules']:
-            temp.append(m)
-        if len(temp) > 0:
-            events_rules[n] = temp
+    regions = service_regions('events', regions)
+    for region, sources in zip(regions, run_concurrently(index, regions)):
+        if len(sources) > 0:
+            events_rules[region] = sources
     return events_rules
 
 
-def find_in_string(pattern, target):
-    """Summary
+def event_sources(eventPattern):
+    """Event sources an EventBridge pattern matches on.
+
+    Args:
+        eventPattern (str): EventPattern JSON, may be None for scheduled rules
 
     Returns:
-        TYPE: Description
+        list: Distinct 'source' and 'detail.eventSource' values
     """
-    result = True
-    for n in pattern:
-        if not re.search(n, target):
-            result = False
-            break
-    return result
-
-
-def get_account_number():
-    """Summary
+    try:
+        pattern = json.loads(eventPattern) if eventPattern else {}
+    except ValueError:
+        return []
+    if not isinstance(pattern, dict):
+        return []
+    detail = pattern.get('detail')
+    values = [pattern.get('source'), detail.get('eventSource') if isinstance(detail, dict) else None]
+    sources = []
+    for value in values:
+        for source in (value if isinstance(value, list) else [value]):
+            # Content filters such as {"prefix": "aws."} are not indexed
+            if isinstance(source, str) and source not in sources:
+                sources.append(source)
+    return sources
+
+
+def get_config_posture(regions):
+    """Collect the AWS Config recorders and delivery channels of every region.
+
+    The recorder status, recorder and delivery channel status calls of all
+    regions run concurrently. Recorders are merged with their status by
+    name. Failed calls are recorded in 'Errors' by call name. Regions
+    without AWS Config are left out.
 
     Returns:
-        TYPE: Description
+        dict: Region -> {'Recorders': [{'Name', 'Recording', 'AllSupported',
+        'IncludeGlobalResourceTypes'}], 'Channels': [{'Name', 'HistoryStatus',
+        'StreamStatus'}], 'Errors'}
+    """
+    calls = ('describe_configuration_recorder_status', 'describe_configuration_recorders',
+             'describe_delivery_channel_status')
+    regions = service_regions('config', regions)
+    tasks = [(region, call) for region in regions for call in calls]
+
+    def describe(task):
+        region, call = task
+        try:
+            return getattr(aws_client('config', region), call)(), None
+        except Exception as e:
+            return None, error_code(e)
+    responses = dict()
+    for task, response in zip(tasks, run_concurrently(describe, tasks)):
+        responses[task] = response
+
+    posture = dict()
+    for region in regions:
+        errors = dict((call, responses[(region, call)][1]) for call in calls if responses[(region, call)][1])
+        statuses = dict((o['name'], o) for o in
+                        (responses[(region, calls[0])][0] or {}).get('ConfigurationRecordersStatus', []))
+        recorders = []
+        for o in (responses[(region, calls[1])][0] or {}).get('ConfigurationRecorders', []):
+            group = o.get('recordingGroup', {})
+            recorders.append({'Name': o['name'], 'Recording': statuses.get(o['name'], {}).get('recording', False),
+                              'AllSupported': group.get('allSupported'),
+                              'IncludeGlobalResourceTypes': group.get('includeGlobalResourceTypes')})
+        channels = []
+        for o in (responses[(region, calls[2])][0] or {}).get('DeliveryChannelsStatus', []):
+            channels.append({'Name': o.get('name'),
+                             'HistoryStatus': o.get('configHistoryDeliveryInfo', {}).get('lastStatus'),
+                             'StreamStatus': o.get('configStreamDeliveryInfo', {}).get('lastStatus')})
+        posture[region] = {'Recorders': recorders, 'Channels': channels, 'Errors': errors}
+    return posture
+
+
+def probe_guardduty(region):
+    """GuardDuty detectors of a region and their status."""
+    client = aws_client('guardduty', region)
+    detectors = []
+    for page in client.get_paginator('list_detectors').paginate():
+        for detectorId in page['DetectorIds']:
+            detectors.append({'DetectorId': detectorId, 'Status': client.get_detector(DetectorId=detectorId)['Status']})
+    if not detectors:
+        return {'Status': 'NOT_ENABLED', 'Detectors': detectors}
+    enabled = any(d['Status'] == 'ENABLED' for d in detectors)
+    return {'Status': 'ENABLED' if enabled else 'SUSPENDED', 'Detectors': detectors}
+
+
+def probe_inspector(region):
+    """Inspector assessment targets of a region."""
+    targets = []
+    paginator = aws_client('inspector', region).get_paginator('list_assessment_targets')
+    for page in paginator.paginate():
+        targets.extend(page['assessmentTargetArns'])
+    return {'Status': 'ENABLED' if targets else 'NOT_ENABLED', 'Targets': len(targets)}
+
+
+def probe_macie(region):
+    """Macie session status of a region."""
+    try:
+        session = aws_client('macie2', region).get_macie_session()
+    except Exception as e:
+        # Macie answers AccessDenied while it is not enabled in the region; other
+        # AccessDenied errors, such as a missing permission, are errors
+        if error_code(e) == 'AccessDeniedException' and 'not enabled' in str(e).lower():
+            return {'Status': 'NOT_ENABLED'}
+        raise
+    return {'Status': session['status']}
+
+
+def get_security_services(regions):
+    """Probe the enablement of every security service in every region.
+
+    All (region, service) probes in SECURITY_SERVICE_PROBES run
+    concurrently, so another service adds no serial latency. A probe that
+    fails is reported with status 'ERROR' and the error code, a service not
+    offered in a region as 'UNAVAILABLE' without a call.
+
+    Returns:
+        dict: Region -> service -> {'Status', ...probe details}
+    """
+    services = dict((region, dict()) for region in regions)
+    tasks = []
+    for service in sorted(SECURITY_SERVICE_PROBES):
+        available = service_regions(SECURITY_SERVICE_PROBES[service][0], regions)
+        for region in regions:
+            if region in available:
+                tasks.append((region, service))
+            else:
+                services[region][service] = {'Status': 'UNAVAILABLE'}
+
+    def probe(task):
+        region, service = task
+        try:
+            return globals()[SECURITY_SERVICE_PROBES[service][1]](region)
+        except Exception as e:
+            return {'Status': 'ERROR', 'Error': error_code(e)}
+    for (region, service), state in zip(tasks, run_concurrently(probe, tasks)):
+        services[region][service] = state
+    return services
+
+
+def find_in_string(pattern, target):
+    """Summary
+
+    Returns:
+        TYPE: Description
+    """
+    result = True
+    for n in pattern:
+        if not re.search(n, target):
+            result = False
+            break
+    return result
+
+
+def get_security_group_rules(regions):
+    """Ingress rule sets of all security groups, stored once per distinct rule set.
+
+    Each group's CIDR-sourced ingress rules are canonicalized (protocol
+    normalized to tcp, udp or all, protocol "-1" spelled out as 0-65535,
+    CIDRs normalized, rules sorted and deduplicated) and hashed. Groups
+    stamped out from the same template share a hash, so their rules are
+    stored and evaluated once. Rules of other protocols (ICMP) have no
+    port range.
+
+    Returns:
+        dict: Region -> {'rulesets': hash -> list of rules, 'groups': list of groups}
+    """
+    import hashlib
+    import ipaddress
+    protocols = {"-1": "all", "tcp": "tcp", "6": "tcp", "udp": "udp", "17": "udp"}
+    sgRules = dict()
+    for n in regions:
+        pages = all_pages(aws_client('ec2', n).get_paginator('describe_security_groups'),
+                          PaginationConfig={'PageSize': 1000})
+        if pages is None:
+            continue
+        rulesets = dict()
+        groups = []
+        for page in pages:
+            for m in page['SecurityGroups']:
+                canonical = set()
+                for o in m['IpPermissions']:
+                    protocol = protocols.get(str(o['IpProtocol']), str(o['IpProtocol']))
+                    if protocol == "all":
+                        fromPort, toPort = 0, 65535
+                    elif protocol in ("tcp", "udp"):
+                        fromPort, toPort = int(o.get('FromPort', 0)), int(o.get('ToPort', 65535))
+                    else:
+                        fromPort, toPort = None, None
+                    cidrs = [r['CidrIp'] for r in o.get('IpRanges', [])] + \
+                        [r['CidrIpv6'] for r in o.get('Ipv6Ranges', [])]
+                    for cidr in cidrs:
+                        try:
+                            cidr = str(ipaddress.ip_network(cidr, strict=False))
+                        except ValueError:
+                            pass
+                        canonical.add((protocol, fromPort, toPort, cidr))
+                canonical = sorted(canonical, key=str)
+                rulesetHash = hashlib.sha1(json.dumps(canonical).encode('utf-8')).hexdigest()
+                if rulesetHash not in rulesets:
+                    rulesets[rulesetHash] = [{'Protocol': protocol, 'FromPort': fromPort, 'ToPort': toPort, 'Cidr': cidr}
+                                             for protocol, fromPort, toPort, cidr in canonical]
+                groups.append({'GroupId': m['GroupId'], 'GroupName': m.get('GroupName'), 'VpcId': m.get('VpcId'),
+                               'Ingress': rulesetHash,
+                               'RuleCount': len(m['IpPermissions']) + len(m.get('IpPermissionsEgress', []))})
+        sgRules[n] = {'rulesets': rulesets, 'groups': groups}
+    return sgRules
+
+
+def exposed_ports(rules, ports):
+    """Ports of a rule set that are reachable from anywhere (0.0.0.0/0 or ::/0).
+
+    The port ranges of world-open rules are sorted by start port and swept
+    together with the sorted ports, keeping the ranges that cover the
+    current port in a heap ordered by end port.
+
+    Args:
+        rules (list): Canonical rules of one rule set
+        ports (list): Sorted ports to check
+
+    Returns:
+        list: Exposed ports
+    """
+    import heapq
+    import ipaddress
+    intervals = []
+    for rule in rules:
+        if rule['FromPort'] is None:
+            continue
+        try:
+            network = ipaddress.ip_network(rule['Cidr'], strict=False)
+        except ValueError:
+            continue
+        if network.prefixlen == 0:
+            intervals.append((rule['FromPort'], rule['ToPort']))
+    intervals.sort()
+    exposed = []
+    active = []
+    i = 0
+    for port in ports:
+        while i < len(intervals) and intervals[i][0] <= port:
+            heapq.heappush(active, intervals[i][1])
+            i += 1
+        while active and active[0] < port:
+            heapq.heappop(active)
+        if active:
+            exposed.append(port)
+    return exposed
+
+
+def get_port_exposure(sgRules):
+    """Security groups reachable from anywhere (0.0.0.0/0 or ::/0) on each sensitive port.
+
+    Each distinct rule set is evaluated once and the verdict applies to every
+    group that has it. Verdicts are kept by rule set hash in _RULESET_VERDICTS,
+    which outlives the run in a warm Lambda container up to
+    RULESET_CACHE_MAX_ENTRIES, and for the rule sets of this scan in
+    RULESET_CACHE_FILE when set.
+
+    Returns:
+        dict: Region -> port (str) -> sorted list of group IDs
+    """
+    ports = sorted(set(SENSITIVE_PORTS) | set([22, 3389]))
+    portsKey = ",".join(str(port) for port in ports)
+    if RULESET_CACHE_FILE and not _RULESET_VERDICTS:
+        try:
+            with open(RULESET_CACHE_FILE) as f:
+                _RULESET_VERDICTS.update(json.load(f))
+            _RULESET_FILE_KEYS.clear()
+            _RULESET_FILE_KEYS.update(_RULESET_VERDICTS)
+        except (IOError, OSError, ValueError):
+            pass
+    seen = dict()
+    exposure = dict()
+    for n, regionRules in sgRules.items():
+        verdicts = dict()
+        for rulesetHash, rules in regionRules['rulesets'].items():
+            key = rulesetHash + ":" + portsKey
+            # Most recently used last
+            verdict = _RULESET_VERDICTS.pop(key, None)
+            if verdict is None:
+                verdict = exposed_ports(rules, ports)
+            _RULESET_VERDICTS[key] = seen[key] = verdicts[rulesetHash] = verdict
+        exposed = dict()
+        for m in regionRules['groups']:
+            for port in verdicts[m['Ingress']]:
+                exposed.setdefault(str(port), []).append(m['GroupId'])
+        for port in exposed:
+            exposed[port].sort()
+        exposure[n] = exposed
+    while len(_RULESET_VERDICTS) > RULESET_CACHE_MAX_ENTRIES:
+        del _RULESET_VERDICTS[next(iter(_RULESET_VERDICTS))]
+    if RULESET_CACHE_FILE and set(seen) != _RULESET_FILE_KEYS:
+        with open(RULESET_CACHE_FILE, 'w') as f:
+            json.dump(seen, f)
+        _RULESET_FILE_KEYS.clear()
+        _RULESET_FILE_KEYS.update(seen)
+    return exposure
+
+
+def get_vpcs(regions):
+    """Available VPCs with their IPv4 and IPv6 CIDR blocks.
+
+    Returns:
+        dict: Region -> list of {'VpcId', 'CidrBlocks'}
+    """
+    vpcs = dict()
+    for n in regions:
+        pages = all_pages(aws_client('ec2', n).get_paginator('describe_vpcs'),
+                          Filters=[{'Name': 'state', 'Values': ['available']}], PaginationConfig={'PageSize': 1000})
+        if pages is None:
+            continue
+        temp = []
+        for page in pages:
+            for m in page['Vpcs']:
+                cidrs = [o['CidrBlock'] for o in m.get('CidrBlockAssociationSet', [])
+                         if o.get('CidrBlockState', {}).get('State', 'associated') == 'associated']
+                cidrs += [o['Ipv6CidrBlock'] for o in m.get('Ipv6CidrBlockAssociationSet', [])
+                          if o.get('Ipv6CidrBlockState', {}).get('State', 'associated') == 'associated']
+                if not cidrs and m.get('CidrBlock'):
+                    cidrs = [m['CidrBlock']]
+                temp.append({'VpcId': m['VpcId'], 'CidrBlocks': cidrs})
+        vpcs[n] = temp
+    return vpcs
+
+
+def prefix_index(networks):
+    """Sort networks into (version, first address, last address) tuples for bisect lookups.
+
+    Args:
+        networks (list): ipaddress networks
+
+    Returns:
+        list: Sorted index
+    """
+    return sorted((net.version, int(net.network_address), int(net.broadcast_address)) for net in networks)
+
+
+def lookup_prefix(index, network):
+    """Relation of a network to the disjoint networks of a prefix index.
+
+    Args:
+        index (list): Output of prefix_index, entries must not overlap
+        network (TYPE): ipaddress network
+
+    Returns:
+        str: "within" when an indexed network contains it, "covers" when it contains
+        indexed networks, otherwise "outside"
+    """
+    import bisect
+    first, last = int(network.network_address), int(network.broadcast_address)
+    i = bisect.bisect_right(index, (network.version, first, float('inf')))
+    if i and index[i - 1][0] == network.version and index[i - 1][1] <= first and last <= index[i - 1][2]:
+        return "within"
+    i = bisect.bisect_left(index, (network.version, first, -1))
+    if i < len(index) and index[i][0] == network.version and index[i][1] <= last:
+        return "covers"
+    return "outside"
+
+
+def get_route_analysis(regions, vpcs):
+    """Find peering routes that are not least access.
+
+    For every route table, the routes to VPC peering connections are parsed
+    into ipaddress networks and compared with the peer VPC's CIDR blocks,
+    taken from the peering connection, through a sorted prefix index.
+    Peering routes and the VPC's own CIDR blocks are then sorted by address
+    and swept with a stack of enclosing networks to find overlaps, so a
+    table with n routes is analyzed in O(n log n). Findings:
+
+        over-broad: the route covers the peer VPC's CIDR blocks and more
+        outside peer: the route does not fall within the peer VPC's CIDR blocks
+        overlaps <route>: the route overlaps another peering route or the local VPC
+        inactive peering: the peering connection is missing or not active
+
+    Routes to prefix lists are not evaluated.
+
+    Returns:
+        dict: Region -> list of findings
+    """
+    import ipaddress
+    analysis = dict()
+    for n in regions:
+        client = aws_client('ec2', n)
+        peeringPages = all_pages(client.get_paginator('describe_vpc_peering_connections'),
+                                 PaginationConfig={'PageSize': 1000})
+        tablePages = all_pages(client.get_paginator('describe_route_tables'),
+                               PaginationConfig={'PageSize': 1000}) if peeringPages is not None else None
+        if tablePages is None:
+            continue
+        peerings = dict()
+        for page in peeringPages:
+            for m in page['VpcPeeringConnections']:
+                peerings[m['VpcPeeringConnectionId']] = m
+        localCidrs = dict((m['VpcId'], m['CidrBlocks']) for m in vpcs.get(n, []))
+        peerIndexes = dict()
+        findings = []
+        for page in tablePages:
+            for table in page['RouteTables']:
+                vpcId = table.get('VpcId')
+                entries = []
+                for cidr in localCidrs.get(vpcId, []):
+                    entries.append((ipaddress.ip_network(cidr, strict=False), None))
+                for route in table['Routes']:
+                    pcx = route.get('VpcPeeringConnectionId')
+                    destination = route.get('DestinationCidrBlock') or route.get('DestinationIpv6CidrBlock')
+                    if not pcx or not destination:
+                        continue
+                    network = ipaddress.ip_network(destination, strict=False)
+                    entries.append((network, pcx))
+                    finding = None
+                    peering = peerings.get(pcx)
+                    if peering is None or peering.get('Status', {}).get('Code') != 'active':
+                        finding = "inactive peering"
+                    else:
+                        if pcx not in peerIndexes:
+                            peerIndexes[pcx] = dict()
+                            for side, other in (('RequesterVpcInfo', 'AccepterVpcInfo'), ('AccepterVpcInfo', 'RequesterVpcInfo')):
+                                info = peering.get(other, {})
+                                cidrs = [o['CidrBlock'] for o in info.get('CidrBlockSet', [])] or \
+                                    ([info['CidrBlock']] if info.get('CidrBlock') else [])
+                                cidrs += [o['Ipv6CidrBlock'] for o in info.get('Ipv6CidrBlockSet', [])]
+                                peerIndexes[pcx][peering.get(side, {}).get('VpcId')] = prefix_index(
+                                    [ipaddress.ip_network(c, strict=False) for c in cidrs])
+                        relation = lookup_prefix(peerIndexes[pcx].get(vpcId, []), network)
+                        if relation == "covers":
+                            finding = "over-broad"
+                        elif relation == "outside":
+                            finding = "outside peer"
+                    if finding:
+                        findings.append({'RouteTableId': table['RouteTableId'], 'VpcId': vpcId,
+                                         'Destination': str(network), 'VpcPeeringConnectionId': pcx,
+                                         'Finding': finding})
+
+                # Networks either nest or are disjoint: sort broadest first and keep the enclosing ones on a stack
+                entries.sort(key=lambda e: (e[0].version, int(e[0].network_address), e[0].prefixlen))
+                stack = []
+                for network, pcx in entries:
+                    while stack and (stack[-1][0].version != network.version or
+                                     int(stack[-1][0].broadcast_address) < int(network.network_address)):
+                        stack.pop()
+                    for outer, outerPcx in stack:
+                        if outerPcx != pcx:
+                            route, other = (network, pcx) if pcx else (outer, outerPcx)
+                            findings.append({'RouteTableId': table['RouteTableId'], 'VpcId': vpcId,
+                                             'Destination': str(route), 'VpcPeeringConnectionId': other,
+                                             'Finding': "overlaps " + (str(outer) if pcx else str(network)) +
+                                             (" (" + outerPcx + ")" if outerPcx and pcx else " (local)")})
+                    stack.append((network, pcx))
+        analysis[n] = findings
+    return analysis
+
+
+def get_flow_log_coverage(regions, vpcs):
+    """Flow log status of every available VPC.
+
+    Flow logs are listed with a server-side resource-id filter, 200 VPCs per
+    request, and matched to VPCs through a dict keyed by VPC ID.
+
+    Returns:
+        dict: Region -> VPC ID -> "active", "delivery failed" (only flow logs whose
+        delivery fails), "inactive" (flow logs exist but none is active) or "missing"
+    """
+    coverage = dict()
+    for n in regions:
+        status = dict((m['VpcId'], "missing") for m in vpcs.get(n, []))
+        vpcIds = sorted(status)
+        paginator = aws_client('ec2', n).get_paginator('describe_flow_logs')
+        pages = []
+        for i in range(0, len(vpcIds), 200):
+            batch = all_pages(paginator, Filter=[{'Name': 'resource-id', 'Values': vpcIds[i:i + 200]}],
+                              PaginationConfig={'PageSize': 1000})
+            if batch is None:
+                pages = None
+                break
+            pages.extend(batch)
+        if pages is None:
+            continue
+        for page in pages:
+            for m in page['FlowLogs']:
+                vpcId = m['ResourceId']
+                if vpcId not in status or status[vpcId] == "active":
+                    continue
+                if m.get('FlowLogStatus') != 'ACTIVE':
+                    if status[vpcId] == "missing":
+                        status[vpcId] = "inactive"
+                elif m.get('DeliverLogsStatus') == 'FAILED':
+                    status[vpcId] = "delivery failed"
+                else:
+                    status[vpcId] = "active"
+        coverage[n] = status
+    return coverage
+
+
+def get_trail_buckets(cloudtrails):
+    """Inspect every bucket CloudTrail logs to, once per bucket.
+
+    Each bucket's region is resolved once with get_bucket_location, then its
+    ACL, policy status, public access block and logging are fetched
+    concurrently through a client for that region, which avoids S3
+    redirects. Failed calls are recorded in 'Errors' by check name.
+
+    Returns:
+        dict: Bucket name -> {'Region', 'Public', 'PolicyPublic', 'AclPublic',
+        'PublicAccessBlock', 'Logging', 'Errors'}
+    """
+    names = sorted(set(o['S3BucketName'] for n in cloudtrails.values() for o in n if o.get('S3BucketName')))
+    buckets = dict((name, {'Region': None, 'Public': False, 'AclPublic': False, 'PolicyPublic': False,
+                           'PublicAccessBlock': {}, 'Logging': False, 'Errors': {}}) for name in names)
+
+    def locate(name):
+        try:
+            location = aws_client('s3').get_bucket_location(Bucket=name)['LocationConstraint']
+            buckets[name]['Region'] = {None: 'us-east-1', '': 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)
+        except Exception as e:
+            buckets[name]['Errors']['Location'] = error_code(e)
+    run_concurrently(locate, names)
+
+    def inspect(task):
+        name, check = task
+        bucket = buckets[name]
+        client = aws_client('s3', bucket['Region'])
+        try:
+            if check == 'Acl':
+                grants = client.get_bucket_acl(Bucket=name)['Grants']
+                bucket['AclPublic'] = any(re.search(r'(global/AllUsers|global/AuthenticatedUsers)', str(p['Grantee']))
+                                          for p in grants)
+            elif check == 'Policy':
+                bucket['PolicyPublic'] = client.get_bucket_policy_status(Bucket=name)['PolicyStatus']['IsPublic']
+            elif check == 'PublicAccessBlock':
+                bucket['PublicAccessBlock'] = client.get_public_access_block(
+                    Bucket=name)['PublicAccessBlockConfiguration']
+            elif check == 'Logging':
+                bucket['Logging'] = 'LoggingEnabled' in client.get_bucket_logging(Bucket=name)
+        except Exception as e:
+            code = error_code(e)
+            # A bucket without a policy or public access block is a valid answer
+            if code not in ('NoSuchBucketPolicy', 'NoSuchPublicAccessBlockConfiguration'):
+                bucket['Errors'][check] = code
+    run_concurrently(inspect, [(name, check) for name in names
+                               for check in ('Acl', 'Policy', 'PublicAccessBlock', 'Logging')])
+
+    for bucket in buckets.values():
+        block = bucket['PublicAccessBlock']
+        bucket['Public'] = (bucket['AclPublic'] and not block.get('IgnorePublicAcls')) or \
+            (bucket['PolicyPublic'] and not block.get('RestrictPublicBuckets'))
+    return buckets
+
+
+def get_account_number():
+    """Summary
+
+    Returns:
+        TYPE: Description
     """
     if S3_WEB_REPORT_OBFUSCATE_ACCOUNT is False:
-        client = boto3.client("sts")
+        client = aws_client('sts')
         account = client.get_caller_identity()["Account"]
     else:
         account = "111111111111"
     return account
 
 
-def set_evaluation(invokeEvent, mainEvent, annotation):
-    """Summary
+def set_evaluation(invokeEvent, mainEvent, controlResult, inventory):
+    """Report the results to AWS Config.
+
+    The account is evaluated as before. With CONFIG_RESOURCE_EVALUATIONS,
+    resources are evaluated individually as well, see resource_evaluations.
+    Evaluations are sent concurrently in batches.
 
     Args:
-        event (TYPE): Description
-        annotation (TYPE): Description
+        invokeEvent (dict): Parsed invokingEvent of the Config rule
+        mainEvent (dict): Lambda event
+        controlResult (list): Results by section
+        inventory (dict): Resources collected during the scan
 
     Returns:
-        TYPE: Description
+        int: Evaluations Config did not accept
     """
-    configClient = boto3.client('config')
-    if len(annotation) > 0:
-        configClient.put_evaluations(Evaluations=[
-                {
-                    'ComplianceResourceType': 'AWS::::Account',
-                    'ComplianceResourceId': mainEvent['accountId'],
-                    'ComplianceType': 'NON_COMPLIANT',
-                    'Annotation': str(annotation),
-                    'OrderingTimestamp': invokeEvent['notificationCreationTime']
-                },
-            ],
-            ResultToken=mainEvent['resultToken']
-        )
-    else:
-        configClient.put_evaluations(Evaluations=[
-                {
-                    'ComplianceResourceType': 'AWS::::Account',
-                    'ComplianceResourceId': mainEvent['accountId'],
-                    'ComplianceType': 'COMPLIANT',
-                    'OrderingTimestamp': invokeEvent['notificationCreationTime']
-                },
-            ],
-            ResultToken=mainEvent['resultToken']
-        )
+    timestamp = invokeEvent['notificationCreationTime']
+    failed = [c['ControlId'] for section in controlResult for c in section if c['Result'] is False]
+    evaluation = {
+        'ComplianceResourceType': 'AWS::::Account',
+        'ComplianceResourceId': mainEvent['accountId'],
+        'ComplianceType': 'NON_COMPLIANT' if failed else 'COMPLIANT',
+        'OrderingTimestamp': timestamp
+    }
+    if failed:
+        evaluation['Annotation'] = config_annotation(failed)
+    evaluations = [evaluation]
+    if CONFIG_RESOURCE_EVALUATIONS:
+        evaluations.extend(resource_evaluations(controlResult, inventory, timestamp, mainEvent.get('configRuleName')))
+    return put_config_evaluations(evaluations, mainEvent['resultToken'])
+
+
+def config_annotation(controlIds):
+    """Failed controls as a Config annotation, shortened to the 256 character limit."""
+    annotation = "{\"Failed\":" + json.dumps(controlIds) + "}"
+    while len(annotation) > 256:
+        controlIds = controlIds[:-1]
+        annotation = "{\"Failed\":" + json.dumps(controlIds + ["etc"]) + "}"
+    return annotation
+
+
+def offender_resource(offender, resourceIds):
+    """Config resource type and ID named by an offender, None for account level findings.
 
+    Args:
+        offender (str): Offender text of a control
+        resourceIds (dict): IAM ARN -> user or policy ID
 
-def json2html(controlResult, account):
-    """Summary
+    Returns:
+        tuple: (resource type, resource ID) or None
+    """
+    for resourceType, pattern in CONFIG_RESOURCE_PATTERNS:
+        match = re.search(pattern, offender)
+        if match:
+            resourceId = match.group(1)
+            if resourceType.startswith('AWS::IAM::'):
+                resourceId = resourceIds.get(resourceId)
+            return (resourceType, resourceId) if resourceId else None
+    return None
+
+
+def resource_region(offender, resource, regions, default):
+    """Region of the resource an offender names, None for global (IAM) resources.
+
+    Taken from the offender text (an ARN, or a "<region> : <id>" offender),
+    else from the resources collected per region. Remaining resources were
+    found through the session's default region, as control 1.21 does.
 
     Args:
-        controlResult (TYPE): Description
+        offender (str): Offender text of a control
+        resource (tuple): (resource type, resource ID) named by the offender
+        regions (dict): Resource ID -> region of the resources collected per region
+        default (str): Region of the session
 
     Returns:
-        TYPE: Description
+        str: Region name or None
     """
+    if resource[0].startswith('AWS::IAM::'):
+        return None
+    match = re.search(r'\b([a-z]{2}(?:-gov)?-[a-z]+-\d)\b', offender)
+    if match:
+        return match.group(1)
+    return regions.get(resource[1], default)
 
-    print("Generating HTML report...")
 
-    table = []
-    page = []
-    shortReport = shortAnnotation(controlResult)
+def noncompliant_resources(ruleName):
+    """Resources a Config rule currently reports NON_COMPLIANT.
 
-    css = "body,html{margin:0;padding:0}a[href^=http]:after{content:" " url(data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAoAAAAKCAMAAAC67D+PAAAAB3RJTUUH4gMLDjMU49ZxvwAAAAlwSFlzAAAK8AAACvABQqw0mAAAAAlQTFRF////Xl5eVVVVUp4p0AAAAAF0Uk5TAEDm2GYAAAAnSURBVHjaY2AAAyYgABMQwMCEJAphMUCZUCEIkwHGBKvBxWSEGwsAFm4AYAhPD0EAAAAASUVORK5CYII=)}.top_bar{height:40px;background-color:#232F3F;color:#fff;text-align:center;line-height:40px;margin-bottom:20px}.attribute-table,.control-container,.control-table{font-family:Arial,Helvetica,sans-serif;border-collapse:collapse}.attribute-cell,.control-cell{box-sizing:border-box;vertical-align:middle}.active,.collapsible:hover{background-color:#555}.collapsible:after{content:'\\002B';color:#fff;font-weight:700;float:right;margin-left:5px}.active:after{content:'\\2212'}.attribute-table{display:table;width:800px;font-size:.8em;margin:0 auto;margin-bottom:20px;}.attribute-column-label{width:150px;background-color:#d3d3d3;display:table-column}.attribute-column-value{width:auto}.attribute-row{display:table-row;height:25px}.attribute-cell{display:table-cell;border:1px solid #666;padding-left:10px}.attribute-label{background-color:#ccc;width:150px;font-weight:700}.attribute-value{width:auto}.collapsible{background-color:#777;color:#fff;cursor:pointer;padding:12px;width:100%;border:none;text-align:left;outline:0;font-size:14px;height:40px;margin-bottom:10px}.content{max-height:0;overflow:hidden;transition:max-height .2s ease-out}.control-container{display:block;width:800px;font-size:.8em;margin:30px auto 0}.control-table{display:table;width:798px;margin:0 auto;margin-bottom:10px}.control-column-label{width:150px;background-color:#d3d3d3;display:table-column}.control-column-value{width:150px}.control-row{display:table-row;height:25px}.control-cell{display:table-cell;border:1px solid #666;padding-left:10px}.control-label{background-color:#ccc;font-weight:700}.control-value:hover{background-color:#d3d3d3}.result-failure{background-color:#ff6666}"
+    Args:
+        ruleName (str): Config rule name
 
-    page.append('<html><head><style>' + css + '</style></head><body>')
+    Returns:
+        dict: (resource type, resource ID) -> control IDs from the annotation,
+        None when the annotation does not list them all
+    """
+    found = dict()
+    paginator = aws_client('config').get_paginator('get_compliance_details_by_config_rule')
+    for page in paginator.paginate(ConfigRuleName=ruleName, ComplianceTypes=['NON_COMPLIANT']):
+        for o in page['EvaluationResults']:
+            qualifier = o['EvaluationResultIdentifier']['EvaluationResultQualifier']
+            if qualifier['ResourceType'] == 'AWS::::Account':
+                continue
+            try:
+                controlIds = json.loads(o.get('Annotation') or '')['Failed']
+            except (ValueError, KeyError, TypeError):
+                controlIds = None
+            if controlIds is not None and "etc" in controlIds:
+                controlIds = None
+            found[(qualifier['ResourceType'], qualifier['ResourceId'])] = controlIds
+    return found
 
-    report_details = '''
-    <div class="top_bar">AWS Cloud Wellness Report</div>
-    <div class="attribute-table">
-        <div class="attribute-column-label"></div>
-        <div class="attribute-column-value"></div>
 
-        <div class="attribute-row">
-            <div class="attribute-cell attribute-label">Account:</div>
-            <div class="attribute-cell attribute-value">{0}</div>
-        </div>
-        <div class="attribute-row">
-            <div class="attribute-cell attribute-label">Report date:</div>
-            <div class="attribute-cell attribute-value">{1}</div>
-        </div>
-        <div class="attribute-row">
-            <div class="attribute-cell attribute-label">JSON Results</div>
-            <div class="attribute-cell attribute-value">{3}</div>
-        </div>
-    </div>
-    '''.format(
-            account,
-            time.strftime("%c"),
-            AWS_CLOUD_WELLNESS_STANDARD_VERSION,
-            shortReport
-        )
+def resource_evaluations(controlResult, inventory, timestamp, ruleName=None):
+    """Per resource Config evaluations for the rule's region.
 
-    page.append(report_details)
+    Resources named by offenders are NON_COMPLIANT, with the failed controls
+    as annotation. Resources of other regions are left to the rule deployed
+    there; IAM resources are global and always included. A resource the rule
+    reported NON_COMPLIANT before is COMPLIANT again once every control in
+    its annotation ran without naming it, and without skipped or incomplete
+    regions. Other resources are not evaluated.
 
-    page.append('    <div class="control-container">')
+    Args:
+        controlResult (list): Results by section
+        inventory (dict): Resources collected during the scan
+        timestamp (str): OrderingTimestamp of the evaluations
+        ruleName (str): Config rule name, None to send NON_COMPLIANT evaluations only
 
-    for m, _ in enumerate(controlResult):
-        page.append('''
+    Returns:
+        list: Evaluations
+    """
+    region = aws_client('config').meta.region_name
+    details = inventory.get('iam_details') or {}
+    resourceIds = dict((o['Arn'], o['UserId']) for o in details.get('Users', []) if 'UserId' in o)
+    resourceIds.update((o['Arn'], o['PolicyId']) for o in details.get('Policies', []) if 'PolicyId' in o)
+    regions = dict()
+    for n, rules in (inventory.get('security_group_rules') or {}).items():
+        regions.update((o['GroupId'], n) for o in rules['groups'])
+    for n, vpcs in (inventory.get('vpcs') or {}).items():
+        regions.update((o['VpcId'], n) for o in vpcs)
+
+    failed = dict()
+    complete = set()
+    controls = [c for section in controlResult for c in section]
+    for c in controls:
+        if not c.get('SkippedScope') and not c.get('IncompleteRegions'):
+            complete.add(c['ControlId'])
+        if c['Result'] is not False:
+            continue
+        for offender in c['Offenders']:
+            resource = offender_resource(str(offender), resourceIds)
+            if resource is None or resource_region(str(offender), resource, regions, region) not in (None, region):
+                continue
+            if c['ControlId'] not in failed.setdefault(resource, []):
+                failed[resource].append(c['ControlId'])
+
+    evaluations = []
+    for resourceType, resourceId in sorted(failed):
+        evaluations.append({'ComplianceResourceType': resourceType, 'ComplianceResourceId': resourceId,
+                            'ComplianceType': 'NON_COMPLIANT', 'OrderingTimestamp': timestamp,
+                            'Annotation': config_annotation(failed[(resourceType, resourceId)])})
+    if not ruleName:
+        return evaluations
+    try:
+        previous = noncompliant_resources(ruleName)
+    except Exception as e:
+        with _OUTPUT_LOCK:
+            print("Could not read the resources Config rule " + ruleName + " reports non compliant: " + str(e))
+        return evaluations
+    allComplete = len(complete) == len(controls) == len(CONTROLS)
+    for resource, controlIds in sorted(previous.items()):
+        if resource in failed:
+            continue
+        if allComplete if controlIds is None else complete.issuperset(controlIds):
+            evaluations.append({'ComplianceResourceType': resource[0], 'ComplianceResourceId': resource[1],
+                                'ComplianceType': 'COMPLIANT', 'OrderingTimestamp': timestamp})
+    return evaluations
+
+
+def put_config_evaluations(evaluations, resultToken):
+    """Send evaluations in batches of CONFIG_EVALUATION_BATCH_SIZE, concurrently.
+
+    Throttled calls, and evaluations Config reports as failed, are retried
+    with exponential backoff and jitter up to CONFIG_EVALUATION_RETRIES
+    times. Other errors are raised.
+
+    Returns:
+        int: Evaluations still failed after all retries
+    """
+    import random
+    size = min(CONFIG_EVALUATION_BATCH_SIZE, 100)
+    batches = [evaluations[i:i + size] for i in range(0, len(evaluations), size)]
+
+    def put(batch):
+        client = aws_client('config')
+        for attempt in range(CONFIG_EVALUATION_RETRIES + 1):
+            if attempt:
+                time.sleep(random.uniform(0, min(0.2 * 2 ** attempt, 5.0)))
+            try:
+                response = client.put_evaluations(Evaluations=batch, ResultToken=resultToken)
+            except Exception as e:
+                if error_code(e) not in ('ThrottlingException', 'Throttling', 'TooManyRequestsException') \
+                        or attempt == CONFIG_EVALUATION_RETRIES:
+                    raise
+                continue
+            batch = response.get('FailedEvaluations', [])
+            if not batch:
+                return 0
+        return len(batch)
+    unsent = sum(run_concurrently(put, batches))
+    if unsent:
+        with _OUTPUT_LOCK:
+            print("Config did not accept {0} of {1} evaluations".format(unsent, len(evaluations)))
+    return unsent
+
+
+def compact_links(links):
+    """Express offender links as shared templates plus the values that vary.
+
+    Links are split on URL delimiters and grouped by their delimiter layout.
+    Within a group, tokens that are the same for every link become part of
+    the template, and only the varying tokens are stored per link.
+
+    Args:
+        links (list): Offender links
+
+    Returns:
+        tuple: (templates, rows). A template is a list of literal parts, a row is
+        [template index, value, value, ...] and expands to
+        parts[0] + value + parts[1] + value + ... + parts[-1].
+    """
+    delimiters = re.compile(r"([/?#=&:,.]+)")
+    split = [delimiters.split(link) for link in links]
+    groups = {}
+    order = []
+    for tokens in split:
+        layout = tuple(tokens[1::2])
+        if layout not in groups:
+            groups[layout] = []
+            order.append(layout)
+        groups[layout].append(tokens)
+
+    templates = []
+    variables = {}
+    for layout in order:
+        members = groups[layout]
+        columns = list(zip(*members))
+        varying = [i for i in range(0, len(columns), 2) if len(set(columns[i])) > 1]
+        parts = [""]
+        for i, token in enumerate(members[0]):
+            if i in varying:
+                parts.append("")
+            else:
+                parts[-1] += token
+        variables[layout] = (len(templates), varying)
+        templates.append(parts)
+
+    rows = []
+    for tokens in split:
+        index, varying = variables[tuple(tokens[1::2])]
+        rows.append([index] + [tokens[i] for i in varying])
+    return templates, rows
+
+
+def compact_section(section):
+    """One section of the compact report, as the JSON data the browser renders.
+
+    Args:
+        section (list): Control results of the section
+
+    Returns:
+        str: JSON text
+    """
+    controls = []
+    for control in section:
+        templates, links = compact_links(control.get('OffendersLinks') or [])
+        controls.append({
+            'id': control['ControlId'],
+            'description': control['Description'],
+            'result': control['Result'],
+            'failReason': control['failReason'],
+            'scored': control['ScoredControl'],
+            'offenders': list(control['Offenders'] or []),
+            'templates': templates,
+            'links': links,
+        })
+    return json.dumps({
+        'label': CONTROL_LABEL_MAP[str(section[0]['ControlId'].split('.')[0])],
+        'controls': controls,
+    }, separators=(',', ':'), default=str)
+
+
+def compact_report(controlResult, rendered=None):
+    """Report body that embeds the results once as JSON and renders them in the browser.
+
+    Sections, controls and offender pages are only turned into HTML when the
+    reader opens them, so the size of the page and the time to open it do not
+    grow with the number of offenders the way the full report does.
+
+    Args:
+        controlResult (list): Control results per section
+        rendered (list): compact_section of every section, when already rendered
+
+    Returns:
+        list: HTML chunks, placed after the report header
+    """
+    if rendered is None:
+        rendered = [compact_section(section) for section in controlResult]
+    data = '{"sections":[' + ','.join(rendered) + ']}'
+
+    page = []
+    page.append('<script type="application/json" id="report-data">')
+    # Keep the JSON from closing the script element early
+    page.append(data.replace('</', '<\\/'))
+    page.append('</script>')
+    page.append('''
+        <script>
+        var PAGE_SIZE = ''' + str(S3_WEB_REPORT_OFFENDERS_PAGE_SIZE) + ''';
+        var report = JSON.parse(document.getElementById("report-data").textContent);
+        var container = document.getElementsByClassName("control-container")[0];
+
+        function el(tag, cls, text) {
+            var e = document.createElement(tag);
+            if (cls) e.className = cls;
+            if (text !== undefined) e.textContent = text;
+            return e;
+        }
+
+        function row(table, label, value) {
+            var r = el("div", "control-row"), v = el("div", "control-cell control-value");
+            r.appendChild(el("div", "control-cell control-label", label));
+            if (value instanceof Node) v.appendChild(value); else v.textContent = String(value);
+            r.appendChild(v);
+            table.appendChild(r);
+        }
+
+        function link(c, i) {
+            var l = c.links[i];
+            if (!l) return null;
+            var parts = c.templates[l[0]], url = parts[0];
+            for (var j = 1; j < parts.length; j++) url += l[j] + parts[j];
+            return url;
+        }
+
+        function offenders(c) {
+            var box = el("div"), more = el("button", "more-offenders"), shown = 0;
+            function showPage() {
+                var end = Math.min(shown + PAGE_SIZE, c.offenders.length);
+                if (more.parentNode) box.removeChild(more);
+                for (; shown < end; shown++) {
+                    var line = el("div", null, c.offenders[shown]), url = link(c, shown);
+                    if (url) {
+                        var a = el("a");
+                        a.href = url;
+                        a.target = "_blank";
+                        line.appendChild(document.createTextNode("\\u00a0"));
+                        line.appendChild(a);
+                    }
+                    box.appendChild(line);
+                }
+                if (shown < c.offenders.length) {
+                    more.textContent = "Show more (" + (c.offenders.length - shown) + " remaining)";
+                    box.appendChild(more);
+                }
+            }
+            more.addEventListener("click", showPage);
+            showPage();
+            return box;
+        }
+
+        function control(c) {
+            var t = el("div", "control-table" + (c.result ? "" : " result-failure"));
+            t.appendChild(el("div", "control-column-label"));
+            t.appendChild(el("div", "control-column-value"));
+            row(t, "Control ID:", c.id);
+            row(t, "Description:", c.description);
+            row(t, "Result:", c.result ? "Pass" : "Fail");
+            if (!c.result) {
+                row(t, "Fail Reason:", c.failReason);
+                if (c.offenders.length) row(t, "Offenders (" + c.offenders.length + "):", offenders(c));
+            }
+            row(t, "Scored Control:", c.scored ? "True" : "False");
+            return t;
+        }
+
+        report.sections.forEach(function(s) {
+            var button = el("button", "collapsible", s.label + " Controls (" + s.controls.length + ")");
+            var content = el("div", "content");
+            button.addEventListener("click", function() {
+                if (!content.firstChild) s.controls.forEach(function(c) { content.appendChild(control(c)); });
+                this.classList.toggle("active");
+                content.style.maxHeight = content.style.maxHeight ? null : "none";
+            });
+            container.appendChild(button);
+            container.appendChild(content);
+        });
+        </script>
+    ''')
+    return page
+
+
+def html_section(section):
+    """One section of the full HTML report.
+
+    Args:
+        section (list): Control results of the section
+
+    Returns:
+        list: HTML chunks
+    """
+    chunks = []
+    chunks.append('''
             <button class="collapsible">{control_label} Controls ({control_count})</button>
             <div class="content">
             '''.format(
-                    control_label=CONTROL_LABEL_MAP[str(controlResult[m][0]['ControlId'].split('.')[0])],
-                    control_count=len(controlResult[m]
-                )
+                control_label=CONTROL_LABEL_MAP[str(section[0]['ControlId'].split('.')[0])],
+                control_count=len(section
             )
         )
+    )
 
-        for n in range(len(controlResult[m])):
+    for n in range(len(section)):
 
-            # The section will be highlighted for failed controls.
-            result_class = " result-failure" if controlResult[m][n]['Result'] == False else ""
+        # The section will be highlighted for failed controls.
+        result_class = " result-failure" if section[n]['Result'] == False else ""
 
-            page.append('''
+        chunks.append('''
                 <div class="control-table{result_status}">
                     <div class="control-column-label"></div>
                     <div class="control-column-value"></div>
@@ -2466,52 +3985,123 @@ def json2html(controlResult, account):
                         <div class="control-cell control-value">{result}</div>
                     </div>
                 '''.format(
-                        result_status=result_class,
-                        result="Pass" if controlResult[m][n]['Result'] else "Fail",
-                        control_id=controlResult[m][n]['ControlId'],
-                        description=controlResult[m][n]['Description']
-                    )
-            )
+                    result_status=result_class,
+                    result="Pass" if section[n]['Result'] else "Fail",
+                    control_id=section[n]['ControlId'],
+                    description=section[n]['Description']
+                )
+        )
 
-            # Only show these fields in case of failure.
-            if controlResult[m][n]['Result'] == False:
+        # Only show these fields in case of failure.
+        if section[n]['Result'] == False:
 
-                page.append('''
+            chunks.append('''
                         <div class="control-row">
                             <div class="control-cell control-label">Fail Reason:</div>
                             <div class="control-cell control-value">{fail_reason}</div>
                         </div>
                     '''.format(
-                            fail_reason=controlResult[m][n]['failReason']
-                        )
-                )
+                        fail_reason=section[n]['failReason']
+                    )
+            )
 
-                offenders_links = format_offenders(controlResult[m][n])
-                # Only display offenders if there are any.
-                if offenders_links:
-                    page.append('''
+            offenders_links = format_offenders(section[n])
+            # Only display offenders if there are any.
+            if offenders_links:
+                chunks.append('''
                             <div class="control-row">
                                 <div class="control-cell control-label">Offenders:</div>
                                 <div class="control-cell control-value">{offenders}</div>
                             </div>
                         '''.format(
-                                offenders=offenders_links
-                            )
-                    )
+                            offenders=offenders_links
+                        )
+                )
 
-            page.append('''
+        chunks.append('''
                     <div class="control-row">
                         <div class="control-cell control-label">Scored Control:</div>
                         <div class="control-cell control-value">{scored_control}</div>
                     </div>
                 '''.format(
-                        scored_control=controlResult[m][n]['ScoredControl']
-                    )
-            )
+                    scored_control=section[n]['ScoredControl']
+                )
+        )
+
+        chunks.append('</div>')
+
+    chunks.append('</div>')
+
+    return chunks
 
-            page.append('</div>')
 
+def report_section(section):
+    """Render one section for the report format in S3_WEB_REPORT_FORMAT."""
+    if S3_WEB_REPORT_FORMAT == "compact":
+        return compact_section(section)
+    return html_section(section)
+
+
+def json2html(controlResult, account, rendered=None):
+    """Summary
+
+    Args:
+        controlResult (TYPE): Description
+        rendered (list): report_section of every section, when already rendered
+
+    Returns:
+        TYPE: Description
+    """
+
+    with _OUTPUT_LOCK:
+        print("Generating HTML report...")
+
+    table = []
+    page = []
+    shortReport = shortAnnotation(controlResult)
+
+    css = "body,html{margin:0;padding:0}a[href^=http]:after{content:" " url(data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAoAAAAKCAMAAAC67D+PAAAAB3RJTUUH4gMLDjMU49ZxvwAAAAlwSFlzAAAK8AAACvABQqw0mAAAAAlQTFRF////Xl5eVVVVUp4p0AAAAAF0Uk5TAEDm2GYAAAAnSURBVHjaY2AAAyYgABMQwMCEJAphMUCZUCEIkwHGBKvBxWSEGwsAFm4AYAhPD0EAAAAASUVORK5CYII=)}.top_bar{height:40px;background-color:#232F3F;color:#fff;text-align:center;line-height:40px;margin-bottom:20px}.attribute-table,.control-container,.control-table{font-family:Arial,Helvetica,sans-serif;border-collapse:collapse}.attribute-cell,.control-cell{box-sizing:border-box;vertical-align:middle}.active,.collapsible:hover{background-color:#555}.collapsible:after{content:'\\002B';color:#fff;font-weight:700;float:right;margin-left:5px}.active:after{content:'\\2212'}.attribute-table{display:table;width:800px;font-size:.8em;margin:0 auto;margin-bottom:20px;}.attribute-column-label{width:150px;background-color:#d3d3d3;display:table-column}.attribute-column-value{width:auto}.attribute-row{display:table-row;height:25px}.attribute-cell{display:table-cell;border:1px solid #666;padding-left:10px}.attribute-label{background-color:#ccc;width:150px;font-weight:700}.attribute-value{width:auto}.collapsible{background-color:#777;color:#fff;cursor:pointer;padding:12px;width:100%;border:none;text-align:left;outline:0;font-size:14px;height:40px;margin-bottom:10px}.content{max-height:0;overflow:hidden;transition:max-height .2s ease-out}.control-container{display:block;width:800px;font-size:.8em;margin:30px auto 0}.control-table{display:table;width:798px;margin:0 auto;margin-bottom:10px}.control-column-label{width:150px;background-color:#d3d3d3;display:table-column}.control-column-value{width:150px}.control-row{display:table-row;height:25px}.control-cell{display:table-cell;border:1px solid #666;padding-left:10px}.control-label{background-color:#ccc;font-weight:700}.control-value:hover{background-color:#d3d3d3}.result-failure{background-color:#ff6666}"
+
+    page.append('<html><head><style>' + css + '</style></head><body>')
+
+    report_details = '''
+    <div class="top_bar">AWS Cloud Wellness Report</div>
+    <div class="attribute-table">
+        <div class="attribute-column-label"></div>
+        <div class="attribute-column-value"></div>
+
+        <div class="attribute-row">
+            <div class="attribute-cell attribute-label">Account:</div>
+            <div class="attribute-cell attribute-value">{0}</div>
+        </div>
+        <div class="attribute-row">
+            <div class="attribute-cell attribute-label">Report date:</div>
+            <div class="attribute-cell attribute-value">{1}</div>
+        </div>
+        <div class="attribute-row">
+            <div class="attribute-cell attribute-label">JSON Results</div>
+            <div class="attribute-cell attribute-value">{3}</div>
+        </div>
+    </div>
+    '''.format(
+            account,
+            time.strftime("%c"),
+            AWS_CLOUD_WELLNESS_STANDARD_VERSION,
+            shortReport
+        )
+
+    page.append(report_details)
+
+    page.append('    <div class="control-container">')
+
+    if S3_WEB_REPORT_FORMAT == "compact":
         page.append('</div>')
+        page.extend(compact_report(controlResult, rendered))
+        page.append('</body></html>')
+        return page
+
+    for chunks in rendered if rendered is not None else [html_section(section) for section in controlResult]:
+        page.extend(chunks)
 
     js_collapse = '''
         <script>
@@ -2529,11 +4119,100 @@ def json2html(controlResult, account):
     return page
 
 
+class S3ObjectWriter(object):
+    """Write-only file object that uploads to S3 without touching disk.
+
+    Data is buffered in memory. Objects smaller than S3_WEB_REPORT_PART_SIZE
+    are stored with a single put_object, larger ones are sent as a multipart
+    upload while they are being written.
+
+    Args:
+        bucket (str): Bucket name
+        key (str): Object key
+        extraArgs (dict): Object attributes such as ContentType
+    """
+
+    def __init__(self, bucket, key, extraArgs):
+        import io
+        self.bucket = bucket
+        self.key = key
+        self.extraArgs = extraArgs
+        self.buffer = io.BytesIO()
+        self.uploadId = None
+        self.parts = []
+
+    def write(self, data):
+        self.buffer.write(data)
+        if self.buffer.tell() >= S3_WEB_REPORT_PART_SIZE:
+            self._upload_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self):
+        client = aws_client('s3')
+        if self.uploadId is None:
+            self.uploadId = client.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                           **self.extraArgs)['UploadId']
+        partNumber = len(self.parts) + 1
+        response = client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.uploadId,
+                                      PartNumber=partNumber, Body=self.buffer.getvalue())
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': partNumber})
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def close(self):
+        if self.uploadId is None:
+            aws_client('s3').put_object(Bucket=self.bucket, Key=self.key,
+                                        Body=self.buffer.getvalue(), **self.extraArgs)
+            return
+        if self.buffer.tell():
+            self._upload_part()
+        aws_client('s3').complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                   UploadId=self.uploadId,
+                                                   MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        if self.uploadId is not None:
+            try:
+                aws_client('s3').abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                        UploadId=self.uploadId)
+            except Exception as e:
+                with _OUTPUT_LOCK:
+                    print("Could not abort multipart upload of " + self.key + ": " + str(e))
+
+
+def obfuscate_account_numbers(htmlReport):
+    """Replace 12 digit account numbers in a stream of HTML chunks.
+
+    A run of digits at the end of a chunk is held back until the next chunk,
+    so numbers split across chunks are replaced as well.
+
+    Args:
+        htmlReport (iterable): HTML chunks
+
+    Returns:
+        generator: Obfuscated HTML chunks
+    """
+    pattern = re.compile(r"\d{12}")
+    trailingDigits = re.compile(r"\d*$")
+    carry = ""
+    for item in htmlReport:
+        item = carry + item
+        split = trailingDigits.search(item).start()
+        carry = item[split:]
+        if split:
+            yield pattern.sub("xxxxxxxxxxxx", item[:split])
+    if carry:
+        yield pattern.sub("xxxxxxxxxxxx", carry)
+
+
 def s3report(htmlReport, account):
     """Summary
 
     Args:
-        htmlReport (TYPE): Description
+        htmlReport (iterable): HTML chunks, streamed into the (compressed) S3 object
 
     Returns:
         TYPE: Description
@@ -2544,21 +4223,27 @@ def s3report(htmlReport, account):
             str(datetime.now().strftime('%Y%m%d_%H%M')) + ".html"
     else:
         reportName = "aws_cloud_wellness_report.html"
-    with tempfile.NamedTemporaryFile(delete=False) as f:
+    extraArgs = {'ContentType': 'text/html; charset=utf-8'}
+    if S3_WEB_REPORT_COMPRESS:
+        extraArgs['ContentEncoding'] = 'gzip'
+    writer = S3ObjectWriter(output_bucket, reportName, extraArgs)
+    try:
+        if S3_WEB_REPORT_COMPRESS:
+            import gzip
+            out = gzip.GzipFile(filename=reportName, mode='wb', fileobj=writer,
+                                compresslevel=S3_WEB_REPORT_COMPRESS_LEVEL)
+        else:
+            out = writer
         for item in htmlReport:
-            f.write(item)
-            f.flush()
-        try:
-            f.close()
-            S3_CLIENT.upload_file(f.name,
-                output_bucket,
-                reportName,
-                ExtraArgs={'ContentType': 'text/html'})
-            os.unlink(f.name)
-        except Exception as e:
-            return "Failed to upload report to S3 because: " + str(e)
+            out.write(item.encode('utf-8'))
+        if out is not writer:
+            out.close()
+        writer.close()
+    except Exception as e:
+        writer.abort()
+        return "Failed to upload report to S3 because: " + str(e)
     ttl = int(S3_WEB_REPORT_EXPIRE) * 60
-    signedURL = S3_CLIENT.generate_presigned_url('get_object',
+    signedURL = aws_client('s3').generate_presigned_url('get_object',
         Params={
             'Bucket': output_bucket,
             'Key': reportName
@@ -2567,35 +4252,98 @@ def s3report(htmlReport, account):
     return signedURL
 
 
-def json_output(controlResult):
+def write_ndjson(record):
+    """Write one compact JSON line and flush it, so consumers can read it right away.
+
+    Args:
+        record (dict): JSON serializable record
+    """
+    stream = ndjson_stream or sys.stdout
+    stream.write(json.dumps(record, separators=(',', ':'), sort_keys=True, default=str) + "\n")
+    stream.flush()
+
+
+def ndjson_control(control, account, scanId):
+    """Write the NDJSON line(s) for one control result.
+
+    Args:
+        control (dict): Control result
+        account (str): Account number
+        scanId (str): Identifies the scan the result belongs to
+    """
+    timestamp = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    offenders = list(control['Offenders'] or [])
+    record = {
+        'type': 'control',
+        'scanId': scanId,
+        'account': account,
+        'timestamp': timestamp,
+        'controlId': control['ControlId'],
+        'section': CONTROL_LABEL_MAP[control['ControlId'].split('.')[0]],
+        'description': control['Description'],
+        'result': control['Result'],
+        'scored': control['ScoredControl'],
+        'failReason': control['failReason'],
+        'offenderCount': len(offenders),
+    }
+    if not NDJSON_PER_OFFENDER:
+        record['offenders'] = offenders
+    if control.get('SkippedScope'):
+        record['skippedScope'] = control['SkippedScope']
+    if control.get('IncompleteRegions'):
+        record['incompleteRegions'] = control['IncompleteRegions']
+    write_ndjson(record)
+    if NDJSON_PER_OFFENDER:
+        links = control.get('OffendersLinks') or []
+        for n, offender in enumerate(offenders):
+            write_ndjson({
+                'type': 'offender',
+                'scanId': scanId,
+                'account': account,
+                'timestamp': timestamp,
+                'controlId': control['ControlId'],
+                'offender': offender,
+                'link': links[n] if n < len(links) else None,
+            })
+
+
+def json_section(section):
+    """One section of the JSON output: (section number, JSON text of its controls by number)."""
+    inner = dict()
+    for n in range(len(section)):
+        x = int(section[n]['ControlId'].split('.')[1])
+        inner[x] = section[n]
+    y = section[0]['ControlId'].split('.')[0]
+    return y, json.dumps(inner, sort_keys=True, indent=4, separators=(',', ': '))
+
+
+def json_output(controlResult, rendered=None):
     """Summary
 
     Args:
         controlResult (TYPE): Description
+        rendered (list): json_section of every section, when already rendered
 
     Returns:
         TYPE: Description
     """
-    inner = dict()
-    outer = dict()
-    for m in range(len(controlResult)):
-        inner = dict()
-        for n in range(len(controlResult[m])):
-            x = int(controlResult[m][n]['ControlId'].split('.')[1])
-            inner[x] = controlResult[m][n]
-        y = controlResult[m][0]['ControlId'].split('.')[0]
-        outer[y] = inner
-    if OUTPUT_ONLY_JSON is True:
-        print(json.dumps(outer, sort_keys=True, indent=4, separators=(',', ': ')))
-    else:
-        print("JSON output:")
-        print("-------------------------------------------------------")
-        print(json.dumps(outer, sort_keys=True, indent=4, separators=(',', ': ')))
-        print("-------------------------------------------------------")
-        print("\n")
-        print("Summary:")
-        print(shortAnnotation(controlResult))
-        print("\n")
+    if rendered is None:
+        rendered = [json_section(section) for section in controlResult]
+    # Same text as dumping all sections at once, with the sections nested one level deeper
+    output = "{\n" + ",\n".join('    ' + json.dumps(y) + ': ' + text.replace("\n", "\n    ")
+                                  for y, text in sorted(rendered)) + "\n}" if rendered else "{}"
+    with _OUTPUT_LOCK:
+        if OUTPUT_ONLY_JSON is True:
+            print(output)
+        else:
+            print("JSON output:")
+            print("-------------------------------------------------------")
+            print(output)
+            print("-------------------------------------------------------")
+            print("\n")
+            print("Summary:")
+            print(shortAnnotation(controlResult))
+            print("\n")
     return 0
 
 def format_offenders(control):
@@ -2671,7 +4419,7 @@ def send_results_to_sns(url):
     """
     # Get correct region for the TopicARN
     region = (SNS_TOPIC_ARN.split("sns:", 1)[1]).split(":", 1)[0]
-    client = boto3.client('sns', region_name=region)
+    client = aws_client('sns', region)
     client.publish(TopicArn=SNS_TOPIC_ARN,
         Subject="AWS AWS Cloud Wellness report - " + str(time.strftime("%c")),
         Message=json.dumps({'default': url}),
@@ -2679,6 +4427,730 @@ def send_results_to_sns(url):
     )
 
 
+# --- Scan plan ---
+
+# Shared resources collected once per scan: name -> (collector function, inventory it needs).
+# Items are collected on first use, so a resumed scan only fetches what its remaining controls need.
+INVENTORY = {
+    "regions": ("get_regions", ()),
+    "cred_report": ("get_cred_report", ()),
+    "password_policy": ("get_account_password_policy", ()),
+    "iam_details": ("get_iam_authorization_details", ()),
+    "cloud_trails": ("get_cloudtrails", ("regions",)),
+    "trail_buckets": ("get_trail_buckets", ("cloud_trails",)),
+    "events_rules": ("get_events_rules", ("regions",)),
+    "security_services": ("get_security_services", ("regions",)),
+    "config_posture": ("get_config_posture", ("regions",)),
+    "account_number": ("get_account_number", ()),
+    "security_group_rules": ("get_security_group_rules", ("regions",)),
+    "port_exposure": ("get_port_exposure", ("security_group_rules",)),
+    "vpcs": ("get_vpcs", ("regions",)),
+    "route_analysis": ("get_route_analysis", ("regions", "vpcs")),
+    "flow_log_coverage": ("get_flow_log_coverage", ("regions", "vpcs")),
+}
+
+# Controls in report order: (section, control function, inventory passed as arguments).
+# Comment out unwanted controls
+CONTROLS = [
+    ("1", "control_1_1_root_use", ("cred_report",)),
+    ("1", "control_1_2_mfa_on_password_enabled_iam", ("cred_report",)),
+    ("1", "control_1_3_unused_credentials", ("cred_report",)),
+    ("1", "control_1_4_rotated_keys", ("cred_report",)),
+    ("1", "control_1_5_password_policy_uppercase", ("password_policy",)),
+    ("1", "control_1_6_password_policy_lowercase", ("password_policy",)),
+    ("1", "control_1_7_password_policy_symbol", ("password_policy",)),
+    ("1", "control_1_8_password_policy_number", ("password_policy",)),
+    ("1", "control_1_9_password_policy_length", ("password_policy",)),
+    ("1", "control_1_10_password_policy_reuse", ("password_policy",)),
+    ("1", "control_1_11_password_policy_expire", ("password_policy",)),
+    ("1", "control_1_12_root_key_exists", ("cred_report",)),
+    ("1", "control_1_13_root_mfa_enabled", ()),
+    ("1", "control_1_14_root_hardware_mfa_enabled", ()),
+    ("1", "control_1_15_security_questions_registered", ()),
+    ("1", "control_1_16_no_policies_on_iam_users", ("iam_details",)),
+    ("1", "control_1_17_detailed_billing_enabled", ()),
+    ("1", "control_1_18_ensure_iam_master_and_manager_roles", ()),
+    ("1", "control_1_19_maintain_current_contact_details", ()),
+    ("1", "control_1_20_ensure_security_contact_details", ()),
+    ("1", "control_1_21_ensure_iam_instance_roles_used", ()),
+    ("1", "control_1_22_ensure_incident_management_roles", ()),
+    ("1", "control_1_23_no_active_initial_access_keys_with_iam_user", ("cred_report",)),
+    ("1", "control_1_24_no_overly_permissive_policies", ("iam_details",)),
+    ("2", "control_2_1_ensure_cloud_trail_all_regions", ("cloud_trails",)),
+    ("2", "control_2_2_ensure_cloudtrail_validation", ("cloud_trails",)),
+    ("2", "control_2_3_ensure_cloudtrail_bucket_not_public", ("cloud_trails", "trail_buckets")),
+    ("2", "control_2_4_ensure_cloudtrail_cloudwatch_logs_integration", ("cloud_trails",)),
+    ("2", "control_2_5_ensure_config_all_regions", ("regions", "config_posture")),
+    ("2", "control_2_6_ensure_cloudtrail_bucket_logging", ("cloud_trails", "trail_buckets")),
+    ("2", "control_2_7_ensure_cloudtrail_encryption_kms", ("cloud_trails",)),
+    ("2", "control_2_8_ensure_kms_cmk_rotation", ("regions",)),
+    ("3", "control_3_1_ensure_log_metric_filter_unauthorized_api_calls", ("cloud_trails",)),
+    ("3", "control_3_2_ensure_log_metric_filter_console_signin_no_mfa", ("cloud_trails",)),
+    ("3", "control_3_3_ensure_log_metric_filter_root_usage", ("cloud_trails",)),
+    ("3", "control_3_4_ensure_log_metric_iam_policy_change", ("cloud_trails",)),
+    ("3", "control_3_5_ensure_log_metric_cloudtrail_configuration_changes", ("cloud_trails",)),
+    ("3", "control_3_6_ensure_log_metric_console_auth_failures", ("cloud_trails",)),
+    ("3", "control_3_7_ensure_log_metric_disabling_scheduled_delete_of_kms_cmk", ("cloud_trails",)),
+    ("3", "control_3_8_ensure_log_metric_s3_bucket_policy_changes", ("cloud_trails",)),
+    ("3", "control_3_9_ensure_log_metric_config_configuration_changes", ("cloud_trails",)),
+    ("3", "control_3_10_ensure_log_metric_security_group_changes", ("cloud_trails",)),
+    ("3", "control_3_11_ensure_log_metric_nacl", ("cloud_trails",)),
+    ("3", "control_3_12_ensure_log_metric_changes_to_network_gateways", ("cloud_trails",)),
+    ("3", "control_3_13_ensure_log_metric_changes_to_route_tables", ("cloud_trails",)),
+    ("3", "control_3_14_ensure_log_metric_changes_to_vpc", ("cloud_trails",)),
+    ("3", "control_3_15_verify_sns_subscribers", ()),
+    ("3", "control_3_16_ensure_log_metric_changes_to_organizations", ("cloud_trails",)),
+    ("4", "control_4_1_ensure_ssh_not_open_to_world", ("regions", "port_exposure")),
+    ("4", "control_4_2_ensure_rdp_not_open_to_world", ("regions", "port_exposure")),
+    ("4", "control_4_3_ensure_flow_logs_enabled_on_all_vpc", ("regions", "flow_log_coverage")),
+    ("4", "control_4_4_ensure_default_security_groups_restricts_traffic", ("regions", "security_group_rules")),
+    ("4", "control_4_5_ensure_route_tables_are_least_access", ("regions", "route_analysis")),
+    ("5", "custom_control1_ensure_guardduty_is_enabled", ("regions", "events_rules", "security_services")),
+    ("5", "custom_control1_ensure_inspector_is_enabled", ("regions", "security_services")),
+    ("5", "custom_control1_ensure_macie_is_enabled", ("regions", "events_rules", "security_services")),
+    ("5", "custom_control1_ensure_sensitive_ports_not_open_to_world", ("regions", "port_exposure")),
+]
+
+
+def collect_inventory(name, inventory, markers=None):
+    """Collect an inventory item, and the items it depends on, unless already present.
+
+    Calls the collector skipped (SkippedScope) and regions it could not
+    complete (IncompleteRegions) are recorded in markers under the item's
+    name, together with those of the items it depends on, so that every
+    control evaluating the item reports them.
+
+    Args:
+        name (str): Key in INVENTORY
+        inventory (dict): Items collected so far, updated in place
+        markers (dict): Item name -> {'SkippedScope', 'IncompleteRegions'}, updated in place
+
+    Returns:
+        TYPE: The collected item
+    """
+    if name not in inventory:
+        collector, dependencies = INVENTORY[name]
+        arguments = [collect_inventory(n, inventory, markers) for n in dependencies]
+        mark = _BREAKER.mark()
+        guardMark = _GUARD.mark()
+        ttl = MEMO_POLICIES.get(name)
+        found, value = False, None
+        if ttl:
+            key = (name, json.dumps(arguments, sort_keys=True, default=str))
+            found, value = memo_cache().get(key)
+        if not found:
+            value = globals()[collector](*arguments)
+        scope = merge_markers([{'SkippedScope': _BREAKER.skipped_since(mark),
+                                'IncompleteRegions': _GUARD.incomplete_since(guardMark)}] +
+                              [(markers or {}).get(n, {}) for n in dependencies])
+        # Later runs only reuse complete collections
+        if ttl and not found and not scope:
+            memo_cache().put(key, value, ttl)
+        inventory[name] = value
+        if markers is not None:
+            markers[name] = scope
+    return inventory[name]
+
+
+def merge_markers(markers):
+    """Union of SkippedScope and IncompleteRegions markers, leaving out empty ones.
+
+    Args:
+        markers (list): dicts with optional 'SkippedScope' and 'IncompleteRegions' lists
+
+    Returns:
+        dict: Sorted, distinct entries per marker
+    """
+    merged = dict()
+    for key in ('SkippedScope', 'IncompleteRegions'):
+        values = sorted(set(v for m in markers for v in m.get(key, [])))
+        if values:
+            merged[key] = values
+    return merged
+
+
+class MemoCache(object):
+    """TTL-bounded LRU cache that outlives an invocation in a warm container.
+
+    Values are copied in and out, so a run cannot change what the next one
+    reads. Hits, misses, expirations and evictions are counted per input
+    name, the first element of the key.
+
+    Args:
+        maxEntries (int): Items kept at most
+        maxBytes (int): Approximate size kept at most, measured as JSON
+    """
+
+    def __init__(self, maxEntries, maxBytes):
+        import collections
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.stats = collections.defaultdict(collections.Counter)
+
+    def get(self, key):
+        """Return (True, value) for a fresh entry, (False, None) otherwise."""
+        import copy
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                self._remove(key)
+                self.stats[key[0]]['expired'] += 1
+                entry = None
+            if entry is None:
+                self.stats[key[0]]['misses'] += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.stats[key[0]]['hits'] += 1
+            value = entry[0]
+        return True, copy.deepcopy(value)
+
+    def put(self, key, value, ttl):
+        import copy
+        size = len(json.dumps(value, default=str))
+        if size > self.maxBytes:
+            return
+        value = copy.deepcopy(value)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, time.time() + ttl, size)
+            self.size += size
+            while len(self.entries) > self.maxEntries or self.size > self.maxBytes:
+                evicted = next(iter(self.entries))
+                self._remove(evicted)
+                self.stats[evicted[0]]['evictions'] += 1
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)[2]
+
+    def summary(self):
+        """Hit and miss counts per input, and the cache's current size."""
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size,
+                    'inputs': dict((name, dict(counts)) for name, counts in sorted(self.stats.items()))}
+
+
+_MEMO = None
+_MEMO_LOCK = threading.Lock()
+
+
+def memo_cache():
+    """Return the warm-container cache, creating it on first use.
+
+    Created lazily, so MEMO_MAX_ENTRIES and MEMO_MAX_BYTES set after import
+    (for example by a test harness or the command line) take effect.
+
+    Returns:
+        MemoCache: The shared cache
+    """
+    global _MEMO
+    if _MEMO is None:
+        with _MEMO_LOCK:
+            if _MEMO is None:
+                _MEMO = MemoCache(MEMO_MAX_ENTRIES, MEMO_MAX_BYTES)
+    return _MEMO
+
+
+def group_results(results):
+    """Arrange control results by section, in CONTROLS order.
+
+    Args:
+        results (dict): Control function name -> control result
+
+    Returns:
+        list: One list of control results per section
+    """
+    controls = []
+    section = None
+    for section_id, name, _ in CONTROLS:
+        if name not in results:
+            continue
+        if section_id != section:
+            controls.append([])
+            section = section_id
+        controls[-1].append(results[name])
+    return controls
+
+
+# --- Findings store ---
+
+FINDINGS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    account TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    finished_at TEXT NOT NULL,
+    failed_controls INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_account ON runs (account, started_at);
+
+CREATE TABLE IF NOT EXISTS results (
+    run_id TEXT NOT NULL,
+    account TEXT NOT NULL,
+    control_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    result INTEGER NOT NULL,
+    scored INTEGER NOT NULL,
+    fail_reason TEXT,
+    offender_count INTEGER NOT NULL,
+    PRIMARY KEY (run_id, control_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_control_day ON results (control_id, day, account);
+CREATE INDEX IF NOT EXISTS results_account_control ON results (account, control_id, day);
+
+CREATE TABLE IF NOT EXISTS offenders (
+    offender_id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    control_id TEXT NOT NULL,
+    offender TEXT NOT NULL,
+    link TEXT,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL,
+    first_run TEXT NOT NULL,
+    last_run TEXT NOT NULL,
+    UNIQUE (account, control_id, offender)
+);
+CREATE INDEX IF NOT EXISTS offenders_offender ON offenders (offender, control_id);
+CREATE INDEX IF NOT EXISTS offenders_last_run ON offenders (last_run);
+
+CREATE TABLE IF NOT EXISTS run_offenders (
+    run_id TEXT NOT NULL,
+    offender_id INTEGER NOT NULL,
+    PRIMARY KEY (run_id, offender_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS run_offenders_offender ON run_offenders (offender_id);
+
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    day TEXT NOT NULL,
+    account TEXT NOT NULL,
+    control_id TEXT NOT NULL,
+    runs INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    max_offenders INTEGER NOT NULL,
+    PRIMARY KEY (day, control_id, account)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS daily_rollups_account ON daily_rollups (account, day);
+"""
+
+
+def store_findings(controlResult, account, runId, startedAt, path):
+    """Record a run's results and offenders in the SQLite findings store.
+
+    Offenders are kept once per (account, control, offender) with the first
+    and last time they were seen, and linked to every run that reported them.
+    Daily rollups per (day, control, account) are recomputed from the results
+    in the same transaction, so trend queries do not have to scan the raw
+    results and storing a run again does not count it twice.
+
+    Args:
+        controlResult (list): Control results per section
+        account (str): Account number
+        runId (str): Identifies the run, the scan id
+        startedAt (str): ISO 8601 UTC time the run started
+        path (str): Database file, created when missing
+    """
+    import sqlite3
+    finishedAt = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    day = finishedAt[:10]
+    controls = [control for section in controlResult for control in section]
+
+    connection = sqlite3.connect(path, timeout=30)
+    try:
+        # WAL needs shared memory, which network filesystems such as EFS do not provide
+        connection.execute("PRAGMA journal_mode=DELETE")
+        connection.executescript(FINDINGS_SCHEMA)
+        with connection:
+            # Days this run was stored under before, when it is stored again
+            days = set(row[0] for row in connection.execute(
+                "SELECT DISTINCT day FROM results WHERE run_id = ?", (runId,)))
+            days.add(day)
+            connection.execute("DELETE FROM results WHERE run_id = ?", (runId,))
+            connection.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?)",
+                (runId, account, startedAt, finishedAt,
+                 len([c for c in controls if c['Result'] is False])))
+            connection.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(runId, account, c['ControlId'], day, int(bool(c['Result'])), int(bool(c['ScoredControl'])),
+                  c['failReason'] or None, len(c['Offenders'] or [])) for c in controls])
+
+            offenders = []
+            for c in controls:
+                links = c.get('OffendersLinks') or []
+                for n, offender in enumerate(c['Offenders'] or []):
+                    offenders.append((account, c['ControlId'], str(offender),
+                                      links[n] if n < len(links) else None,
+                                      finishedAt, finishedAt, runId, runId))
+            connection.executemany(
+                "INSERT INTO offenders (account, control_id, offender, link, first_seen, last_seen, first_run, last_run) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (account, control_id, offender) DO UPDATE SET "
+                "last_seen = excluded.last_seen, last_run = excluded.last_run, link = excluded.link",
+                offenders)
+            connection.execute(
+                "INSERT OR IGNORE INTO run_offenders (run_id, offender_id) "
+                "SELECT ?, offender_id FROM offenders WHERE account = ? AND last_run = ?",
+                (runId, account, runId))
+
+            for d in sorted(days):
+                connection.execute("DELETE FROM daily_rollups WHERE day = ? AND account = ?", (d, account))
+                connection.execute(
+                    "INSERT INTO daily_rollups "
+                    "SELECT day, account, control_id, COUNT(*), SUM(result = 0), MAX(offender_count) "
+                    "FROM results WHERE day = ? AND account = ? GROUP BY day, account, control_id",
+                    (d, account))
+    finally:
+        connection.close()
+    # The delivery sinks may be writing to stdout at the same time
+    with _OUTPUT_LOCK:
+        print("Stored {0} results and {1} offenders in {2}".format(len(controls), len(offenders), path))
+
+
+# --- Diff mode ---
+
+def baseline_location(account):
+    """Where the previous run's results for an account are kept.
+
+    Args:
+        account (str): Account number
+
+    Returns:
+        str: s3:// URL or local path
+    """
+    name = "aws_cloud_wellness_baseline_" + str(account) + ".json"
+    if DIFF_BASELINE_LOCATION == "s3":
+        return "s3://" + output_bucket + "/" + DIFF_BASELINE_PREFIX + name
+    return os.path.join(DIFF_BASELINE_LOCATION, name)
+
+
+def load_baseline(account):
+    """Load the previous run's results, None when there is no previous run.
+
+    In S3 a missing baseline is only reported as such (404) when the role may
+    list the bucket, otherwise S3 answers AccessDenied.
+
+    Args:
+        account (str): Account number
+
+    Returns:
+        dict: Baseline written by save_baseline
+    """
+    try:
+        return load_document(baseline_location(account))
+    except (IOError, OSError):
+        return None
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return None
+        raise
+
+
+def save_baseline(account, controlResult, scanId):
+    """Store this run's results as the baseline for the next run.
+
+    Args:
+        account (str): Account number
+        controlResult (list): Control results per section
+        scanId (str): Identifies the scan
+    """
+    name = "aws_cloud_wellness_baseline_" + str(account) + ".json"
+    save_document(DIFF_BASELINE_LOCATION, DIFF_BASELINE_PREFIX, name, {
+        'scanId': scanId,
+        'account': account,
+        'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'controls': dict((control['ControlId'], {'result': control['Result'],
+                                                  'offenders': [str(o) for o in control['Offenders'] or []]})
+                         for section in controlResult for control in section),
+    })
+
+
+def diff_results(baseline, controlResult):
+    """Compare each control's result and offenders with the baseline.
+
+    Args:
+        baseline (dict): Previous run, or None to treat everything as new
+        controlResult (list): Control results per section
+
+    Returns:
+        dict: Control ID -> {result, previousResult, new, resolved, unchanged}, only for
+        controls whose result or offenders changed
+    """
+    previous = (baseline or {}).get('controls', {})
+    delta = {}
+    for section in controlResult:
+        for control in section:
+            before = previous.get(control['ControlId'], {})
+            current = [str(o) for o in control['Offenders'] or []]
+            currentSet = set(current)
+            beforeSet = set(before.get('offenders', []))
+            new = [o for o in current if o not in beforeSet]
+            resolved = sorted(beforeSet - currentSet)
+            if new or resolved or before.get('result') != control['Result']:
+                delta[control['ControlId']] = {
+                    'result': control['Result'],
+                    'previousResult': before.get('result'),
+                    'new': new,
+                    'resolved': resolved,
+                    'unchanged': len(currentSet & beforeSet),
+                }
+    return delta
+
+
+def delta_controls(controlResult, delta):
+    """Control results limited to what changed, in the shape json2html expects.
+
+    Offenders are the new ones followed by the resolved ones, each marked as such.
+
+    Args:
+        controlResult (list): Control results per section
+        delta (dict): Output of diff_results
+
+    Returns:
+        list: Changed control results per section
+    """
+    sections = []
+    for section in controlResult:
+        changed = []
+        for control in section:
+            change = delta.get(control['ControlId'])
+            if change is None:
+                continue
+            links = dict(zip([str(o) for o in control['Offenders'] or []], control.get('OffendersLinks') or []))
+            control = dict(control)
+            control['Offenders'] = ["[new] " + o for o in change['new']] + \
+                ["[resolved] " + o for o in change['resolved']]
+            control['OffendersLinks'] = [links.get(o, '') for o in change['new']]
+            control['Description'] += " ({0} new, {1} resolved, {2} unchanged offenders since the previous run)".format(
+                len(change['new']), len(change['resolved']), change['unchanged'])
+            changed.append(control)
+        if changed:
+            sections.append(changed)
+    return sections
+
+
+# --- Delivery ---
+
+class DeliverySink(object):
+    """Independent consumer of completed results.
+
+    Sections are queued with put as the scan completes them, and render,
+    when given, turns each into output on the sink's own thread right away.
+    Once the sink is closed, deliver is called with all sections and their
+    rendered output, in order, so a slow sink does not hold up the others.
+    With DELIVERY_CONCURRENT disabled, sections are rendered as they are
+    put and close delivers on the calling thread.
+
+    Args:
+        name (str): Sink name used in messages
+        deliver (TYPE): Called with the list of sections and the list of rendered sections
+        render (TYPE): Called with one section, None to render nothing ahead
+    """
+
+    def __init__(self, name, deliver, render=None):
+        import queue
+        self.name = name
+        self.deliver = deliver
+        self.render = render
+        self.sections = []
+        self.rendered = []
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = None
+        if DELIVERY_CONCURRENT:
+            self.thread = threading.Thread(target=self._run, name="delivery-" + name)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def put(self, section):
+        self.queue.put(('section', section))
+        if self.thread is None and self.render is not None:
+            self._receive()
+
+    def close(self):
+        """Deliver once every queued section has been received."""
+        self.queue.put(('close', None))
+        if self.thread is None:
+            self._run()
+
+    def abort(self):
+        """Stop without delivering, for scans that continue in another invocation."""
+        self.queue.put(('abort', None))
+        if self.thread is None:
+            self._run()
+
+    def _run(self):
+        while self._receive():
+            pass
+
+    def _receive(self):
+        """Handle the next queued item, False once the sink is closed or aborted."""
+        kind, section = self.queue.get()
+        try:
+            if kind == 'section':
+                self.sections.append(section)
+                if self.render is not None and self.error is None:
+                    self.rendered.append(self.render(section))
+                return True
+            if kind == 'close' and self.error is None:
+                self.deliver(self.sections, self.rendered if self.render is not None else None)
+        except Exception as e:
+            with _OUTPUT_LOCK:
+                print("Delivery to " + self.name + " failed: " + str(e))
+            self.error = e
+        return False
+
+    def wait(self):
+        """Wait for the delivery to finish and raise its error, if any."""
+        if self.thread is not None:
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def finish_delivery(sinks):
+    """Wait for every sink, then raise the first delivery error."""
+    errors = []
+    for sink in sinks:
+        try:
+            sink.wait()
+        except Exception as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+# --- Checkpoints ---
+
+def remaining_time_ms(context):
+    """Milliseconds left before the Lambda times out, None when not running in Lambda.
+
+    Args:
+        context (TYPE): Lambda context object
+
+    Returns:
+        int: Remaining time or None
+    """
+    try:
+        return context.get_remaining_time_in_millis()
+    except AttributeError:
+        return None
+
+
+def save_document(location, prefix, name, document):
+    """Write a JSON document to the report bucket or to a local directory.
+
+    Args:
+        location (str): "s3" for the report bucket, otherwise a local directory
+        prefix (str): Key prefix used in S3
+        name (str): File name
+        document (dict): JSON serializable apart from datetimes
+
+    Returns:
+        str: s3:// URL or local path of the document
+    """
+    body = json.dumps(document, default=str)
+    if location == "s3":
+        aws_client('s3').put_object(Bucket=output_bucket,
+            Key=prefix + name,
+            Body=body.encode('utf-8'),
+            ContentType='application/json'
+        )
+        return "s3://" + output_bucket + "/" + prefix + name
+    path = os.path.join(location, name)
+    with open(path, 'w') as f:
+        f.write(body)
+    return path
+
+
+def load_document(token):
+    """Read a JSON document written by save_document.
+
+    Args:
+        token (str): s3:// URL or local path
+
+    Returns:
+        dict: The document
+    """
+    if token.startswith("s3://"):
+        bucket, key = token[len("s3://"):].split("/", 1)
+        response = aws_client('s3').get_object(Bucket=bucket, Key=key)
+        return json.loads(response['Body'].read().decode('utf-8'))
+    with open(token) as f:
+        return json.load(f)
+
+
+def save_checkpoint(state):
+    """Persist scan progress to S3 or to a local directory.
+
+    Args:
+        state (dict): Scan state, must be JSON serializable apart from datetimes
+
+    Returns:
+        str: Continuation token identifying the checkpoint
+    """
+    name = "aws_cloud_wellness_checkpoint_" + state['scanId'] + ".json"
+    return save_document(CHECKPOINT_LOCATION, CHECKPOINT_PREFIX, name, state)
+
+
+def load_checkpoint(token):
+    """Read scan progress written by save_checkpoint.
+
+    Args:
+        token (str): Continuation token
+
+    Returns:
+        dict: Scan state
+    """
+    return load_document(token)
+
+
+def delete_checkpoint(token):
+    """Remove a checkpoint once the scan it belongs to has completed.
+
+    Args:
+        token (str): Continuation token
+    """
+    try:
+        if token.startswith("s3://"):
+            bucket, key = token[len("s3://"):].split("/", 1)
+            aws_client('s3').delete_object(Bucket=bucket, Key=key)
+        else:
+            os.remove(token)
+    except Exception as e:
+        print("Could not remove checkpoint " + token + ": " + str(e))
+
+
+def continue_scan(state, context):
+    """Checkpoint an unfinished scan and hand it over to a new invocation.
+
+    Args:
+        state (dict): Scan state
+        context (TYPE): Lambda context object
+
+    Returns:
+        dict: Continuation token and progress, also the Lambda return value
+    """
+    state['hops'] = state.get('hops', 0) + 1
+    token = save_checkpoint(state)
+    done = len(state['results'])
+    print("Approaching Lambda timeout, checkpointed {0} of {1} controls to {2}".format(done, len(CONTROLS), token))
+    response = {'continuationToken': token, 'completedControls': done, 'totalControls': len(CONTROLS),
+                'hops': state['hops']}
+    if state['hops'] > CHECKPOINT_MAX_HOPS:
+        print("Scan {0} was continued {1} times, not invoking the function again".format(state['scanId'],
+                                                                                       CHECKPOINT_MAX_HOPS))
+    elif CHECKPOINT_REINVOKE:
+        aws_client('lambda').invoke(FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps({'continuationToken': token})
+        )
+        response['reinvoked'] = True
+    return response
+
+
 def lambda_handler(event, context):
     """Summary
 
@@ -2687,13 +5159,27 @@ def lambda_handler(event, context):
         context (TYPE): Description
 
     Returns:
-        TYPE: Description
+        TYPE: None when the scan completed, otherwise a dict with a continuationToken
     """
     # Run all control validations.
     # The control object is a dictionary with the value
     # result : Boolean - True/False
     # failReason : String - Failure description
     # scored : Boolean - True/False
+
+    # Checkpoint once a fraction of the time this invocation started with is left
+    remaining = remaining_time_ms(context)
+    margin = remaining * CHECKPOINT_MARGIN_FRACTION if remaining is not None else None
+
+    # Resume a scan that an earlier invocation checkpointed before timing out
+    resumeToken = None
+    state = None
+    if isinstance(event, dict) and event.get('continuationToken'):
+        resumeToken = event['continuationToken']
+        state = load_checkpoint(resumeToken)
+        event = state['event']
+        print("Resuming scan {0}, {1} controls already evaluated...".format(state['scanId'], len(state['results'])))
+
     # Check if the script is initiade from AWS Config Rules
     try:
         if event['configRuleId']:
@@ -2703,124 +5189,155 @@ def lambda_handler(event, context):
     except:
         configRule = False
 
-
-    # Globally used resources
+    if state is None:
+        import uuid
+        state = {'scanId': uuid.uuid4().hex, 'event': event, 'inventory': {}, 'results': {},
+                 'startedAt': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')}
+    inventory = state['inventory']
+    markers = state.setdefault('markers', {})
+    results = state['results']
+    _BREAKER.reset()
+    _GUARD.reset()
+    _TRANSPORT.reset()
+
+    # Results are delivered by independent sinks, fed with each section as it completes
+    shared = {}
+
+    def deliver_console(sections, rendered):
+        if OUTPUT_FORMAT == "ndjson":
+            write_ndjson({'type': 'summary', 'scanId': state['scanId'], 'account': shared['accountNumber'],
+                          'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                          'failed': json.loads(shortAnnotation(sections))['Failed'],
+                          'transport': _TRANSPORT.summary(), 'memo': memo_cache().summary()})
+        elif SCRIPT_OUTPUT_JSON and DIFF_MODE:
+            with _OUTPUT_LOCK:
+                print(json.dumps({'baseline': shared['baseline']['scanId'] if shared['baseline'] else None,
+                                  'changes': shared['delta']}, sort_keys=True, indent=4, separators=(',', ': ')))
+        elif SCRIPT_OUTPUT_JSON:
+            json_output(sections, rendered)
+
+    def deliver_report(sections, rendered):
+        # Create HTML report file if enabled
+        reportControls = shared['reportControls']
+        if S3_WEB_REPORT and reportControls:
+            htmlReport = json2html(reportControls, shared['accountNumber'], None if DIFF_MODE else rendered)
+            if S3_WEB_REPORT_OBFUSCATE_ACCOUNT:
+                htmlReport = obfuscate_account_numbers(htmlReport)
+            signedURL = s3report(htmlReport, shared['accountNumber'])
+            if OUTPUT_ONLY_JSON is False:
+                with _OUTPUT_LOCK:
+                    print("SignedURL:\n" + signedURL)
+            if SEND_REPORT_URL_TO_SNS is True:
+                send_results_to_sns(signedURL)
+
+    def deliver_config(sections, rendered):
+        # Report back to Config if we detected that the script is initiated from Config Rules
+        set_evaluation(invokingEvent, event, sections, inventory)
+
+    configSink = DeliverySink("config", deliver_config) if configRule else None
+    # Sections are rendered as they complete, unless only the changes since the previous run are reported
+    consoleRender = json_section if SCRIPT_OUTPUT_JSON and OUTPUT_FORMAT != "ndjson" and not DIFF_MODE else None
+    reportRender = report_section if S3_WEB_REPORT and not DIFF_MODE else None
+    sinks = [sink for sink in (DeliverySink("console", deliver_console, consoleRender),
+                               DeliverySink("report", deliver_report, reportRender),
+                               configSink) if sink is not None]
+
+    # Globally used resources are retrieved as the controls need them.
     print("Retrieving global resources...")
-    region_list = get_regions()
-    cred_report = get_cred_report()
-    password_policy = get_account_password_policy()
-    cloud_trails = get_cloudtrails(region_list)
-    events_rules = get_events_rules(region_list)
-    accountNumber = get_account_number()
-
-    # Run individual controls.
-    # Comment out unwanted controls
-    print("Evaluating IAM controls...")
-    control1 = []
-    control1.append(control_1_1_root_use(cred_report))
-    control1.append(control_1_2_mfa_on_password_enabled_iam(cred_report))
-    control1.append(control_1_3_unused_credentials(cred_report))
-    control1.append(control_1_4_rotated_keys(cred_report))
-    control1.append(control_1_5_password_policy_uppercase(password_policy))
-    control1.append(control_1_6_password_policy_lowercase(password_policy))
-    control1.append(control_1_7_password_policy_symbol(password_policy))
-    control1.append(control_1_8_password_policy_number(password_policy))
-    control1.append(control_1_9_password_policy_length(password_policy))
-    control1.append(control_1_10_password_policy_reuse(password_policy))
-    control1.append(control_1_11_password_policy_expire(password_policy))
-    control1.append(control_1_12_root_key_exists(cred_report))
-    control1.append(control_1_13_root_mfa_enabled())
-    control1.append(control_1_14_root_hardware_mfa_enabled())
-    control1.append(control_1_15_security_questions_registered())
-    control1.append(control_1_16_no_policies_on_iam_users())
-    control1.append(control_1_17_detailed_billing_enabled())
-    control1.append(control_1_18_ensure_iam_master_and_manager_roles())
-    control1.append(control_1_19_maintain_current_contact_details())
-    control1.append(control_1_20_ensure_security_contact_details())
-    control1.append(control_1_21_ensure_iam_instance_roles_used())
-    control1.append(control_1_22_ensure_incident_management_roles())
-    control1.append(control_1_23_no_active_initial_access_keys_with_iam_user(cred_report))
-    control1.append(control_1_24_no_overly_permissive_policies())
-
-    print("Evaluating logging controls...")
-    control2 = []
-    control2.append(control_2_1_ensure_cloud_trail_all_regions(cloud_trails))
-    control2.append(control_2_2_ensure_cloudtrail_validation(cloud_trails))
-    control2.append(control_2_3_ensure_cloudtrail_bucket_not_public(cloud_trails))
-    control2.append(control_2_4_ensure_cloudtrail_cloudwatch_logs_integration(cloud_trails))
-    control2.append(control_2_5_ensure_config_all_regions(region_list))
-    control2.append(control_2_6_ensure_cloudtrail_bucket_logging(cloud_trails))
-    control2.append(control_2_7_ensure_cloudtrail_encryption_kms(cloud_trails))
-    control2.append(control_2_8_ensure_kms_cmk_rotation(region_list))
-
-    print("Evaluating monitoring controls...")
-    control3 = []
-    control3.append(control_3_1_ensure_log_metric_filter_unauthorized_api_calls(cloud_trails))
-    control3.append(control_3_2_ensure_log_metric_filter_console_signin_no_mfa(cloud_trails))
-    control3.append(control_3_3_ensure_log_metric_filter_root_usage(cloud_trails))
-    control3.append(control_3_4_ensure_log_metric_iam_policy_change(cloud_trails))
-    control3.append(control_3_5_ensure_log_metric_cloudtrail_configuration_changes(cloud_trails))
-    control3.append(control_3_6_ensure_log_metric_console_auth_failures(cloud_trails))
-    control3.append(control_3_7_ensure_log_metric_disabling_scheduled_delete_of_kms_cmk(cloud_trails))
-    control3.append(control_3_8_ensure_log_metric_s3_bucket_policy_changes(cloud_trails))
-    control3.append(control_3_9_ensure_log_metric_config_configuration_changes(cloud_trails))
-    control3.append(control_3_10_ensure_log_metric_security_group_changes(cloud_trails))
-    control3.append(control_3_11_ensure_log_metric_nacl(cloud_trails))
-    control3.append(control_3_12_ensure_log_metric_changes_to_network_gateways(cloud_trails))
-    control3.append(control_3_13_ensure_log_metric_changes_to_route_tables(cloud_trails))
-    control3.append(control_3_14_ensure_log_metric_changes_to_vpc(cloud_trails))
-    control3.append(control_3_15_verify_sns_subscribers())
-    control3.append(control_3_16_ensure_log_metric_changes_to_organizations(cloud_trails))
-
-    print("Evaluating network controls...")
-    control4 = []
-    control4.append(control_4_1_ensure_ssh_not_open_to_world(region_list))
-    control4.append(control_4_2_ensure_rdp_not_open_to_world(region_list))
-    control4.append(control_4_3_ensure_flow_logs_enabled_on_all_vpc(region_list))
-    control4.append(control_4_4_ensure_default_security_groups_restricts_traffic(region_list))
-    control4.append(control_4_5_ensure_route_tables_are_least_access(region_list))
-
-    print("Evaluating custom controls...")
-    control_custom = []
-    control_custom.append(custom_control1_ensure_guardduty_is_enabled(region_list, events_rules))
-    control_custom.append(custom_control1_ensure_inspector_is_enabled(region_list))
-    control_custom.append(custom_control1_ensure_macie_is_enabled(region_list))
-
-    # Join results
-    controls = []
-    controls.append(control1)
-    controls.append(control2)
-    controls.append(control3)
-    controls.append(control4)
-    controls.append(control_custom)
-
-    # Build JSON structure for console output if enabled
-    if SCRIPT_OUTPUT_JSON:
-        json_output(controls)
-
-    # Create HTML report file if enabled
-    if S3_WEB_REPORT:
-        htmlReport = json2html(controls, accountNumber)
-        if S3_WEB_REPORT_OBFUSCATE_ACCOUNT:
-            for n, _ in enumerate(htmlReport):
-                htmlReport[n] = re.sub(r"\d{12}", "xxxxxxxxxxxx", htmlReport[n])
-        signedURL = s3report(htmlReport, accountNumber)
-        if OUTPUT_ONLY_JSON is False:
-            print("SignedURL:\n" + signedURL)
-        if SEND_REPORT_URL_TO_SNS is True:
-            send_results_to_sns(signedURL)
-
-    # Report back to Config if we detected that the script is initiated from Config Rules
-    if configRule:
-        evalAnnotation = shortAnnotation(controls)
-        set_evaluation(invokingEvent, event, evalAnnotation)
+    section = None
+    pending = [section_id for section_id, _, _ in CONTROLS]
+    evaluated = 0
+    try:
+        for section_id, name, arguments in CONTROLS:
+            if name not in results:
+                remaining = remaining_time_ms(context)
+                if CHECKPOINT_ENABLED and evaluated and remaining is not None and remaining < margin:
+                    for sink in sinks:
+                        sink.abort()
+                    return continue_scan(state, context)
+                if section_id != section:
+                    print("Evaluating " + CONTROL_LABEL_MAP[section_id] + " controls...")
+                    section = section_id
+                values = [collect_inventory(n, inventory, markers) for n in arguments]
+                scope = merge_markers([markers.get(n, {}) for n in arguments])
+                if scope.get('IncompleteRegions') and "regions" in arguments:
+                    # Regions missing from the inventory are not evaluated, rather than judged on absent data
+                    i = arguments.index("regions")
+                    values[i] = [n for n in values[i] if n not in scope['IncompleteRegions']]
+                mark = _BREAKER.mark()
+                guardMark = _GUARD.mark()
+                results[name] = globals()[name](*values)
+                evaluated += 1
+                # Shared inventory items pass their markers on to every control that evaluates them
+                results[name].update(merge_markers([{'SkippedScope': _BREAKER.skipped_since(mark),
+                                                     'IncompleteRegions': _GUARD.incomplete_since(guardMark)},
+                                                    scope]))
+                # A control that could not evaluate every region does not pass
+                if results[name].get('IncompleteRegions') and results[name]['Result']:
+                    results[name]['Result'] = False
+                    results[name]['failReason'] = "Not evaluated in " + ", ".join(results[name]['IncompleteRegions'])
+                if OUTPUT_FORMAT == "ndjson":
+                    ndjson_control(results[name], collect_inventory("account_number", inventory), state['scanId'])
+            pending.remove(section_id)
+            if section_id not in pending:
+                for sink in sinks:
+                    sink.put([results[n] for s, n, _ in CONTROLS if s == section_id])
+        accountNumber = collect_inventory("account_number", inventory)
+        shared['accountNumber'] = accountNumber
+
+        # Config does not wait for the findings store, the baseline or the other sinks
+        if configSink is not None:
+            configSink.close()
+
+        # Join results
+        controls = group_results(results)
+        if resumeToken:
+            delete_checkpoint(resumeToken)
+
+        # Keep history of results and offenders if enabled
+        if FINDINGS_DB:
+            store_findings(controls, accountNumber, state['scanId'], state['startedAt'], FINDINGS_DB)
+
+        # Only report what changed since the previous run if enabled
+        reportControls = controls
+        baseline = delta = None
+        if DIFF_MODE:
+            baseline = load_baseline(accountNumber)
+            delta = diff_results(baseline, controls)
+            reportControls = delta_controls(controls, delta)
+            if not reportControls:
+                print("No changes since the previous run" + (" (" + baseline['scanId'] + ")" if baseline else ""))
+        shared.update({'baseline': baseline, 'delta': delta, 'reportControls': reportControls})
+
+        for sink in sinks:
+            if sink is not configSink:
+                sink.close()
+    except BaseException:
+        for sink in sinks:
+            sink.abort()
+        raise
+    finish_delivery(sinks)
+
+    # The next run compares with these results only once they have been delivered
+    if DIFF_MODE:
+        save_baseline(accountNumber, controls, state['scanId'])
+    if OUTPUT_ONLY_JSON is False and OUTPUT_FORMAT != "ndjson":
+        transport = _TRANSPORT.summary()
+        print("AWS requests: {0}, new connections: {1}, connection reuse: {2:.0%}".format(
+            transport['requests'], transport['newConnections'], transport['connectionReuse']))
+        memo = memo_cache().summary()
+        print("Reused inputs: " + (", ".join("{0} {1}/{2}".format(name, counts.get('hits', 0),
+                                                                  counts.get('hits', 0) + counts.get('misses', 0))
+                                             for name, counts in memo['inputs'].items()) or "none"))
 
 
 if __name__ == '__main__':
+    import getopt
+    import boto3
     profile_name = ''
     try:
         opts, args = getopt.getopt(sys.argv[1:], "p:h:ob:pr", [
-                                   "profile=", "help", "output-bucket="])
+                                   "profile=", "help", "output-bucket=", "output=", "ndjson-per-offender", "findings-db=", "diff"])
 
     except getopt.GetoptError:
         print("Error: Illegal option\n")
@@ -2842,12 +5359,37 @@ if __name__ == '__main__':
             print("     -p, --profile <profile>")
             print("         specify a specific profile\n")
             print("     -ob, --output-bucket <bucket-name>")
-            print("         specify an S3 bucket to store the HTML report")
+            print("         specify an S3 bucket to store the HTML report\n")
+            print("     --output <json|ndjson>")
+            print("         ndjson writes one JSON line per control to stdout as it completes;")
+            print("         all other messages go to stderr\n")
+            print("     --ndjson-per-offender")
+            print("         with --output ndjson, also write one line per offender\n")
+            print("     --findings-db <path>")
+            print("         record results and offender history in a SQLite database\n")
+            print("     --diff")
+            print("         only report changes since the previous run")
             sys.exit()
         elif opt in ("-p", "--profile"):
             profile_name = arg
         elif opt in ("-ob", "--output-bucket"):
             output_bucket = arg
+        elif opt == "--output":
+            if arg not in ("json", "ndjson"):
+                print("Error: --output must be json or ndjson")
+                sys.exit(2)
+            OUTPUT_FORMAT = arg
+        elif opt == "--ndjson-per-offender":
+            NDJSON_PER_OFFENDER = True
+        elif opt == "--findings-db":
+            FINDINGS_DB = arg
+        elif opt == "--diff":
+            DIFF_MODE = True
+
+    # Keep stdout for NDJSON lines only
+    if OUTPUT_FORMAT == "ndjson":
+        ndjson_stream = sys.stdout
+        sys.stdout = sys.stderr
 
     print("")
 
@@ -2857,9 +5399,8 @@ if __name__ == '__main__':
             print("Using profile: {}".format(profile_name))
 
             boto3.setup_default_session(profile_name=profile_name)
-            # Update globals with new profile
-            IAM_CLIENT = boto3.client('iam')
-            S3_CLIENT = boto3.client('s3')
+            # Clients created from now on use the new profile
+            _CLIENTS.clear()
         except Exception as e:
             if "could not be found" in str(e):
                 print("Error: " + str(e))
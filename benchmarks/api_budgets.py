@@ -0,0 +1,254 @@
+"""API-call budget regression check per control.
+
+Runs ``lambda_handler`` against ``FakeAWS`` at two account sizes, counts
+the AWS calls made by every control and collector, and compares each
+count with the budget declared in ``BUDGETS``. A budget is a sum of terms
+evaluated against the account size, for example::
+
+    per('regions', 3)            # 3 calls per region
+    pages('users', 1000)         # one page per 1,000 users
+    calls(0)                     # no calls at all
+
+Because the limit is checked at both sizes, a change that reintroduces an
+N+1 pattern (say a per-user lookup) exceeds the budget on the larger
+account and fails. Controls or collectors without a declared budget fail
+too, so new code has to state its API-call complexity.
+
+    python benchmarks/api_budgets.py          # exit status 1 on violations
+"""
+
+from __future__ import print_function
+
+import collections
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_aws  # noqa: E402
+import harness  # noqa: E402
+import scenarios  # noqa: E402
+
+
+# The two account sizes every budget is checked at.
+SIZES = {
+    'small': dict(users=150, security_groups=80, kms_keys=40, regions=3, trails=4),
+    'large': dict(users=3000, security_groups=1500, kms_keys=600, regions=12, trails=24),
+}
+
+
+class Budget(object):
+    """Upper bound on API calls, linear in counts taken from the account.
+
+    Args:
+        terms (list): ``(calls, count name or None, items per unit)``
+            tuples; a term adds ``calls * ceil(count / items per unit)``.
+    """
+
+    def __init__(self, terms):
+        self.terms = list(terms)
+
+    def __add__(self, other):
+        return Budget(self.terms + other.terms)
+
+    def limit(self, counts):
+        total = 0
+        for n, key, per_unit in self.terms:
+            total += n if key is None else n * int(math.ceil(counts[key] / float(per_unit)))
+        return total
+
+    def __str__(self):
+        parts = []
+        for n, key, per_unit in self.terms:
+            if key is None:
+                parts.append('{0}'.format(n) if n else 'none')
+            elif per_unit == 1:
+                parts.append('{0}/{1}'.format(n, key.rstrip('s')))
+            else:
+                parts.append('{0}/{1:,} {2}'.format(n, per_unit, key))
+        return ' + '.join(parts)
+
+
+def calls(n):
+    """A fixed number of calls, independent of account size."""
+    return Budget([(n, None, 1)])
+
+
+def per(key, n=1):
+    """``n`` calls per counted item, e.g. ``per('regions', 3)``."""
+    return Budget([(n, key, 1)])
+
+
+def pages(key, page_size, n=1):
+    """``n`` calls per page of ``page_size`` counted items."""
+    return Budget([(n, key, page_size)])
+
+
+# Declared budgets, keyed by ControlId for controls and by function name
+# for collectors and delivery functions.
+BUDGETS = {
+    # Collectors
+    'get_regions': calls(1),
+    'get_cred_report': calls(2),
+    'get_account_password_policy': calls(1),
+    'get_iam_authorization_details': pages('iam_entities', 1000),
+    'get_cloudtrails': pages('trails', 50) + per('regions') + per('trails', 2) + per('log_group_trails'),
+    'get_events_rules': per('regions'),
+    'get_security_services': per('regions', 4),
+    'get_config_posture': per('regions', 3),
+    'get_account_number': calls(1),
+    'get_trail_buckets': per('trail_buckets', 5),
+    'get_security_group_rules': per('regions') + pages('security_groups', 1000),
+    'get_port_exposure': calls(0),
+    'get_vpcs': per('regions') + pages('vpcs', 1000),
+    'get_flow_log_coverage': per('regions') + pages('vpcs', 200),
+    'get_route_analysis': per('regions', 2),
+    # 1.x work from the credential report and authorization details: no per-user calls
+    '1.1': calls(0), '1.2': calls(0), '1.3': calls(0), '1.4': calls(0),
+    '1.5': calls(0), '1.6': calls(0), '1.7': calls(0), '1.8': calls(0),
+    '1.9': calls(0), '1.10': calls(0), '1.11': calls(0), '1.12': calls(0),
+    '1.13': calls(1),
+    '1.14': calls(1) + pages('mfa_devices', 100),
+    '1.15': calls(0),
+    '1.16': calls(0),
+    '1.17': calls(0), '1.18': calls(0), '1.19': calls(0), '1.20': calls(0),
+    '1.21': calls(1),
+    '1.22': calls(1),
+    '1.23': calls(0),
+    '1.24': calls(0),
+    # 2.x
+    '2.1': calls(0),
+    '2.2': calls(0),
+    '2.3': calls(0),
+    '2.4': calls(0),
+    '2.5': calls(0),
+    '2.6': calls(0),
+    '2.7': calls(0),
+    # 2.8: keys and aliases are listed per region; rotation status is the one per-key call
+    '2.8': per('regions', 2) + pages('kms_keys', 100, 2) + per('kms_keys'),
+    # 3.x: metric filters come from the trail catalog; alarm and topic for each match
+    '3.1': per('log_group_trails', 2),
+    '3.2': per('log_group_trails', 2),
+    '3.3': per('log_group_trails', 2),
+    '3.4': per('log_group_trails', 2),
+    '3.5': per('log_group_trails', 2),
+    '3.6': per('log_group_trails', 2),
+    '3.7': per('log_group_trails', 2),
+    '3.8': per('log_group_trails', 2),
+    '3.9': per('log_group_trails', 2),
+    '3.10': per('log_group_trails', 2),
+    '3.11': per('log_group_trails', 2),
+    '3.12': per('log_group_trails', 2),
+    '3.13': per('log_group_trails', 2),
+    '3.14': per('log_group_trails', 2),
+    '3.15': calls(0),
+    '3.16': per('log_group_trails', 2),
+    # 4.x: O(regions), independent of the number of groups, VPCs or routes;
+    # 4.1, 4.2 and 4.4 read the shared security group rule index
+    '4.1': calls(0),
+    '4.2': calls(0),
+    '4.3': calls(0),
+    '4.4': calls(0),
+    '4.5': calls(0),
+    # Custom controls
+    '5.1': calls(0),
+    '5.2': calls(0),
+    '5.3': calls(0),
+    '5.4': calls(0),
+    # Delivery
+    'json_output': calls(0),
+    'json2html': calls(0),
+    's3report': calls(2),
+    'send_results_to_sns': calls(1),
+    # NON_COMPLIANT resources, and the rule's earlier NON_COMPLIANT resources read back
+    'set_evaluation': calls(1) + pages('config_resources', 100, 2),
+}
+
+
+def account_counts(account):
+    """Counts the budgets are expressed in, taken from the account model."""
+    trails = account['trails']
+    return {
+        'regions': len(account['regions']),
+        'users': len(account['users']),
+        'iam_entities': len(account['users']) + len(account['policies']),
+        'mfa_devices': len(account['virtual_mfa_devices']),
+        'vpcs': sum(len(v) for v in account['vpcs'].values()),
+        'security_groups': sum(len(v) for v in account['security_groups'].values()),
+        'kms_keys': sum(len(v) for v in account['kms_keys'].values()),
+        'trails': len(trails),
+        'trail_buckets': len(set(t['S3BucketName'] for t in trails if t.get('S3BucketName'))),
+        'multi_region_trails': len([t for t in trails if t['IsMultiRegionTrail']]),
+        'log_group_trails': len([t for t in trails if 'CloudWatchLogsLogGroupArn' in t]),
+        # Resources set_evaluation may report to Config individually
+        'config_resources': (len(account['users']) + len(account['policies']) + len(trails) +
+                             sum(len(v) for v in account['vpcs'].values()) * 2 +
+                             sum(len(v) for v in account['security_groups'].values()) +
+                             sum(len(v) for v in account['kms_keys'].values()) +
+                             sum(len(r['Instances']) for v in account['instances'].values() for r in v)),
+    }
+
+
+def check(sizes=None, budgets=None, settings=None):
+    """Run every size and compare call counts with ``budgets``.
+
+    Returns:
+        list: ``(size name, key, calls, limit, budget)`` rows, and a list of
+        violation messages.
+    """
+    budgets = BUDGETS if budgets is None else budgets
+    rows = []
+    violations = []
+    for size_name, size in sorted((sizes or SIZES).items()):
+        account = scenarios.build_account(**size)
+        counts = account_counts(account)
+        fake = fake_aws.FakeAWS(account)
+        # Sinks deliver one after another so each call is attributed to the sink that made it
+        result = harness.run(fake, config_rule=True, settings=dict({'SEND_REPORT_URL_TO_SNS': True,
+                                  'SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:123456789012:reports',
+                                  'DELIVERY_CONCURRENT': False,
+                                  'CONFIG_RESOURCE_EVALUATIONS': True}, **(settings or {})))
+        entries = result['entries']
+        for key, entry in entries.items():
+            made = sum(entry['calls'].values())
+            budget = budgets.get(key)
+            if budget is None:
+                violations.append('{0}: {1} has no declared budget ({2} calls)'.format(size_name, key, made))
+                continue
+            limit = budget.limit(counts)
+            rows.append((size_name, key, made, limit, budget))
+            if made > limit:
+                top = ', '.join('{0}.{1}={2}'.format(svc, op, n) for (svc, op, _), n in
+                                _by_operation(entry['calls']).most_common(3))
+                violations.append('{0}: {1} made {2} calls, budget {3} allows {4} ({5})'.format(
+                    size_name, key, made, budget, limit, top))
+        for key in budgets:
+            if key not in entries and key.split('.')[0].isdigit():
+                violations.append('{0}: control {1} did not run'.format(size_name, key))
+    return rows, violations
+
+
+def _by_operation(counter):
+    merged = {}
+    for (service, operation, _), n in counter.items():
+        merged[(service, operation, None)] = merged.get((service, operation, None), 0) + n
+    return collections.Counter(merged)
+
+
+def main():
+    rows, violations = check()
+    print('{0:<6} {1:<32} {2:>7} {3:>7}  {4}'.format('size', 'control / stage', 'calls', 'limit', 'budget'))
+    for size_name, key, made, limit, budget in rows:
+        print('{0:<6} {1:<32} {2:>7} {3:>7}  {4}'.format(size_name, key, made, limit, budget))
+    if violations:
+        print('\nAPI-call budget violations:')
+        for message in violations:
+            print('  ' + message)
+        return 1
+    print('\nAll controls within their API-call budgets.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
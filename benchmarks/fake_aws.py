@@ -0,0 +1,694 @@
+"""In-process stand-in for the AWS APIs used by aws-cloud-wellness.
+
+The fake replaces ``boto3.client`` while a benchmark or budget run is
+active. Every client it hands out serves responses from an account model
+built by ``scenarios.build_account`` and records each API call, so a run
+can be timed and its call volume inspected without touching a real
+account.
+
+Only the operations the script actually calls are implemented. Paging
+follows the real service conventions (``Marker``/``IsTruncated`` for IAM,
+``NextToken`` for EC2 and friends) so page counts are realistic.
+"""
+
+from __future__ import print_function
+
+import collections
+import contextlib
+import csv
+import io
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+# service -> operation -> handler(backend, region, **kwargs)
+HANDLERS = collections.defaultdict(dict)
+
+# service -> operation -> (input token, output token, limit key, truncated key, result keys, default page size)
+PAGING = {
+    'iam': {
+        'list_virtual_mfa_devices': ('Marker', 'Marker', 'MaxItems', 'IsTruncated', ('VirtualMFADevices',), 100),
+        'get_account_authorization_details': ('Marker', 'Marker', 'MaxItems', 'IsTruncated',
+                                              ('UserDetailList', 'Policies'), 100),
+    },
+    'kms': {
+        'list_keys': ('Marker', 'NextMarker', 'Limit', 'Truncated', ('Keys',), 100),
+        'list_aliases': ('Marker', 'NextMarker', 'Limit', 'Truncated', ('Aliases',), 100),
+    },
+    'cloudtrail': {
+        'list_trails': ('NextToken', 'NextToken', None, None, ('Trails',), 50),
+    },
+    'logs': {
+        'describe_metric_filters': ('nextToken', 'nextToken', 'limit', None, ('metricFilters',), 50),
+    },
+    'config': {
+        'get_compliance_details_by_config_rule': ('NextToken', 'NextToken', 'Limit', None, ('EvaluationResults',), 100),
+    },
+    'events': {
+        'list_rules': ('NextToken', 'NextToken', 'Limit', None, ('Rules',), 100),
+    },
+    'guardduty': {
+        'list_detectors': ('NextToken', 'NextToken', 'MaxResults', None, ('DetectorIds',), 50),
+    },
+    'inspector': {
+        'list_assessment_targets': ('nextToken', 'nextToken', 'maxResults', None, ('assessmentTargetArns',), 10),
+    },
+    'ec2': {
+        'describe_instances': ('NextToken', 'NextToken', 'MaxResults', None, ('Reservations',), None),
+        'describe_security_groups': ('NextToken', 'NextToken', 'MaxResults', None, ('SecurityGroups',), None),
+        'describe_flow_logs': ('NextToken', 'NextToken', 'MaxResults', None, ('FlowLogs',), None),
+        'describe_vpcs': ('NextToken', 'NextToken', 'MaxResults', None, ('Vpcs',), None),
+        'describe_route_tables': ('NextToken', 'NextToken', 'MaxResults', None, ('RouteTables',), None),
+        'describe_vpc_peering_connections': ('NextToken', 'NextToken', 'MaxResults', None,
+                                             ('VpcPeeringConnections',), None),
+    },
+}
+
+
+def handler(service, operation):
+    """Register a fake implementation of ``service.operation``."""
+    def register(fn):
+        HANDLERS[service][operation] = fn
+        return fn
+    return register
+
+
+def client_error(code, operation, message=''):
+    """Build the ``ClientError`` botocore would raise for ``code``."""
+    op_name = ''.join(part.capitalize() for part in operation.split('_'))
+    return ClientError({'Error': {'Code': code, 'Message': message or code}}, op_name)
+
+
+def page(items, kwargs, service, operation, result_key=None):
+    """Return one page of ``items`` following the operation's paging style.
+
+    ``items`` may hold ``(result key, item)`` pairs for operations that page
+    over several result lists at once; pass ``result_key=True`` for those.
+    """
+    in_token, out_token, limit_key, truncated_key, result_keys, default_size = PAGING[service][operation]
+    start = int(kwargs.get(in_token) or 0)
+    size = kwargs.get(limit_key) or default_size or len(items) or 1
+    chunk = items[start:start + size]
+    if result_key:
+        response = dict((key, []) for key in result_keys)
+        for key, item in chunk:
+            response[key].append(item)
+    else:
+        response = {result_keys[0]: chunk}
+    more = start + size < len(items)
+    if more:
+        response[out_token] = str(start + size)
+    if truncated_key:
+        response[truncated_key] = more
+    return response
+
+
+class FakePaginator(object):
+    """Minimal stand-in for ``botocore.paginate.Paginator``."""
+
+    def __init__(self, client, operation):
+        self._client = client
+        self._operation = operation
+
+    def paginate(self, **kwargs):
+        in_token, out_token, limit_key, _, _, _ = PAGING[self._client.service][self._operation]
+        config = kwargs.pop('PaginationConfig', {}) or {}
+        if config.get('PageSize'):
+            kwargs[limit_key] = config['PageSize']
+        while True:
+            response = getattr(self._client, self._operation)(**kwargs)
+            yield response
+            token = response.get(out_token)
+            if not token:
+                break
+            kwargs[in_token] = token
+
+
+# Client methods botocore implements locally, without an API call or call events.
+LOCAL_OPERATIONS = ('generate_presigned_url',)
+
+
+class FakeEvents(object):
+    """Minimal stand-in for botocore's hierarchical event emitter.
+
+    Emits ``before-call`` (a handler may raise to short-circuit the call) and
+    ``after-call`` with the parsed response or error, like botocore does.
+    """
+
+    def __init__(self):
+        self._handlers = []
+
+    def register(self, event_name, handler, **kwargs):
+        self._handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for prefix, handler in list(self._handlers):
+            if event_name == prefix or event_name.startswith(prefix + '.'):
+                handler(event_name=event_name, **kwargs)
+
+
+class FakeClient(object):
+    """Client for one service/region pair, dispatching to ``HANDLERS``."""
+
+    def __init__(self, backend, service, region):
+        self._backend = backend
+        self.service = service
+        self.region = region
+        self.meta = collections.namedtuple('Meta', 'region_name service_name events')(region, service, FakeEvents())
+
+    def get_paginator(self, operation):
+        if operation not in PAGING.get(self.service, {}):
+            raise NotImplementedError('{0}.{1} paginator'.format(self.service, operation))
+        return FakePaginator(self, operation)
+
+    def can_paginate(self, operation):
+        return operation in PAGING.get(self.service, {})
+
+    def __getattr__(self, operation):
+        if operation.startswith('_'):
+            raise AttributeError(operation)
+        fn = HANDLERS[self.service].get(operation)
+        if fn is None:
+            raise AttributeError('{0} has no fake operation {1}'.format(self.service, operation))
+
+        def call(*args, **kwargs):
+            if operation in LOCAL_OPERATIONS:
+                return self._backend.dispatch(self.service, self.region, operation, fn, args, kwargs)
+            event = '{0}.{1}'.format(self.service, ''.join(part.capitalize() for part in operation.split('_')))
+            self.meta.events.emit('before-call.' + event, params=kwargs)
+            try:
+                response = self._backend.dispatch(self.service, self.region, operation, fn, args, kwargs)
+            except ClientError as e:
+                self.meta.events.emit('after-call.' + event, parsed=e.response)
+                raise
+            self.meta.events.emit('after-call.' + event, parsed=response)
+            return response
+        call.__name__ = operation
+        return call
+
+
+class FakeAWS(object):
+    """Backend holding the account model, call log and latency settings.
+
+    Args:
+        account (dict): Account model from ``scenarios.build_account``.
+        latency (float): Seconds slept per API call.
+        latency_overrides (dict): Per service or ``service.operation``
+            latency in seconds, taking precedence over ``latency``.
+    """
+
+    def __init__(self, account, latency=0.0, latency_overrides=None):
+        self.account = account
+        self.latency = latency
+        self.latency_overrides = latency_overrides or {}
+        self.default_region = account['regions'][0]
+        self.calls = collections.Counter()
+        self.objects = {}
+        self.invocations = []
+        self.uploads = {}
+        self._lock = threading.Lock()
+
+    @property
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def snapshot(self):
+        """Return a copy of the call counter, keyed by (service, operation, region)."""
+        with self._lock:
+            return collections.Counter(self.calls)
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def client(self, service_name, region_name=None, **kwargs):
+        return FakeClient(self, service_name, region_name or self.default_region)
+
+    def dispatch(self, service, region, operation, fn, args, kwargs):
+        with self._lock:
+            self.calls[(service, operation, region)] += 1
+        delay = self.latency_overrides.get(
+            service + '.' + operation, self.latency_overrides.get(service, self.latency))
+        if delay:
+            time.sleep(delay)
+        return fn(self, region, *args, **kwargs)
+
+    @contextlib.contextmanager
+    def installed(self):
+        """Route ``boto3.client`` and ``boto3.setup_default_session`` to the fake."""
+        original_client = boto3.client
+        original_setup = boto3.setup_default_session
+        boto3.client = self.client
+        boto3.setup_default_session = lambda **kwargs: None
+        try:
+            yield self
+        finally:
+            boto3.client = original_client
+            boto3.setup_default_session = original_setup
+
+
+# --- IAM ---
+
+CRED_REPORT_FIELDS = [
+    'user', 'arn', 'user_creation_time', 'password_enabled', 'password_last_used',
+    'password_last_changed', 'password_next_rotation', 'mfa_active',
+    'access_key_1_active', 'access_key_1_last_rotated', 'access_key_1_last_used_date',
+    'access_key_1_last_used_region', 'access_key_1_last_used_service',
+    'access_key_2_active', 'access_key_2_last_rotated', 'access_key_2_last_used_date',
+    'access_key_2_last_used_region', 'access_key_2_last_used_service',
+    'cert_1_active', 'cert_1_last_rotated', 'cert_2_active', 'cert_2_last_rotated',
+]
+
+
+@handler('iam', 'generate_credential_report')
+def _generate_credential_report(backend, region):
+    return {'State': 'COMPLETE'}
+
+
+@handler('iam', 'get_credential_report')
+def _get_credential_report(backend, region):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=CRED_REPORT_FIELDS, lineterminator='\n')
+    writer.writeheader()
+    for row in backend.account['credential_report']:
+        writer.writerow(row)
+    return {'Content': buf.getvalue().encode('utf-8'), 'ReportFormat': 'text/csv'}
+
+
+@handler('iam', 'get_account_password_policy')
+def _get_account_password_policy(backend, region):
+    policy = backend.account['password_policy']
+    if policy is None:
+        raise client_error('NoSuchEntity', 'get_account_password_policy',
+                           'The Password Policy with domain name {0} cannot be found.'.format(backend.account['account_id']))
+    return {'PasswordPolicy': policy}
+
+
+@handler('iam', 'get_account_summary')
+def _get_account_summary(backend, region):
+    return {'SummaryMap': backend.account['account_summary']}
+
+
+@handler('iam', 'list_virtual_mfa_devices')
+def _list_virtual_mfa_devices(backend, region, **kwargs):
+    kwargs.pop('AssignmentStatus', None)
+    return page(backend.account['virtual_mfa_devices'], kwargs, 'iam', 'list_virtual_mfa_devices')
+
+
+@handler('iam', 'get_account_authorization_details')
+def _get_account_authorization_details(backend, region, Filter=None, **kwargs):
+    account = backend.account
+    items = []
+    if not Filter or 'User' in Filter:
+        for user in account['users']:
+            detail = dict(user)
+            detail['UserPolicyList'] = [{'PolicyName': name, 'PolicyDocument': {'Statement': []}}
+                                        for name in account['inline_user_policies'].get(user['UserName'], [])]
+            detail['AttachedManagedPolicies'] = []
+            items.append(('UserDetailList', detail))
+    if not Filter or 'LocalManagedPolicy' in Filter:
+        for policy in account['policies']:
+            detail = dict(policy)
+            detail['PolicyVersionList'] = [{'Document': account['policy_documents'][policy['Arn']],
+                                            'VersionId': policy['DefaultVersionId'], 'IsDefaultVersion': True}]
+            items.append(('Policies', detail))
+    return page(items, kwargs, 'iam', 'get_account_authorization_details', result_key=True)
+
+
+@handler('iam', 'list_entities_for_policy')
+def _list_entities_for_policy(backend, region, PolicyArn, **kwargs):
+    return {'PolicyGroups': [], 'PolicyUsers': [], 'PolicyRoles': backend.account['support_roles']}
+
+
+@handler('iam', 'get_role')
+def _get_role(backend, region, RoleName):
+    if RoleName not in backend.account['roles']:
+        raise client_error('NoSuchEntity', 'get_role', 'The role with name {0} cannot be found.'.format(RoleName))
+    return {'Role': {'RoleName': RoleName}}
+
+
+# --- STS ---
+
+@handler('sts', 'get_caller_identity')
+def _get_caller_identity(backend, region):
+    return {'Account': backend.account['account_id']}
+
+
+# --- EC2 ---
+
+def _regional(backend, key, region):
+    return backend.account[key].get(region, [])
+
+
+def _filtered(items, filters):
+    for flt in filters or []:
+        name, values = flt['Name'], flt['Values']
+        if name == 'group-name':
+            items = [i for i in items if i['GroupName'] in values]
+        elif name == 'state':
+            items = [i for i in items if i['State'] in values]
+        elif name == 'resource-id':
+            values = set(values)
+            items = [i for i in items if i['ResourceId'] in values]
+    return items
+
+
+@handler('ec2', 'describe_regions')
+def _describe_regions(backend, region, AllRegions=False, **kwargs):
+    regions = [{'RegionName': r, 'Endpoint': 'ec2.{0}.amazonaws.com'.format(r), 'OptInStatus': 'opt-in-not-required'}
+               for r in backend.account['regions']]
+    if AllRegions:
+        # Opt-in regions the account has not enabled
+        regions.extend({'RegionName': r, 'Endpoint': 'ec2.{0}.amazonaws.com'.format(r), 'OptInStatus': 'not-opted-in'}
+                       for r in ('af-south-1', 'me-south-1', 'il-central-1') if r not in backend.account['regions'])
+    return {'Regions': regions}
+
+
+@handler('ec2', 'describe_instances')
+def _describe_instances(backend, region, **kwargs):
+    return page(_regional(backend, 'instances', region), kwargs, 'ec2', 'describe_instances')
+
+
+@handler('ec2', 'describe_security_groups')
+def _describe_security_groups(backend, region, Filters=None, **kwargs):
+    groups = _filtered(_regional(backend, 'security_groups', region), Filters)
+    return page(groups, kwargs, 'ec2', 'describe_security_groups')
+
+
+@handler('ec2', 'describe_flow_logs')
+def _describe_flow_logs(backend, region, Filter=None, **kwargs):
+    return page(_filtered(_regional(backend, 'flow_logs', region), Filter), kwargs, 'ec2', 'describe_flow_logs')
+
+
+@handler('ec2', 'describe_vpcs')
+def _describe_vpcs(backend, region, Filters=None, **kwargs):
+    return page(_filtered(_regional(backend, 'vpcs', region), Filters), kwargs, 'ec2', 'describe_vpcs')
+
+
+@handler('ec2', 'describe_route_tables')
+def _describe_route_tables(backend, region, **kwargs):
+    return page(_regional(backend, 'route_tables', region), kwargs, 'ec2', 'describe_route_tables')
+
+
+@handler('ec2', 'describe_vpc_peering_connections')
+def _describe_vpc_peering_connections(backend, region, **kwargs):
+    return page(_regional(backend, 'peering_connections', region), kwargs, 'ec2', 'describe_vpc_peering_connections')
+
+
+# --- CloudTrail ---
+
+def _public_trail(trail):
+    return dict((k, v) for k, v in trail.items() if not k.startswith('_'))
+
+
+@handler('cloudtrail', 'list_trails')
+def _list_trails(backend, region, **kwargs):
+    trails = [{'TrailARN': t['TrailARN'], 'Name': t['Name'], 'HomeRegion': t['HomeRegion']}
+              for t in backend.account['trails']]
+    return page(trails, kwargs, 'cloudtrail', 'list_trails')
+
+
+@handler('cloudtrail', 'describe_trails')
+def _describe_trails(backend, region, trailNameList=None, includeShadowTrails=True):
+    trails = []
+    for trail in backend.account['trails']:
+        if trailNameList is not None:
+            if trail['TrailARN'] not in trailNameList and trail['Name'] not in trailNameList:
+                continue
+            if trail['HomeRegion'] != region and not (includeShadowTrails and trail['IsMultiRegionTrail']):
+                continue
+        elif not (trail['HomeRegion'] == region or (includeShadowTrails and trail['IsMultiRegionTrail'])):
+            continue
+        trails.append(_public_trail(trail))
+    return {'trailList': trails}
+
+
+def _find_trail(backend, name, operation):
+    for trail in backend.account['trails']:
+        if name in (trail['TrailARN'], trail['Name']):
+            return trail
+    raise client_error('TrailNotFoundException', operation)
+
+
+@handler('cloudtrail', 'get_trail_status')
+def _get_trail_status(backend, region, Name):
+    return {'IsLogging': _find_trail(backend, Name, 'get_trail_status')['_logging']}
+
+
+@handler('cloudtrail', 'get_event_selectors')
+def _get_event_selectors(backend, region, TrailName):
+    trail = _find_trail(backend, TrailName, 'get_event_selectors')
+    return {'TrailARN': trail['TrailARN'],
+            'EventSelectors': [{'ReadWriteType': 'All', 'IncludeManagementEvents': True, 'DataResources': []}]}
+
+
+# --- S3 ---
+
+def _bucket(backend, name, operation):
+    bucket = backend.account['buckets'].get(name)
+    if bucket is None:
+        raise client_error('NoSuchBucket', operation, 'The specified bucket does not exist')
+    if bucket.get('denied'):
+        raise client_error('AccessDenied', operation, 'Access Denied')
+    return bucket
+
+
+@handler('s3', 'get_bucket_acl')
+def _get_bucket_acl(backend, region, Bucket):
+    return {'Grants': _bucket(backend, Bucket, 'get_bucket_acl')['grants']}
+
+
+@handler('s3', 'get_bucket_logging')
+def _get_bucket_logging(backend, region, Bucket):
+    bucket = _bucket(backend, Bucket, 'get_bucket_logging')
+    if bucket['logging']:
+        return {'LoggingEnabled': {'TargetBucket': Bucket + '-logs', 'TargetPrefix': ''}}
+    return {}
+
+
+@handler('s3', 'get_bucket_location')
+def _get_bucket_location(backend, region, Bucket):
+    location = _bucket(backend, Bucket, 'get_bucket_location')['region']
+    return {'LocationConstraint': None if location == 'us-east-1' else location}
+
+
+@handler('s3', 'get_bucket_policy_status')
+def _get_bucket_policy_status(backend, region, Bucket):
+    bucket = _bucket(backend, Bucket, 'get_bucket_policy_status')
+    if 'policy_public' not in bucket:
+        raise client_error('NoSuchBucketPolicy', 'get_bucket_policy_status', 'The bucket policy does not exist')
+    return {'PolicyStatus': {'IsPublic': bucket['policy_public']}}
+
+
+@handler('s3', 'get_public_access_block')
+def _get_public_access_block(backend, region, Bucket):
+    bucket = _bucket(backend, Bucket, 'get_public_access_block')
+    if 'public_access_block' not in bucket:
+        raise client_error('NoSuchPublicAccessBlockConfiguration', 'get_public_access_block',
+                           'The public access block configuration was not found')
+    return {'PublicAccessBlockConfiguration': bucket['public_access_block']}
+
+
+@handler('s3', 'upload_file')
+def _upload_file(backend, region, Filename, Bucket, Key, ExtraArgs=None, **kwargs):
+    with open(Filename, 'rb') as f:
+        backend.objects[(Bucket, Key)] = {'Body': f.read(), 'ExtraArgs': ExtraArgs or {}}
+
+
+@handler('s3', 'put_object')
+def _put_object(backend, region, Bucket, Key, Body=b'', **kwargs):
+    if hasattr(Body, 'read'):
+        Body = Body.read()
+    backend.objects[(Bucket, Key)] = {'Body': Body, 'ExtraArgs': kwargs}
+    return {'ETag': '"fake"'}
+
+
+@handler('s3', 'create_multipart_upload')
+def _create_multipart_upload(backend, region, Bucket, Key, **kwargs):
+    upload_id = 'upload-{0}'.format(len(backend.uploads) + 1)
+    backend.uploads[upload_id] = {'Bucket': Bucket, 'Key': Key, 'ExtraArgs': kwargs, 'Parts': {}}
+    return {'UploadId': upload_id}
+
+
+@handler('s3', 'upload_part')
+def _upload_part(backend, region, Bucket, Key, UploadId, PartNumber, Body=b'', **kwargs):
+    if hasattr(Body, 'read'):
+        Body = Body.read()
+    backend.uploads[UploadId]['Parts'][PartNumber] = Body
+    return {'ETag': '"part-{0}"'.format(PartNumber)}
+
+
+@handler('s3', 'complete_multipart_upload')
+def _complete_multipart_upload(backend, region, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+    upload = backend.uploads.pop(UploadId)
+    body = b''.join(upload['Parts'][part['PartNumber']] for part in MultipartUpload['Parts'])
+    backend.objects[(Bucket, Key)] = {'Body': body, 'ExtraArgs': upload['ExtraArgs']}
+    return {'ETag': '"fake"'}
+
+
+@handler('s3', 'abort_multipart_upload')
+def _abort_multipart_upload(backend, region, Bucket, Key, UploadId, **kwargs):
+    backend.uploads.pop(UploadId, None)
+    return {}
+
+
+@handler('s3', 'get_object')
+def _get_object(backend, region, Bucket, Key, **kwargs):
+    if (Bucket, Key) not in backend.objects:
+        raise client_error('NoSuchKey', 'get_object', 'The specified key does not exist.')
+    return {'Body': io.BytesIO(backend.objects[(Bucket, Key)]['Body'])}
+
+
+@handler('s3', 'delete_object')
+def _delete_object(backend, region, Bucket, Key, **kwargs):
+    backend.objects.pop((Bucket, Key), None)
+    return {}
+
+
+@handler('s3', 'generate_presigned_url')
+def _generate_presigned_url(backend, region, ClientMethod, Params=None, ExpiresIn=3600, **kwargs):
+    return 'https://{0}.s3.amazonaws.com/{1}?X-Amz-Expires={2}'.format(Params['Bucket'], Params['Key'], ExpiresIn)
+
+
+# --- Config ---
+
+@handler('config', 'describe_configuration_recorder_status')
+def _describe_configuration_recorder_status(backend, region, **kwargs):
+    return {'ConfigurationRecordersStatus': backend.account['config'][region]['status']}
+
+
+@handler('config', 'describe_configuration_recorders')
+def _describe_configuration_recorders(backend, region, **kwargs):
+    return {'ConfigurationRecorders': backend.account['config'][region]['recorders']}
+
+
+@handler('config', 'describe_delivery_channel_status')
+def _describe_delivery_channel_status(backend, region, **kwargs):
+    return {'DeliveryChannelsStatus': backend.account['config'][region]['channels']}
+
+
+@handler('config', 'put_evaluations')
+def _put_evaluations(backend, region, Evaluations, ResultToken, **kwargs):
+    backend.account.setdefault('evaluations', []).extend(Evaluations)
+    return {'FailedEvaluations': []}
+
+
+@handler('config', 'get_compliance_details_by_config_rule')
+def _get_compliance_details_by_config_rule(backend, region, ConfigRuleName, ComplianceTypes=None, **kwargs):
+    latest = collections.OrderedDict()
+    for e in backend.account.get('evaluations', []):
+        latest[(e['ComplianceResourceType'], e['ComplianceResourceId'])] = e
+    results = [{'EvaluationResultIdentifier': {'EvaluationResultQualifier': {
+                    'ConfigRuleName': ConfigRuleName, 'ResourceType': e['ComplianceResourceType'],
+                    'ResourceId': e['ComplianceResourceId']}},
+                'ComplianceType': e['ComplianceType'], 'Annotation': e.get('Annotation')}
+               for e in latest.values() if not ComplianceTypes or e['ComplianceType'] in ComplianceTypes]
+    return page(results, kwargs, 'config', 'get_compliance_details_by_config_rule')
+
+
+# --- KMS ---
+
+def _kms_key(backend, region, key_id, operation):
+    for key in backend.account['kms_keys'].get(region, []):
+        if key_id in (key['KeyId'], key['KeyArn']):
+            if key.get('denied'):
+                # The key policy does not grant the scanning role access, as with ACM keys
+                raise client_error('AccessDeniedException', operation,
+                                   'User: arn:aws:sts::{0}:assumed-role/aws-cloud-wellness/scan is not authorized to '
+                                   'perform: kms:{1} on resource: {2} because no resource-based policy allows the '
+                                   'kms:{1} action'.format(backend.account['account_id'],
+                                                           ''.join(p.capitalize() for p in operation.split('_')),
+                                                           key['KeyArn']))
+            return key
+    raise client_error('NotFoundException', operation)
+
+
+@handler('kms', 'list_keys')
+def _list_keys(backend, region, **kwargs):
+    keys = [{'KeyId': k['KeyId'], 'KeyArn': k['KeyArn']} for k in backend.account['kms_keys'].get(region, [])]
+    return page(keys, kwargs, 'kms', 'list_keys')
+
+
+@handler('kms', 'list_aliases')
+def _list_aliases(backend, region, **kwargs):
+    aliases = [{'AliasName': ('alias/aws/managed-' if k['manager'] == 'AWS' else 'alias/app-') + k['KeyId'][:8],
+                'TargetKeyId': k['KeyId']} for k in backend.account['kms_keys'].get(region, [])]
+    return page(aliases, kwargs, 'kms', 'list_aliases')
+
+
+@handler('kms', 'get_key_rotation_status')
+def _get_key_rotation_status(backend, region, KeyId):
+    return {'KeyRotationEnabled': _kms_key(backend, region, KeyId, 'get_key_rotation_status')['rotation']}
+
+
+# --- CloudWatch Logs, CloudWatch and SNS ---
+
+@handler('logs', 'describe_metric_filters')
+def _describe_metric_filters(backend, region, logGroupName=None, **kwargs):
+    return page(backend.account['metric_filters'].get((region, logGroupName), []), kwargs,
+                'logs', 'describe_metric_filters')
+
+
+@handler('cloudwatch', 'describe_alarms_for_metric')
+def _describe_alarms_for_metric(backend, region, MetricName, Namespace, **kwargs):
+    return {'MetricAlarms': backend.account['alarms'].get((region, Namespace, MetricName), [])}
+
+
+@handler('sns', 'list_subscriptions_by_topic')
+def _list_subscriptions_by_topic(backend, region, TopicArn, **kwargs):
+    return {'Subscriptions': backend.account['topics'].get(TopicArn, [])}
+
+
+@handler('sns', 'publish')
+def _publish(backend, region, TopicArn, Message, **kwargs):
+    backend.account.setdefault('published', []).append({'TopicArn': TopicArn, 'Message': Message})
+    return {'MessageId': 'fake'}
+
+
+# --- Lambda ---
+
+@handler('lambda', 'invoke')
+def _invoke(backend, region, FunctionName, InvocationType='RequestResponse', Payload=b'', **kwargs):
+    # Recorded rather than run; the harness drives continuations itself.
+    backend.invocations.append({'FunctionName': FunctionName, 'InvocationType': InvocationType,
+                                'Payload': Payload})
+    return {'StatusCode': 202 if InvocationType == 'Event' else 200}
+
+
+# --- EventBridge, GuardDuty, Inspector and Macie ---
+
+@handler('events', 'list_rules')
+def _list_rules(backend, region, **kwargs):
+    return page(_regional(backend, 'events_rules', region), kwargs, 'events', 'list_rules')
+
+
+@handler('guardduty', 'list_detectors')
+def _list_detectors(backend, region, **kwargs):
+    ids = [d['DetectorId'] for d in _regional(backend, 'guardduty', region)]
+    return page(ids, kwargs, 'guardduty', 'list_detectors')
+
+
+@handler('guardduty', 'get_detector')
+def _get_detector(backend, region, DetectorId):
+    for detector in _regional(backend, 'guardduty', region):
+        if detector['DetectorId'] == DetectorId:
+            return {'Status': detector['Status']}
+    raise client_error('BadRequestException', 'get_detector')
+
+
+@handler('inspector', 'list_assessment_targets')
+def _list_assessment_targets(backend, region, **kwargs):
+    targets = [arn for arn in backend.account['inspector_targets'] if arn.split(':')[3] == region]
+    return page(targets, kwargs, 'inspector', 'list_assessment_targets')
+
+
+@handler('macie2', 'get_macie_session')
+def _get_macie_session(backend, region):
+    status = backend.account['macie'].get(region)
+    if status is None:
+        raise client_error('AccessDeniedException', 'get_macie_session', 'Macie is not enabled')
+    return {'status': status, 'findingPublishingFrequency': 'FIFTEEN_MINUTES'}
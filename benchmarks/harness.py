@@ -0,0 +1,151 @@
+"""Shared plumbing for driving ``lambda_handler`` against ``FakeAWS``.
+
+``run`` loads a fresh copy of ``aws-cloud-wellness.py`` with the fake
+installed, wraps the module's control, collector and delivery functions so
+each one records its wall time and the API calls made while it ran, and
+invokes ``lambda_handler``. When a simulated timeout makes the handler
+checkpoint, the run continues with the returned token until it completes.
+"""
+
+from __future__ import print_function
+
+import collections
+import contextlib
+import functools
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'aws-cloud-wellness.py')
+
+# Module-level functions that are timed individually.
+INSTRUMENTED_PREFIXES = ('control_', 'custom_control', 'get_')
+INSTRUMENTED_NAMES = ('json_output', 'json2html', 's3report', 'send_results_to_sns', 'set_evaluation')
+
+REPORT_BUCKET = 'benchmark-reports'
+
+
+def load_module(fake):
+    """Import a fresh, uncached copy of the script with ``fake`` installed."""
+    spec = importlib.util.spec_from_file_location('aws_cloud_wellness_bench', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    with fake.installed():
+        spec.loader.exec_module(module)
+    module.output_bucket = REPORT_BUCKET
+    return module
+
+
+class Recorder(object):
+    """Collects per-function wall time and API calls during a run.
+
+    Entries are keyed by ``ControlId`` for controls and by function name
+    for everything else. Nested instrumented calls are counted inclusively.
+    """
+
+    def __init__(self, fake):
+        self.fake = fake
+        self.entries = collections.OrderedDict()
+
+    def wrap(self, name, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            before = self.fake.snapshot()
+            start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            calls = self.fake.snapshot()
+            calls.subtract(before)
+            key = result['ControlId'] if isinstance(result, dict) and 'ControlId' in result else name
+            entry = self.entries.setdefault(key, {'function': name, 'seconds': 0.0, 'calls': collections.Counter()})
+            entry['seconds'] += elapsed
+            entry['calls'].update(dict((k, v) for k, v in calls.items() if v > 0))
+            return result
+        return timed
+
+    def instrument(self, module):
+        for name in dir(module):
+            fn = getattr(module, name)
+            if callable(fn) and getattr(fn, '__module__', None) == module.__name__ and (
+                    name.startswith(INSTRUMENTED_PREFIXES) or name in INSTRUMENTED_NAMES):
+                setattr(module, name, self.wrap(name, fn))
+
+
+def config_rule_event(account_id):
+    """Event shaped like an AWS Config periodic rule invocation."""
+    return {
+        'configRuleId': 'config-rule-benchmark',
+        'configRuleName': 'aws-cloud-wellness',
+        'invokingEvent': json.dumps({'notificationCreationTime': '2020-01-01T00:00:00.000Z',
+                                     'messageType': 'ScheduledNotification'}),
+        'resultToken': 'benchmark-token',
+        'accountId': account_id,
+    }
+
+
+class _FakeContext(object):
+    """Lambda context with a fixed deadline, for runs that need one."""
+
+    def __init__(self, timeout_ms):
+        self._deadline = time.time() + timeout_ms / 1000.0
+        self.function_name = 'aws-cloud-wellness'
+        self.invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:aws-cloud-wellness'
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.time()) * 1000))
+
+
+@contextlib.contextmanager
+def _quiet(enabled):
+    if not enabled:
+        yield
+        return
+    saved = sys.stdout
+    sys.stdout = io.StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = saved
+
+
+def run(fake, config_rule=False, quiet=True, settings=None, timeout_ms=None):
+    """Run ``lambda_handler`` against ``fake`` until the scan completes.
+
+    Args:
+        fake (FakeAWS): Backend to serve the run.
+        config_rule (bool): Invoke as an AWS Config rule.
+        quiet (bool): Discard the script's console output.
+        settings (dict): Module-level settings to override before the run.
+        timeout_ms (int): Lambda timeout to simulate per invocation; None
+            passes no context.
+
+    Returns:
+        dict: ``seconds`` (end to end), ``calls`` (Counter), ``entries``
+        (per-function records from ``Recorder``), ``report_bytes``
+        (size of the objects uploaded to S3) and ``invocations`` (handler
+        invocations needed to complete the scan).
+    """
+    module = load_module(fake)
+    for key, value in (settings or {}).items():
+        setattr(module, key, value)
+    recorder = Recorder(fake)
+    recorder.instrument(module)
+    event = config_rule_event(fake.account['account_id']) if config_rule else ''
+    fake.reset()
+    invocations = 0
+    with fake.installed(), _quiet(quiet):
+        start = time.perf_counter()
+        while True:
+            invocations += 1
+            context = _FakeContext(timeout_ms) if timeout_ms else ''
+            response = module.lambda_handler(event, context)
+            if not (isinstance(response, dict) and response.get('continuationToken')):
+                break
+            event = {'continuationToken': response['continuationToken']}
+        elapsed = time.perf_counter() - start
+    report_bytes = sum(len(obj['Body']) for obj in fake.objects.values())
+    return {'seconds': elapsed, 'calls': fake.snapshot(), 'entries': recorder.entries,
+            'report_bytes': report_bytes, 'invocations': invocations, 'module': module}
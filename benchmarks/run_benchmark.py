@@ -0,0 +1,111 @@
+"""Benchmark aws-cloud-wellness against a synthetic account.
+
+Examples:
+    python benchmarks/run_benchmark.py --scenario large
+    python benchmarks/run_benchmark.py --users 500 --regions 8 --latency-ms 20
+    python benchmarks/run_benchmark.py --scenario medium --latency-ms 30 --latency ec2=80 --json
+
+Reports the end-to-end runtime of ``lambda_handler`` and, per control and
+per collector, the wall time and number of API calls, so changes to
+concurrency and caching can be compared offline.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_aws  # noqa: E402
+import harness  # noqa: E402
+import scenarios  # noqa: E402
+
+
+def _latency_overrides(values):
+    overrides = {}
+    for value in values or []:
+        key, _, ms = value.partition('=')
+        overrides[key] = float(ms) / 1000.0
+    return overrides
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenario', choices=sorted(scenarios.SCENARIOS), default='small',
+                        help='named account size; explicit size options override it')
+    for option in ('users', 'security-groups', 'kms-keys', 'regions', 'trails'):
+        parser.add_argument('--' + option, type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='latency injected into every API call')
+    parser.add_argument('--latency', action='append', metavar='SERVICE[.OPERATION]=MS',
+                        help='per service or operation latency, may be repeated')
+    parser.add_argument('--repeat', type=int, default=1, help='runs to average')
+    parser.add_argument('--config-rule', action='store_true', help='invoke as an AWS Config rule')
+    parser.add_argument('--timeout-ms', type=int, help='simulate a Lambda context with this timeout')
+    parser.add_argument('--json', action='store_true', help='print machine readable results')
+    return parser.parse_args(argv)
+
+
+def size_from_args(args):
+    size = dict(scenarios.SCENARIOS[args.scenario])
+    for key in size:
+        value = getattr(args, key)
+        if value is not None:
+            size[key] = value
+    return size
+
+
+def summarize(runs):
+    """Average per-entry seconds and calls over ``runs``."""
+    entries = {}
+    for result in runs:
+        for key, entry in result['entries'].items():
+            agg = entries.setdefault(key, {'function': entry['function'], 'seconds': 0.0, 'calls': 0})
+            agg['seconds'] += entry['seconds'] / len(runs)
+            agg['calls'] += sum(entry['calls'].values()) / float(len(runs))
+    return {
+        'seconds': sum(r['seconds'] for r in runs) / len(runs),
+        'calls': sum(sum(r['calls'].values()) for r in runs) / float(len(runs)),
+        'report_bytes': runs[-1]['report_bytes'],
+        'invocations': runs[-1]['invocations'],
+        'entries': entries,
+    }
+
+
+def print_table(size, summary):
+    print('Account: ' + ', '.join('{0}={1}'.format(k, v) for k, v in sorted(size.items())))
+    print('{0:<44} {1:>10} {2:>10}'.format('Control / stage', 'seconds', 'API calls'))
+    print('-' * 66)
+    for key, entry in sorted(summary['entries'].items(), key=lambda item: -item[1]['seconds']):
+        label = key if key == entry['function'] else '{0} ({1})'.format(key, entry['function'])
+        print('{0:<44.44} {1:>10.3f} {2:>10.0f}'.format(label, entry['seconds'], entry['calls']))
+    print('-' * 66)
+    print('{0:<44} {1:>10.3f} {2:>10.0f}'.format('End to end (lambda_handler)', summary['seconds'], summary['calls']))
+    print('Report uploaded: {0} bytes'.format(summary['report_bytes']))
+    if summary['invocations'] > 1:
+        print('Completed in {0} invocations (checkpointed on simulated timeout)'.format(summary['invocations']))
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    size = size_from_args(args)
+    account = scenarios.build_account(seed=args.seed, **size)
+    runs = []
+    for _ in range(args.repeat):
+        fake = fake_aws.FakeAWS(account, latency=args.latency_ms / 1000.0,
+                                latency_overrides=_latency_overrides(args.latency))
+        runs.append(harness.run(fake, config_rule=args.config_rule, timeout_ms=args.timeout_ms))
+    summary = summarize(runs)
+    if args.json:
+        print(json.dumps({'size': size, 'latency_ms': args.latency_ms, 'repeat': args.repeat,
+                          'summary': summary}, indent=2, sort_keys=True))
+    else:
+        print_table(size, summary)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
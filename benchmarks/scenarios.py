@@ -0,0 +1,352 @@
+"""Generators for synthetic accounts served by ``fake_aws.FakeAWS``.
+
+``build_account`` produces a deterministic account model of a given size.
+Roughly one resource in ten is made non-compliant so every control has
+offenders to report, which keeps report rendering in the measured path.
+"""
+
+from __future__ import print_function
+
+import datetime
+import json
+import random
+
+
+REGION_NAMES = [
+    'us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'ca-central-1',
+    'eu-west-1', 'eu-west-2', 'eu-west-3', 'eu-central-1', 'eu-north-1',
+    'eu-south-1', 'ap-south-1', 'ap-northeast-1', 'ap-northeast-2',
+    'ap-northeast-3', 'ap-southeast-1', 'ap-southeast-2', 'ap-east-1',
+    'sa-east-1', 'me-south-1', 'af-south-1', 'eu-central-2', 'ap-south-2',
+    'ap-southeast-3', 'il-central-1',
+]
+
+# Named sizes. ``large`` is the reference large account from the backlog.
+SCENARIOS = {
+    'small': dict(users=200, security_groups=100, kms_keys=50, regions=4, trails=5),
+    'medium': dict(users=2000, security_groups=1000, kms_keys=500, regions=10, trails=20),
+    'large': dict(users=10000, security_groups=5000, kms_keys=3000, regions=20, trails=50),
+}
+
+ACCOUNT_ID = '123456789012'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S+00:00'
+
+# Metric filters that satisfy controls 3.1, 3.3 and 3.5; the remaining 3.x
+# controls fail, which exercises both outcomes.
+METRIC_FILTER_PATTERNS = {
+    'UnauthorizedAPICalls': '{ ($.errorCode = "*UnauthorizedOperation") || ($.errorCode = "AccessDenied*") }',
+    'RootUsage': '{ $.userIdentity.type = "Root" && $.userIdentity.invokedBy NOT EXISTS && $.eventType != "AwsServiceEvent" }',
+    'CloudTrailChanges': '{ ($.eventName = CreateTrail) || ($.eventName = UpdateTrail) || ($.eventName = DeleteTrail) || ($.eventName = StartLogging) || ($.eventName = StopLogging) }',
+}
+
+
+def _ts(moment):
+    return moment.strftime(TIME_FORMAT)
+
+
+def _spread(total, buckets):
+    """Split ``total`` items as evenly as possible over ``buckets``."""
+    base, extra = divmod(total, buckets)
+    return [base + (1 if i < extra else 0) for i in range(buckets)]
+
+
+def _build_iam(account, users, rng, now):
+    root = {
+        'user': '<root_account>', 'arn': 'arn:aws:iam::{0}:root'.format(ACCOUNT_ID),
+        'user_creation_time': _ts(now - datetime.timedelta(days=2000)),
+        'password_enabled': 'not_supported', 'password_last_used': _ts(now - datetime.timedelta(days=40)),
+        'password_last_changed': 'not_supported', 'password_next_rotation': 'not_supported',
+        'mfa_active': 'true',
+        'access_key_1_active': 'false', 'access_key_1_last_rotated': 'N/A', 'access_key_1_last_used_date': 'N/A',
+        'access_key_1_last_used_region': 'N/A', 'access_key_1_last_used_service': 'N/A',
+        'access_key_2_active': 'false', 'access_key_2_last_rotated': 'N/A', 'access_key_2_last_used_date': 'N/A',
+        'access_key_2_last_used_region': 'N/A', 'access_key_2_last_used_service': 'N/A',
+        'cert_1_active': 'false', 'cert_1_last_rotated': 'N/A', 'cert_2_active': 'false', 'cert_2_last_rotated': 'N/A',
+    }
+    report = [root]
+    user_list = []
+    inline = {}
+    for i in range(users):
+        name = 'user{0:05d}'.format(i)
+        arn = 'arn:aws:iam::{0}:user/{1}'.format(ACCOUNT_ID, name)
+        created = now - datetime.timedelta(days=rng.randint(30, 1500), seconds=rng.randint(0, 86399))
+        has_password = rng.random() < 0.6
+        has_key = rng.random() < 0.7
+        key_created = created if rng.random() < 0.2 else created + datetime.timedelta(days=rng.randint(1, 25))
+        key_used = key_created + datetime.timedelta(days=rng.randint(0, 200))
+        row = dict(root)
+        row.update({
+            'user': name, 'arn': arn, 'user_creation_time': _ts(created),
+            'password_enabled': 'true' if has_password else 'false',
+            'password_last_used': _ts(now - datetime.timedelta(days=rng.randint(0, 180))) if has_password else 'N/A',
+            'password_last_changed': _ts(created) if has_password else 'N/A',
+            'mfa_active': 'true' if rng.random() < 0.8 else 'false',
+            'access_key_1_active': 'true' if has_key else 'false',
+            'access_key_1_last_rotated': _ts(key_created) if has_key else 'N/A',
+            'access_key_1_last_used_date': _ts(min(key_used, now)) if has_key else 'N/A',
+        })
+        report.append(row)
+        user_list.append({'UserName': name, 'UserId': 'AIDA{0:016d}'.format(i), 'Arn': arn, 'Path': '/', 'CreateDate': created})
+        if rng.random() < 0.1:
+            inline[name] = ['inline-{0}'.format(name)]
+    account['credential_report'] = report
+    account['users'] = user_list
+    account['inline_user_policies'] = inline
+    account['virtual_mfa_devices'] = [
+        {'SerialNumber': 'arn:aws:iam::{0}:mfa/{1}'.format(ACCOUNT_ID, u['UserName'])}
+        for u in user_list if rng.random() < 0.5
+    ]
+
+    policies = []
+    documents = {}
+    for i in range(max(10, users // 20)):
+        arn = 'arn:aws:iam::{0}:policy/policy{1:05d}'.format(ACCOUNT_ID, i)
+        policies.append({'PolicyName': 'policy{0:05d}'.format(i), 'PolicyId': 'ANPA{0:017d}'.format(i), 'Arn': arn,
+                         'DefaultVersionId': 'v1',
+                         'AttachmentCount': 1, 'IsAttachable': True})
+        admin = rng.random() < 0.05
+        documents[arn] = {'Version': '2012-10-17', 'Statement': [
+            {'Effect': 'Allow', 'Action': '*' if admin else ['s3:GetObject'],
+             'Resource': '*' if admin else 'arn:aws:s3:::bucket{0}/*'.format(i)}]}
+    account['policies'] = policies
+    account['policy_documents'] = documents
+    account['password_policy'] = {
+        'MinimumPasswordLength': 14, 'RequireSymbols': True, 'RequireNumbers': True,
+        'RequireUppercaseCharacters': True, 'RequireLowercaseCharacters': False,
+        'AllowUsersToChangePassword': True, 'ExpirePasswords': True, 'MaxPasswordAge': 90,
+        'PasswordReusePrevention': 24,
+    }
+    account['account_summary'] = {'AccountMFAEnabled': 1, 'Users': users}
+    account['support_roles'] = [{'RoleName': 'support', 'RoleId': 'AROA0000000000000001'}]
+    account['roles'] = set(['AWSMacieServiceCustomerSetupRole'])
+
+
+def _build_network(account, regions, security_groups, rng):
+    account['security_groups'] = {}
+    account['vpcs'] = {}
+    account['flow_logs'] = {}
+    account['route_tables'] = {}
+    account['peering_connections'] = {}
+    account['instances'] = {}
+    sg_counter = 0
+    for r_index, (region, count) in enumerate(zip(regions, _spread(security_groups, len(regions)))):
+        vpc_count = max(1, count // 50)
+        vpcs = [{'VpcId': 'vpc-{0:02d}{1:06x}'.format(r_index, v), 'State': 'available',
+                 'CidrBlock': '10.{0}.0.0/16'.format(v % 256),
+                 'CidrBlockAssociationSet': [{'CidrBlock': '10.{0}.0.0/16'.format(v % 256),
+                                              'CidrBlockState': {'State': 'associated'}}]} for v in range(vpc_count)]
+        account['vpcs'][region] = vpcs
+        account['flow_logs'][region] = [
+            {'FlowLogId': 'fl-{0}'.format(v['VpcId']), 'ResourceId': v['VpcId'],
+             'FlowLogStatus': 'ACTIVE', 'DeliverLogsStatus': 'FAILED' if rng.random() < 0.1 else 'SUCCESS'}
+            for v in vpcs if rng.random() < 0.8
+        ] + [
+            {'FlowLogId': 'fl-subnet-{0}'.format(v['VpcId']), 'ResourceId': 'subnet-{0}'.format(v['VpcId'][4:]),
+             'FlowLogStatus': 'ACTIVE', 'DeliverLogsStatus': 'SUCCESS'}
+            for v in vpcs if rng.random() < 0.3
+        ]
+        groups = []
+        for v in vpcs:
+            groups.append({'GroupId': 'sg-{0:017x}'.format(sg_counter), 'GroupName': 'default', 'VpcId': v['VpcId'],
+                           'IpPermissions': [] if rng.random() < 0.7 else [{'IpProtocol': '-1', 'IpRanges': [], 'UserIdGroupPairs': [{'GroupId': 'self'}]}],
+                           'IpPermissionsEgress': []})
+            sg_counter += 1
+        for i in range(max(0, count - vpc_count)):
+            roll = rng.random()
+            if roll < 0.05:
+                port = 22
+            elif roll < 0.1:
+                port = 3389
+            else:
+                port = rng.choice([80, 443, 8080, 5432, 3306, 6379])
+            world = roll < 0.1 or rng.random() < 0.2
+            permissions = [{'IpProtocol': 'tcp', 'FromPort': port, 'ToPort': port,
+                            'IpRanges': [{'CidrIp': '0.0.0.0/0' if world else '10.0.0.0/8'}],
+                            'Ipv6Ranges': [{'CidrIpv6': '::/0'}] if world and rng.random() < 0.3 else [],
+                            'UserIdGroupPairs': []}]
+            extra = rng.random()
+            if extra < 0.02:
+                permissions.append({'IpProtocol': 'tcp', 'FromPort': 1024, 'ToPort': 65535, 'IpRanges': [],
+                                    'Ipv6Ranges': [{'CidrIpv6': '::/0'}], 'UserIdGroupPairs': []})
+            elif extra < 0.03:
+                permissions.append({'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
+                                    'Ipv6Ranges': [], 'UserIdGroupPairs': []})
+            elif extra < 0.05:
+                permissions.append({'IpProtocol': 'icmp', 'FromPort': 8, 'ToPort': -1,
+                                    'IpRanges': [{'CidrIp': '0.0.0.0/0'}], 'Ipv6Ranges': [], 'UserIdGroupPairs': []})
+            groups.append({
+                'GroupId': 'sg-{0:017x}'.format(sg_counter), 'GroupName': 'app-{0}'.format(i),
+                'VpcId': vpcs[i % vpc_count]['VpcId'],
+                'IpPermissions': permissions,
+                'IpPermissionsEgress': [{'IpProtocol': '-1', 'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}],
+            })
+            sg_counter += 1
+        account['security_groups'][region] = groups
+        # Each VPC peers with a 172.16.0.0/20 VPC in another account. Routes to it are
+        # either within the peer (/24) or over-broad (/16); some tables add transit
+        # gateway routes, IPv6 and prefix list peering routes, or an overlapping route
+        # to a peering connection that no longer exists.
+        account['peering_connections'][region] = [
+            {'VpcPeeringConnectionId': 'pcx-{0}'.format(v['VpcId'][4:]), 'Status': {'Code': 'active'},
+             'RequesterVpcInfo': {'VpcId': v['VpcId'], 'OwnerId': ACCOUNT_ID, 'CidrBlock': v['CidrBlock'],
+                                  'CidrBlockSet': [{'CidrBlock': v['CidrBlock']}]},
+             'AccepterVpcInfo': {'VpcId': 'vpc-peer{0}'.format(v['VpcId'][4:]), 'OwnerId': '210987654321',
+                                 'CidrBlock': '172.16.0.0/20', 'CidrBlockSet': [{'CidrBlock': '172.16.0.0/20'}],
+                                 'Ipv6CidrBlockSet': [{'Ipv6CidrBlock': '2600:1f18:abcd::/56'}]}}
+            for v in vpcs
+        ]
+        tables = []
+        for v in vpcs:
+            pcx = 'pcx-{0}'.format(v['VpcId'][4:])
+            routes = [
+                {'DestinationCidrBlock': v['CidrBlock'], 'GatewayId': 'local'},
+                {'DestinationCidrBlock': '172.16.0.0/{0}'.format(rng.choice([16, 24])), 'VpcPeeringConnectionId': pcx},
+            ]
+            routes += [{'DestinationCidrBlock': '100.{0}.0.0/16'.format(t), 'TransitGatewayId': 'tgw-0001'}
+                       for t in range(rng.choice([0, 0, 10, 200]))]
+            if rng.random() < 0.3:
+                routes.append({'DestinationIpv6CidrBlock': '2600:1f18:abcd::/64', 'VpcPeeringConnectionId': pcx})
+            if rng.random() < 0.1:
+                routes.append({'DestinationPrefixListId': 'pl-0001', 'VpcPeeringConnectionId': pcx})
+            if rng.random() < 0.1:
+                routes.append({'DestinationCidrBlock': '172.16.4.0/22', 'VpcPeeringConnectionId': 'pcx-deleted'})
+            tables.append({'RouteTableId': 'rtb-{0}'.format(v['VpcId'][4:]), 'VpcId': v['VpcId'], 'Routes': routes})
+        account['route_tables'][region] = tables
+        account['instances'][region] = [
+            {'ReservationId': 'r-{0}-{1}'.format(region, i), 'Instances': [
+                dict({'InstanceId': 'i-{0:02d}{1:015x}'.format(r_index, i)},
+                     **({'IamInstanceProfile': {'Arn': 'arn:aws:iam::{0}:instance-profile/app'.format(ACCOUNT_ID)}}
+                        if rng.random() < 0.7 else {}))]}
+            for i in range(max(1, count // 10))
+        ]
+
+
+def _build_logging(account, regions, trails, rng):
+    buckets = {}
+    trail_list = []
+    metric_filters = {}
+    alarms = {}
+    topics = {}
+    for i in range(trails):
+        home = regions[i % len(regions)]
+        name = 'trail{0:03d}'.format(i)
+        bucket = 'cloudtrail-logs-{0}'.format(i % 5)
+        group = 'CloudTrail/{0}'.format(name)
+        trail = {
+            'Name': name, 'HomeRegion': home, 'S3BucketName': bucket,
+            'TrailARN': 'arn:aws:cloudtrail:{0}:{1}:trail/{2}'.format(home, ACCOUNT_ID, name),
+            'IsMultiRegionTrail': i == 0 or rng.random() < 0.2, 'IncludeGlobalServiceEvents': True,
+            'LogFileValidationEnabled': rng.random() < 0.8, 'IsOrganizationTrail': False,
+            '_logging': i == 0 or rng.random() < 0.9,
+        }
+        if i == 0 or rng.random() < 0.7:
+            trail['CloudWatchLogsLogGroupArn'] = 'arn:aws:logs:{0}:{1}:log-group:{2}:*'.format(home, ACCOUNT_ID, group)
+            filters = []
+            for metric, pattern in METRIC_FILTER_PATTERNS.items():
+                if i == 0 or rng.random() < 0.3:
+                    filters.append({'filterName': metric, 'filterPattern': pattern, 'metricTransformations': [
+                        {'metricName': metric, 'metricNamespace': 'CISBenchmark', 'metricValue': '1'}]})
+                    topic = 'arn:aws:sns:{0}:{1}:cis-alarms'.format(home, ACCOUNT_ID)
+                    alarms[(home, 'CISBenchmark', metric)] = [{'AlarmName': metric, 'AlarmActions': [topic]}]
+                    topics[topic] = [{'SubscriptionArn': topic + ':sub', 'Protocol': 'email'}]
+            filters.append({'filterName': 'noise', 'filterPattern': '{ $.eventName = "Noise" }', 'metricTransformations': [
+                {'metricName': 'Noise', 'metricNamespace': 'Other', 'metricValue': '1'}]})
+            metric_filters[(home, group)] = filters
+        if rng.random() < 0.7:
+            trail['KmsKeyId'] = 'arn:aws:kms:{0}:{1}:key/trail-{2}'.format(home, ACCOUNT_ID, i)
+        trail_list.append(trail)
+        if bucket not in buckets:
+            public = i % 5 == 1
+            buckets[bucket] = {
+                'region': home, 'logging': i % 5 != 2,
+                'grants': [{'Grantee': {'Type': 'CanonicalUser', 'ID': 'owner'}, 'Permission': 'FULL_CONTROL'}] + (
+                    [{'Grantee': {'Type': 'Group', 'URI': 'http://acs.amazonaws.com/groups/global/AllUsers'}, 'Permission': 'READ'}]
+                    if public else []),
+            }
+            if i % 5 in (1, 3):
+                buckets[bucket]['policy_public'] = i % 5 == 3
+            if i % 5 == 4:
+                buckets[bucket]['public_access_block'] = dict(
+                    (key, True) for key in ('BlockPublicAcls', 'IgnorePublicAcls', 'BlockPublicPolicy',
+                                            'RestrictPublicBuckets'))
+    account['trails'] = trail_list
+    account['buckets'] = buckets
+    account['metric_filters'] = metric_filters
+    account['alarms'] = alarms
+    account['topics'] = topics
+
+
+def _build_services(account, regions, kms_keys, rng):
+    account['config'] = {}
+    account['kms_keys'] = {}
+    account['events_rules'] = {}
+    account['guardduty'] = {}
+    key_index = 0
+    for region, count in zip(regions, _spread(kms_keys, len(regions))):
+        recording = rng.random() < 0.8
+        account['config'][region] = {
+            'status': [{'name': 'default', 'recording': recording, 'lastStatus': 'SUCCESS'}] if recording else [],
+            'recorders': [{'name': 'default', 'roleARN': 'arn:aws:iam::{0}:role/config'.format(ACCOUNT_ID),
+                           'recordingGroup': {'allSupported': True, 'includeGlobalResourceTypes': region == regions[0]}}] if recording else [],
+            'channels': [{'name': 'default', 'configHistoryDeliveryInfo': {'lastStatus': 'SUCCESS'},
+                          'configStreamDeliveryInfo': {'lastStatus': 'SUCCESS' if rng.random() < 0.9 else 'FAILURE'}}] if recording else [],
+        }
+        keys = []
+        for _ in range(count):
+            key_id = '{0:08x}-0000-4000-8000-{1:012x}'.format(key_index, key_index)
+            aws_managed = rng.random() < 0.2
+            keys.append({
+                'KeyId': key_id, 'KeyArn': 'arn:aws:kms:{0}:{1}:key/{2}'.format(region, ACCOUNT_ID, key_id),
+                'rotation': aws_managed or rng.random() < 0.7,
+                'manager': 'AWS' if aws_managed else 'CUSTOMER',
+                'description': 'Default master key that protects my S3 objects' if aws_managed else 'app key {0}'.format(key_index),
+                'denied': rng.random() < 0.01,
+            })
+            key_index += 1
+        account['kms_keys'][region] = keys
+        rules = [{'Name': 'noise-{0}'.format(i), 'State': 'ENABLED',
+                  'EventPattern': json.dumps({'source': ['aws.ec2'], 'detail-type': ['EC2 Instance State-change Notification']})}
+                 for i in range(rng.randint(0, 3))]
+        if rng.random() < 0.8:
+            rules.append({'Name': 'guardduty-findings', 'State': 'ENABLED' if rng.random() < 0.9 else 'DISABLED',
+                          'EventPattern': json.dumps({'source': ['aws.guardduty'], 'detail': {'eventSource': ['aws.guardduty']}})})
+        if region == regions[0]:
+            rules.append({'Name': 'macie-alerts', 'State': 'ENABLED', 'EventPattern': json.dumps({'source': ['aws.macie']})})
+        account['events_rules'][region] = rules
+        if rng.random() < 0.85:
+            account['guardduty'][region] = [{'DetectorId': 'det{0}'.format(region.replace('-', '')),
+                                             'Status': 'ENABLED' if rng.random() < 0.9 else 'DISABLED'}]
+    account['inspector_targets'] = ['arn:aws:inspector:{0}:{1}:target/0-app'.format(regions[0], ACCOUNT_ID)]
+    account['macie'] = {regions[0]: 'ENABLED'}
+
+
+def build_account(users=200, security_groups=100, kms_keys=50, regions=4, trails=5, seed=0):
+    """Build a synthetic account model.
+
+    Args:
+        users (int): IAM users, each with a credential report row.
+        security_groups (int): Security groups spread over all regions.
+        kms_keys (int): KMS keys spread over all regions.
+        regions (int): Enabled regions, taken from ``REGION_NAMES``.
+        trails (int): CloudTrail trails spread over all regions.
+        seed (int): Random seed; equal arguments give equal accounts.
+
+    Returns:
+        dict: Account model consumed by ``fake_aws.FakeAWS``.
+    """
+    if regions > len(REGION_NAMES):
+        raise ValueError('At most {0} regions are supported'.format(len(REGION_NAMES)))
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    region_list = REGION_NAMES[:regions]
+    account = {
+        'account_id': ACCOUNT_ID,
+        'regions': region_list,
+        'size': dict(users=users, security_groups=security_groups, kms_keys=kms_keys, regions=regions, trails=trails),
+    }
+    _build_iam(account, users, rng, now)
+    _build_network(account, region_list, security_groups, rng)
+    _build_logging(account, region_list, trails, rng)
+    _build_services(account, region_list, kms_keys, rng)
+    return account
+